@@ -2,6 +2,8 @@ import React, { createContext, useContext, useState, useEffect } from "react";
 import {
   initializeKeyExchange,
   completeKeyExchange,
+  clearSessionKey,
+  refreshEncryptionKey,
   setupKeyRefresh,
 } from "../services/cryptoService";
 
@@ -53,10 +55,8 @@ export const AuthProvider = ({ children }) => {
         setIsAuthenticated(true);
       }
 
-      // Check if encryption is established
-      if (sessionStorage.getItem("encryption_established") === "true") {
-        setEncryptionStatus(true);
-      }
+      // The session key only lives in memory, so redo the key exchange after a reload
+      refreshEncryptionKey(accessToken).then(setEncryptionStatus);
     }
 
     // Set up periodic key refresh
@@ -163,7 +163,7 @@ export const AuthProvider = ({ children }) => {
     localStorage.removeItem("userRole");
     localStorage.removeItem("userId");
     localStorage.removeItem("userEmail");
-    sessionStorage.removeItem("encryption_established");
+    clearSessionKey();
     setTokens(null);
     setUser(null);
     setIsAuthenticated(false);
@@ -1,5 +1,11 @@
 import React, { createContext, useContext, useState } from "react";
 import { useAuth } from "./AuthContext";
+import {
+  getSessionKeyId,
+  hasSessionKey,
+  refreshEncryptionKey,
+  unwrapRegionPayload,
+} from "../services/cryptoService";
 
 // Create the patient context
 const PatientContext = createContext();
@@ -158,6 +164,87 @@ export const PatientProvider = ({ children }) => {
     }
   };
 
+  // Fetch the blurred image plus decrypted regions and composite them locally
+  // (delivery=regions), so the server never decodes or re-encodes the full frame
+  const fetchCompositedImage = async (url) => {
+    setImageLoading(true);
+    setImageError(null);
+
+    try {
+      // With an established key, regions arrive wrapped and are decrypted here
+      const separator = url.includes("?") ? "&" : "?";
+      const headers = { Authorization: `Bearer ${tokens.access}` };
+      const loadPayload = async (delivery) => {
+        let response = await fetch(`${url}${separator}delivery=${delivery}`, {
+          headers,
+        });
+        if (delivery === "e2e" && response.status === 409) {
+          // The server has no key for this session; fall back to plain regions
+          response = await fetch(`${url}${separator}delivery=regions`, { headers });
+        }
+
+        if (!response.ok) {
+          throw new Error(
+            `Failed to load image regions: ${response.status} ${response.statusText}`
+          );
+        }
+        return response.json();
+      };
+
+      const e2e = encryptionStatus && hasSessionKey();
+      let payload = await loadPayload(e2e ? "e2e" : "regions");
+      if (payload.encryption && payload.encryption.key_id !== getSessionKeyId()) {
+        // A key exchange in another tab replaced the server's key for this user;
+        // exchange again so this tab holds the current key
+        const exchanged = await refreshEncryptionKey(tokens.access);
+        payload = await loadPayload(exchanged ? "e2e" : "regions");
+        if (payload.encryption && payload.encryption.key_id !== getSessionKeyId()) {
+          throw new Error("Image regions are wrapped under a different session key");
+        }
+      }
+
+      // Load the blurred image as a blob so the canvas is not tainted
+      const blurredResponse = await fetch(payload.blurred_image_url);
+      if (!blurredResponse.ok) {
+        throw new Error(`Failed to load blurred image: ${blurredResponse.status}`);
+      }
+      const blurred = await createImageBitmap(await blurredResponse.blob());
+
+      const canvas = document.createElement("canvas");
+      canvas.width = blurred.width;
+      canvas.height = blurred.height;
+      const context = canvas.getContext("2d");
+      context.drawImage(blurred, 0, 0);
+
+      // Paste every decrypted region over its box
+      for (const region of payload.regions) {
+        let bytes = Uint8Array.from(atob(region.data), (c) => c.charCodeAt(0));
+        if (payload.encryption) {
+          bytes = new Uint8Array(await unwrapRegionPayload(bytes));
+        }
+        const bitmap = await createImageBitmap(
+          new Blob([bytes], { type: region.content_type })
+        );
+        context.drawImage(
+          bitmap,
+          region.x1,
+          region.y1,
+          region.x2 - region.x1,
+          region.y2 - region.y1
+        );
+      }
+
+      const blob = await new Promise((resolve) => canvas.toBlob(resolve, "image/png"));
+      setImageLoading(false);
+      return URL.createObjectURL(blob);
+    } catch (error) {
+      console.error("Error compositing image:", error);
+      setImageError(error.message);
+      setImageLoading(false);
+      return null;
+    }
+  };
+
   const value = {
     loading,
     error,
@@ -166,6 +253,7 @@ export const PatientProvider = ({ children }) => {
     addPatient,
     findPatientById,
     fetchAuthenticatedImage,
+    fetchCompositedImage,
     encryptionStatus,
   };
 
@@ -15,6 +15,7 @@ const SearchPatient = () => {
     findPatientById,
     loading,
     fetchAuthenticatedImage,
+    fetchCompositedImage,
     imageLoading,
     imageError,
     encryptionStatus,
@@ -44,7 +45,14 @@ const SearchPatient = () => {
 
   // Function to fetch the image with authentication and decryption if needed
   const getPatientImage = async (url) => {
-    const imageUrl = await fetchAuthenticatedImage(url);
+    // Region delivery composites in the browser; fall back to the restored frame
+    let imageUrl = null;
+    if (process.env.REACT_APP_REGION_DELIVERY === "true") {
+      imageUrl = await fetchCompositedImage(url);
+    }
+    if (!imageUrl) {
+      imageUrl = await fetchAuthenticatedImage(url);
+    }
     if (imageUrl) {
       setImageBlob(imageUrl);
     }
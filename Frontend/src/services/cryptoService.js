@@ -1,5 +1,13 @@
 import * as forge from "node-forge";
 
+// AES key derived from the key exchange. Kept only in memory as a
+// non-extractable CryptoKey, so page scripts cannot read the raw bytes and it
+// is gone on reload or logout.
+let sessionKey = null;
+
+// Identifies sessionKey like the server's key_id (first 16 hex digits of its SHA-256)
+let sessionKeyId = null;
+
 /**
  * Initialize Diffie-Hellman key exchange with server
  * @param {string} accessToken - JWT access token
@@ -94,13 +102,22 @@ export async function completeKeyExchange(accessToken, dhParams) {
     // Calculate shared secret (this is never transmitted)
     const sharedSecret = serverPublicKey.modPow(clientPrivateKey, p);
 
-    // Derive AES key from shared secret using SHA-256
+    // Derive AES key from shared secret using SHA-256 over its big-endian bytes,
+    // left-padded to the length of p (the same bytes the server's exchange() returns)
+    const byteLength = Math.ceil(p.bitLength() / 8);
+    const secretHex = sharedSecret.toString(16).padStart(byteLength * 2, "0");
     const md = forge.md.sha256.create();
-    md.update(sharedSecret.toString());
-    const aesKey = md.digest().toHex();
-
-    // Store the derived key securely (in memory/session storage, not localStorage)
-    sessionStorage.setItem("encryption_established", "true");
+    md.update(forge.util.hexToBytes(secretHex));
+    const keyBinary = md.digest().getBytes();
+    const keyBytes = Uint8Array.from(keyBinary, (c) => c.charCodeAt(0));
+    const keyIdDigest = forge.md.sha256.create();
+    keyIdDigest.update(keyBinary);
+
+    // Import the derived key as non-extractable and keep it in memory only
+    sessionKey = await window.crypto.subtle.importKey("raw", keyBytes, "AES-GCM", false, [
+      "decrypt",
+    ]);
+    sessionKeyId = keyIdDigest.digest().toHex().slice(0, 16);
 
     console.log("Key exchange completed successfully");
     return await response.json();
@@ -110,6 +127,51 @@ export async function completeKeyExchange(accessToken, dhParams) {
   }
 }
 
+/**
+ * Whether a key exchange has completed since the page was loaded
+ * @returns {boolean} - True if a session key is held in memory
+ */
+export function hasSessionKey() {
+  return sessionKey !== null;
+}
+
+/**
+ * Key id of the session key, to compare with the key_id of wrapped payloads
+ * @returns {string|null} - Key id, or null if no key is established
+ */
+export function getSessionKeyId() {
+  return sessionKeyId;
+}
+
+/**
+ * Forget the session key (on logout)
+ */
+export function clearSessionKey() {
+  sessionKey = null;
+  sessionKeyId = null;
+  // Earlier versions kept the raw key in sessionStorage
+  sessionStorage.removeItem("encryption_key");
+  sessionStorage.removeItem("encryption_established");
+}
+
+/**
+ * Decrypt a region payload wrapped by the server for this session
+ * (AES-256-GCM, 12-byte IV followed by ciphertext and tag)
+ * @param {Uint8Array} wrapped - Wrapped payload bytes
+ * @returns {Promise<ArrayBuffer|null>} - Plaintext, or null if no key is established
+ */
+export async function unwrapRegionPayload(wrapped) {
+  if (!sessionKey) {
+    return null;
+  }
+
+  return window.crypto.subtle.decrypt(
+    { name: "AES-GCM", iv: wrapped.slice(0, 12) },
+    sessionKey,
+    wrapped.slice(12)
+  );
+}
+
 /**
  * Refresh the encryption key
  * @param {string} accessToken - JWT access token
@@ -0,0 +1,368 @@
+"""
+Shared on-host cache backend for multi-worker deployments.
+
+Django's default LocMemCache is private to each gunicorn worker, so data written
+by one worker (e.g. the `dh_exchange_<id>` session of the key exchange) is
+invisible to the others. This backend keeps every entry in a single SQLite file
+in WAL mode, which all workers on the host can read concurrently without any
+external service.
+
+Features:
+- LRU eviction bounded by both entry count (MAX_ENTRIES) and size (MAX_BYTES)
+- Batched get_many/set_many/delete_many in a single statement/transaction
+- Atomic add, incr and compare_and_set across processes
+"""
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+# Default byte budget for all cached values (256 MB)
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+# Reads only refresh the LRU timestamp when it is older than this many seconds,
+# so hot keys don't turn every get() into a write
+ACCESS_RESOLUTION = 1.0
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache_entries (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    expires REAL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cache_entries_accessed ON cache_entries (accessed);
+CREATE INDEX IF NOT EXISTS cache_entries_expires ON cache_entries (expires);
+CREATE TABLE IF NOT EXISTS cache_stats (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    entries INTEGER NOT NULL,
+    bytes INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO cache_stats (id, entries, bytes) VALUES (1, 0, 0);
+CREATE TRIGGER IF NOT EXISTS cache_entries_insert AFTER INSERT ON cache_entries BEGIN
+    UPDATE cache_stats SET entries = entries + 1, bytes = bytes + NEW.size WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS cache_entries_delete AFTER DELETE ON cache_entries BEGIN
+    UPDATE cache_stats SET entries = entries - 1, bytes = bytes - OLD.size WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS cache_entries_update AFTER UPDATE OF size ON cache_entries BEGIN
+    UPDATE cache_stats SET bytes = bytes - OLD.size + NEW.size WHERE id = 1;
+END;
+"""
+
+
+class SQLiteCache(BaseCache):
+    """
+    Cache backend storing pickled values in a shared SQLite database.
+
+    Settings example:
+        CACHES = {
+            'default': {
+                'BACKEND': 'medical_lab_system.cache.SQLiteCache',
+                'LOCATION': BASE_DIR / 'cache.sqlite3',
+                'OPTIONS': {'MAX_ENTRIES': 5000, 'MAX_BYTES': 256 * 1024 * 1024},
+            }
+        }
+    """
+    pickle_protocol = pickle.HIGHEST_PROTOCOL
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self._path = str(location)
+        self._max_bytes = int(options.get('MAX_BYTES', DEFAULT_MAX_BYTES))
+        self._busy_timeout = float(options.get('BUSY_TIMEOUT', 5.0))
+        self._local = threading.local()
+
+    # ------------------------------------------------------------------
+    # Connection handling
+    # ------------------------------------------------------------------
+
+    def _connection(self):
+        """
+        Return the connection for the current thread, opening it on first use.
+
+        Connections are never shared between threads or across fork(), which
+        matters when gunicorn preloads the app before spawning workers.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        directory = os.path.dirname(self._path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # isolation_level=None: we manage transactions explicitly
+        conn = sqlite3.connect(self._path, timeout=self._busy_timeout, isolation_level=None,
+                               check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(_SCHEMA)
+
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def _transaction(self):
+        """Open a write transaction that takes the database lock immediately"""
+        return _ImmediateTransaction(self._connection())
+
+    # ------------------------------------------------------------------
+    # Internal helpers (must be called inside a transaction)
+    # ------------------------------------------------------------------
+
+    def _pickle(self, value):
+        return pickle.dumps(value, self.pickle_protocol)
+
+    def _fetch(self, conn, key, now):
+        """Return the live (value, accessed) row for a key, deleting it if expired"""
+        row = conn.execute(
+            'SELECT value, expires, accessed FROM cache_entries WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        value, expires, accessed = row
+        if expires is not None and expires <= now:
+            conn.execute('DELETE FROM cache_entries WHERE key = ? AND expires <= ?', (key, now))
+            return None
+        return value, accessed
+
+    def _store(self, conn, key, pickled, timeout, now):
+        """Insert or replace a single entry; returns False if it can never fit the budget"""
+        size = len(pickled)
+        if size > self._max_bytes:
+            conn.execute('DELETE FROM cache_entries WHERE key = ?', (key,))
+            return False
+        conn.execute(
+            'INSERT INTO cache_entries (key, value, size, expires, accessed) VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT(key) DO UPDATE SET value = excluded.value, size = excluded.size, '
+            'expires = excluded.expires, accessed = excluded.accessed',
+            (key, pickled, size, self.get_backend_timeout(timeout), now)
+        )
+        return True
+
+    def _cull(self, conn, now):
+        """Drop expired entries, then least recently used ones until within budget"""
+        entries, total_bytes = conn.execute(
+            'SELECT entries, bytes FROM cache_stats WHERE id = 1'
+        ).fetchone()
+        if entries <= self._max_entries and total_bytes <= self._max_bytes:
+            return
+
+        conn.execute('DELETE FROM cache_entries WHERE expires IS NOT NULL AND expires <= ?', (now,))
+        entries, total_bytes = conn.execute(
+            'SELECT entries, bytes FROM cache_stats WHERE id = 1'
+        ).fetchone()
+        if entries <= self._max_entries and total_bytes <= self._max_bytes:
+            return
+
+        # Evict down to a low-water mark so we don't cull again on the next set
+        if self._cull_frequency:
+            keep_ratio = 1 - 1 / self._cull_frequency
+        else:
+            keep_ratio = 0
+        target_entries = int(self._max_entries * keep_ratio)
+        target_bytes = int(self._max_bytes * keep_ratio)
+
+        victims = []
+        for key, size in conn.execute('SELECT key, size FROM cache_entries ORDER BY accessed'):
+            if entries <= target_entries and total_bytes <= target_bytes:
+                break
+            victims.append((key,))
+            entries -= 1
+            total_bytes -= size
+        conn.executemany('DELETE FROM cache_entries WHERE key = ?', victims)
+
+    # ------------------------------------------------------------------
+    # Django cache API
+    # ------------------------------------------------------------------
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        pickled = self._pickle(value)
+        now = time.time()
+        with self._transaction() as conn:
+            if self._fetch(conn, key, now) is not None:
+                return False
+            stored = self._store(conn, key, pickled, timeout, now)
+            self._cull(conn, now)
+            return stored
+
+    def get(self, key, default=None, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        return self._get_many({key: key}).get(key, default)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        pickled = self._pickle(value)
+        now = time.time()
+        with self._transaction() as conn:
+            self._store(conn, key, pickled, timeout, now)
+            self._cull(conn, now)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        now = time.time()
+        with self._transaction() as conn:
+            if self._fetch(conn, key, now) is None:
+                return False
+            conn.execute(
+                'UPDATE cache_entries SET expires = ?, accessed = ? WHERE key = ?',
+                (self.get_backend_timeout(timeout), now, key)
+            )
+            return True
+
+    def delete(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        with self._transaction() as conn:
+            cursor = conn.execute('DELETE FROM cache_entries WHERE key = ?', (key,))
+            return cursor.rowcount > 0
+
+    def has_key(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        row = self._connection().execute(
+            'SELECT 1 FROM cache_entries WHERE key = ? AND (expires IS NULL OR expires > ?)',
+            (key, time.time())
+        ).fetchone()
+        return row is not None
+
+    def incr(self, key, delta=1, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        now = time.time()
+        with self._transaction() as conn:
+            row = self._fetch(conn, key, now)
+            if row is None:
+                raise ValueError("Key '%s' not found" % key)
+            new_value = pickle.loads(row[0]) + delta
+            pickled = self._pickle(new_value)
+            conn.execute(
+                'UPDATE cache_entries SET value = ?, size = ?, accessed = ? WHERE key = ?',
+                (pickled, len(pickled), now, key)
+            )
+            return new_value
+
+    def clear(self):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM cache_entries')
+
+    def get_many(self, keys, version=None):
+        """
+        Fetch several keys with one SELECT, refreshing their LRU position.
+
+        Args:
+            keys: Iterable of cache keys
+            version: Optional key version
+
+        Returns:
+            dict: key -> value for every key that was found
+        """
+        key_map = {self.make_and_validate_key(key, version=version): key for key in keys}
+        return self._get_many(key_map)
+
+    def _get_many(self, key_map):
+        """Look up database keys, returning values under the caller's keys"""
+        if not key_map:
+            return {}
+
+        now = time.time()
+        conn = self._connection()
+        placeholders = ','.join('?' * len(key_map))
+        rows = conn.execute(
+            f'SELECT key, value, expires, accessed FROM cache_entries WHERE key IN ({placeholders})',
+            list(key_map)
+        ).fetchall()
+
+        result = {}
+        stale = []
+        expired = []
+        for db_key, value, expires, accessed in rows:
+            if expires is not None and expires <= now:
+                expired.append((db_key, now))
+                continue
+            result[key_map[db_key]] = pickle.loads(value)
+            if now - accessed > ACCESS_RESOLUTION:
+                stale.append((now, db_key))
+
+        if stale or expired:
+            with self._transaction() as conn:
+                conn.executemany('UPDATE cache_entries SET accessed = ? WHERE key = ?', stale)
+                conn.executemany('DELETE FROM cache_entries WHERE key = ? AND expires <= ?', expired)
+        return result
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        """
+        Store several values in a single transaction.
+
+        Returns:
+            list: Keys that could not be stored because they exceed MAX_BYTES
+        """
+        now = time.time()
+        failed = []
+        with self._transaction() as conn:
+            for key, value in data.items():
+                db_key = self.make_and_validate_key(key, version=version)
+                if not self._store(conn, db_key, self._pickle(value), timeout, now):
+                    failed.append(key)
+            self._cull(conn, now)
+        return failed
+
+    def delete_many(self, keys, version=None):
+        db_keys = [(self.make_and_validate_key(key, version=version),) for key in keys]
+        if not db_keys:
+            return
+        with self._transaction() as conn:
+            conn.executemany('DELETE FROM cache_entries WHERE key = ?', db_keys)
+
+    def compare_and_set(self, key, expected, value, timeout=DEFAULT_TIMEOUT, version=None):
+        """
+        Atomically replace the value of a key only if it currently equals `expected`.
+
+        Use expected=None to require that the key does not exist yet.
+
+        Args:
+            key: Cache key
+            expected: Value the key must currently hold
+            value: New value to store
+            timeout: Timeout for the new value
+
+        Returns:
+            bool: True if the value was swapped, False if another writer won
+        """
+        key = self.make_and_validate_key(key, version=version)
+        pickled = self._pickle(value)
+        now = time.time()
+        with self._transaction() as conn:
+            row = self._fetch(conn, key, now)
+            current = pickle.loads(row[0]) if row is not None else None
+            if current != expected:
+                return False
+            stored = self._store(conn, key, pickled, timeout, now)
+            self._cull(conn, now)
+            return stored
+
+    def close(self, **kwargs):
+        # Connections are reused for the lifetime of the thread
+        pass
+
+
+class _ImmediateTransaction:
+    """Context manager wrapping BEGIN IMMEDIATE ... COMMIT/ROLLBACK"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute('BEGIN IMMEDIATE')
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.conn.execute('COMMIT')
+        else:
+            self.conn.execute('ROLLBACK')
+        return False
@@ -115,12 +115,173 @@ WSGI_APPLICATION = 'medical_lab_system.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# Two supported profiles, chosen with DB_ENGINE:
+#
+# sqlite (default): WAL journal so doctor reads proceed while an upload commits,
+# synchronous=NORMAL (safe with WAL, loses at most the last commits on power
+# loss), a memory-mapped read path and IMMEDIATE write transactions, so
+# concurrent writers queue on the busy timeout instead of failing with
+# "database is locked" when upgrading a read lock.
+#
+# postgres: persistent connections checked before reuse (DB_CONN_MAX_AGE).
+# POSTGRES_POOL=true uses the psycopg 3 connection pool of each worker instead
+# (needs psycopg[pool]); POSTGRES_PGBOUNCER=true is for a transaction-pooling
+# PgBouncer in front of the server.
+
+DB_ENGINE = os.environ.get('DB_ENGINE', 'sqlite').lower()
+
+SQLITE_OPTIONS = {
+    'init_command': (
+        'PRAGMA journal_mode=WAL;'
+        'PRAGMA synchronous=NORMAL;'
+        f"PRAGMA mmap_size={int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))};"
+        'PRAGMA cache_size=-20000;'  # 20 MB page cache per connection
+        'PRAGMA temp_store=MEMORY;'
+    ),
+    'transaction_mode': 'IMMEDIATE',
+    # Busy timeout in seconds: how long a writer waits for the write lock
+    'timeout': float(os.environ.get('SQLITE_BUSY_TIMEOUT', 20)),
+}
+
+if DB_ENGINE == 'postgres':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('POSTGRES_DB', 'medsec'),
+            'USER': os.environ.get('POSTGRES_USER', 'medsec'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 600)),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'connect_timeout': 5,
+            },
+        }
+    }
+    if os.environ.get('POSTGRES_POOL', '').lower() == 'true':
+        # Django's connection pool is built on psycopg 3 and psycopg_pool, not psycopg2
+        from importlib.util import find_spec
+        if find_spec('psycopg') is None or find_spec('psycopg_pool') is None:
+            from django.core.exceptions import ImproperlyConfigured
+            raise ImproperlyConfigured(
+                "POSTGRES_POOL=true requires psycopg 3 with its pool: pip install 'psycopg[binary,pool]'"
+            )
+        # The pool owns the connections; Django requires persistent connections to be off
+        DATABASES['default']['CONN_MAX_AGE'] = 0
+        DATABASES['default']['OPTIONS']['pool'] = {
+            'min_size': int(os.environ.get('POSTGRES_POOL_MIN_SIZE', 2)),
+            'max_size': int(os.environ.get('POSTGRES_POOL_MAX_SIZE', 10)),
+            'timeout': 10,
+        }
+    if os.environ.get('POSTGRES_PGBOUNCER', '').lower() == 'true':
+        # Server-side cursors do not survive transaction pooling
+        DATABASES['default']['DISABLE_SERVER_SIDE_CURSORS'] = True
+elif DB_ENGINE == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('SQLITE_PATH', BASE_DIR / 'db.sqlite3'),
+            'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 600)),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': SQLITE_OPTIONS,
+        }
+    }
+else:
+    from django.core.exceptions import ImproperlyConfigured
+    raise ImproperlyConfigured(f"Unknown DB_ENGINE {DB_ENGINE!r}; use 'sqlite' or 'postgres'")
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# Shared on-host cache so all gunicorn workers see the same entries
+# (DH key-exchange sessions, image version stamps, similarity metrics).
+# It is a file on disk, so decrypted regions and restored images never go
+# here; they stay in per-worker memory (see RESTORED_IMAGE_CACHE_BYTES).
+# Set CACHE_BACKEND=locmem to fall back to Django's per-process cache.
+
+if os.environ.get('CACHE_BACKEND', 'sqlite') == 'locmem':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'medical_lab_system.cache.SQLiteCache',
+            'LOCATION': os.environ.get('CACHE_LOCATION', BASE_DIR / 'cache.sqlite3'),
+            'TIMEOUT': 300,
+            'OPTIONS': {
+                'MAX_ENTRIES': int(os.environ.get('CACHE_MAX_ENTRIES', 5000)),
+                'MAX_BYTES': int(os.environ.get('CACHE_MAX_BYTES', 256 * 1024 * 1024)),
+            },
+        }
     }
+
+# Tests always run against LocMemCache, never the on-disk cache above
+TEST_RUNNER = 'medical_lab_system.test_runner.LocMemCacheTestRunner'
+
+
+# In-process LRU of restored images (pixels, encoded images and tiles) and of
+# decrypted region payloads (per worker)
+RESTORED_IMAGE_CACHE_BYTES = int(os.environ.get('RESTORED_IMAGE_CACHE_BYTES', 256 * 1024 * 1024))
+
+# In-process LRU of decrypted region images (per worker)
+DECRYPTED_REGION_CACHE_BYTES = int(os.environ.get('DECRYPTED_REGION_CACHE_BYTES', 64 * 1024 * 1024))
+DECRYPTED_REGION_CACHE_TTL = 3600  # seconds
+
+# Decryption timings are buffered per worker and written with one bulk_update
+# when this many samples are pending or the interval has passed
+DECRYPTION_TIMING_FLUSH_THRESHOLD = int(os.environ.get('DECRYPTION_TIMING_FLUSH_THRESHOLD', 200))
+DECRYPTION_TIMING_FLUSH_INTERVAL = 30  # seconds
+
+# On-disk cache of decoded blurred images as .npy files, memory-mapped on restore
+# so hot images skip the JPEG/PNG decode. Disabled unless RAW_PIXEL_CACHE_DIR is
+# set; once the files exceed RAW_PIXEL_CACHE_MAX_BYTES, the least recently used
+# ones are removed.
+RAW_PIXEL_CACHE_DIR = os.environ.get('RAW_PIXEL_CACHE_DIR') or None
+RAW_PIXEL_CACHE_MAX_BYTES = int(os.environ.get('RAW_PIXEL_CACHE_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+
+# Content-addressed store for encrypted region payloads. When set, new regions
+# keep only a reference in the database; move existing payloads out with
+# `manage.py migrate_region_blobs`. Unset keeps payloads inline.
+REGION_BLOB_STORE_DIR = os.environ.get('REGION_BLOB_STORE_DIR') or None
+# Blobs at least this large are memory-mapped on read instead of copied
+REGION_BLOB_MMAP_THRESHOLD = 256 * 1024
+
+# Payload stored (encrypted) for each detected region: 'RAW' for lossless pixels
+# with a shape/dtype header, 'JPEG' for the legacy encoded crop file
+CROP_PAYLOAD_FORMAT = os.environ.get('CROP_PAYLOAD_FORMAT', 'RAW')
+# zlib level for RAW payloads. Level 1 stores sample scan crops at about an eighth
+# of their pixel size for roughly 0.4 ms of inflate per 200x300 crop on restore;
+# 0 skips the inflate but stores, encrypts and decrypts the full pixel buffer.
+CROP_PAYLOAD_ZLIB_LEVEL = int(os.environ.get('CROP_PAYLOAD_ZLIB_LEVEL', 1))
+
+# Encoders for restored images (see patients/encoders.py for the defaults, which
+# are tuned for latency). Formats the client accepts equally are chosen in
+# IMAGE_FORMAT_PREFERENCE order; an explicit ?format= always wins.
+IMAGE_ENCODERS = {
+    'png': {'level': 1, 'strategy': 'rle'},
+    'jpeg': {'quality': 95, 'progressive': False, 'optimize': False},
+    'webp': {'quality': 101},  # > 100 is lossless
 }
+IMAGE_FORMAT_PREFERENCE = ['png', 'webp', 'jpeg']
+
+# Deep Zoom tiles of restored images; downscaled blurred levels are kept in a
+# per-worker LRU bounded by DEEPZOOM_PYRAMID_CACHE_BYTES
+DEEPZOOM_TILE_SIZE = 256
+DEEPZOOM_PYRAMID_CACHE_BYTES = int(os.environ.get('DEEPZOOM_PYRAMID_CACHE_BYTES', 128 * 1024 * 1024))
+
+# Default page size of the keyset-paginated processed image listing (?page_size= overrides it)
+PROCESSED_IMAGE_PAGE_SIZE = int(os.environ.get('PROCESSED_IMAGE_PAGE_SIZE', 50))
+
+# Thread pool size used by the patient gallery to render thumbnails concurrently
+GALLERY_MAX_WORKERS = int(os.environ.get('GALLERY_MAX_WORKERS', 4))
+
+# Per-worker LRU of region payloads re-wrapped under a doctor's DH-derived key
+# (delivery=e2e), so repeated views serve the wrapped blobs as-is
+E2E_REWRAP_CACHE_BYTES = int(os.environ.get('E2E_REWRAP_CACHE_BYTES', 32 * 1024 * 1024))
 
 
 # Password validation
@@ -0,0 +1,27 @@
+"""
+Test runner that keeps the test suite off the shared on-disk cache.
+
+The default cache is a SQLite file next to the project (see settings.CACHES),
+which tests would otherwise fill and leave behind. Every test runs against a
+per-process LocMemCache instead; tests of the SQLite backend itself create
+their own instances on temporary files.
+"""
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+TEST_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+
+class LocMemCacheTestRunner(DiscoverRunner):
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self._cache_override = override_settings(CACHES=TEST_CACHES)
+        self._cache_override.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self._cache_override.disable()
+        super().teardown_test_environment(**kwargs)
@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import time
+
+from django.test import SimpleTestCase
+
+from .cache import SQLiteCache
+
+
+class SQLiteCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.location = os.path.join(self.tmp_dir, 'cache.sqlite3')
+        self.cache = self.make_cache()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def make_cache(self, **options):
+        return SQLiteCache(self.location, {'OPTIONS': options})
+
+    def test_entries_are_shared_between_instances(self):
+        # Two backend instances on the same file behave like two workers
+        self.cache.set('dh_exchange_1', '{"p": "23"}')
+        other_worker = self.make_cache()
+        self.assertEqual(other_worker.get('dh_exchange_1'), '{"p": "23"}')
+
+    def test_get_many_and_set_many(self):
+        failed = self.cache.set_many({'a': 1, 'b': b'\x00' * 10, 'c': [1, 2]})
+        self.assertEqual(failed, [])
+        self.assertEqual(self.cache.get_many(['a', 'b', 'missing']), {'a': 1, 'b': b'\x00' * 10})
+
+    def test_expired_entries_are_not_returned(self):
+        self.cache.set('short', 'value', timeout=1)
+        time.sleep(1.1)
+        self.assertIsNone(self.cache.get('short'))
+        self.assertFalse(self.cache.has_key('short'))
+
+    def test_byte_budget_evicts_least_recently_used(self):
+        cache = self.make_cache(MAX_BYTES=3000)
+        cache.set('old', b'x' * 1000)
+        cache.set('hot', b'y' * 1000)
+        # Make 'old' the least recently used entry
+        cache._connection().execute("UPDATE cache_entries SET accessed = 0 WHERE key = ?",
+                                    (cache.make_key('old'),))
+        cache.set('new', b'z' * 1000)
+        self.assertIsNone(cache.get('old'))
+        self.assertIsNotNone(cache.get('new'))
+
+    def test_values_larger_than_budget_are_rejected(self):
+        cache = self.make_cache(MAX_BYTES=100)
+        self.assertEqual(cache.set_many({'big': b'x' * 500}), ['big'])
+        self.assertIsNone(cache.get('big'))
+
+    def test_compare_and_set(self):
+        self.assertTrue(self.cache.compare_and_set('version', None, 1))
+        self.assertFalse(self.cache.compare_and_set('version', None, 2))
+        self.assertTrue(self.cache.compare_and_set('version', 1, 2))
+        self.assertEqual(self.cache.get('version'), 2)
+
+    def test_add_and_incr(self):
+        self.assertTrue(self.cache.add('counter', 1))
+        self.assertFalse(self.cache.add('counter', 5))
+        self.assertEqual(self.cache.incr('counter', 2), 3)
+        with self.assertRaises(ValueError):
+            self.cache.incr('missing')
@@ -8,7 +8,11 @@ import logging
 import os
 import json
 from django.contrib.auth import get_user_model
-from .utils import load_encryption_keys_from_file, save_encryption_key
+from .utils import (
+    decode_region_payload, load_encryption_keys_from_file, region_payload_as_image_file, save_encryption_key,
+)
+from .cache import CachePolicy, bump_image_version
+from .timing import decryption_timings
 
 logger = logging.getLogger(__name__)
 
@@ -23,13 +27,15 @@ class CroppedRegionInline(admin.TabularInline):
     coordinates.short_description = 'Coordinates'
     
     def encrypted_data_preview(self, obj):
-        if not obj.cropped_image_data:
+        # The stored header covers the preview; the ciphertext itself is never loaded
+        preview = obj.payload_preview(32)
+        if not preview:
             return "No encrypted data"
         
         # Show encrypted data visualization
-        data_len = len(obj.cropped_image_data)
+        data_len = obj.payload_size or len(preview)
         # Get first 32 bytes for preview (including IV)
-        preview_hex = binascii.hexlify(obj.cropped_image_data[:32]).decode('ascii')
+        preview_hex = binascii.hexlify(preview).decode('ascii')
         formatted_hex = ' '.join([preview_hex[i:i+2] for i in range(0, len(preview_hex), 2)])
         
         # Apply formatting with CSS to show it's encrypted data
@@ -71,11 +77,12 @@ class ProcessedImageInline(admin.StackedInline):
 @admin.register(ProcessedImage)
 class ProcessedImageAdmin(admin.ModelAdmin):
     list_display = ['patient', 'created_at', 'image_previews']
+    list_select_related = ['patient']
     list_filter = ['created_at', 'patient']
     readonly_fields = ['patient', 'blurred_image', 'grid_image', 'restored_image', 'enhanced', 
                       'created_at', 'updated_at', 'original_entropy', 'encrypted_entropy',
-                      'encryption_time', 'decryption_time', 'blurred_preview', 'grid_preview', 
-                      'fingerprint_encryption_info', 'similarity_metrics']
+                      'encryption_time', 'decryption_time', 'decryption_percentiles', 'blurred_preview',
+                      'grid_preview', 'fingerprint_encryption_info', 'similarity_metrics']
     inlines = [CroppedRegionInline]
     
     def has_add_permission(self, request):
@@ -93,6 +100,17 @@ class ProcessedImageAdmin(admin.ModelAdmin):
         return "No image"
     image_previews.short_description = 'Image Overview'
     
+    def decryption_percentiles(self, obj):
+        """Decryption latency percentiles seen by this worker since it started"""
+        summary = decryption_timings.percentiles(obj.id)
+        if not summary['count']:
+            return "No decryptions recorded by this worker"
+        return format_html(
+            'p50 {:.2f} ms, p90 {:.2f} ms, p99 {:.2f} ms (max {:.2f} ms over {} decryptions)',
+            summary['p50_ms'], summary['p90_ms'], summary['p99_ms'], summary['max_ms'], summary['count']
+        )
+    decryption_percentiles.short_description = 'Decryption Latency'
+    
     def blurred_preview(self, obj):
         if obj.blurred_image:
             return format_html('<img src="{}" width="500" height="auto" />', obj.blurred_image.url)
@@ -111,7 +129,8 @@ class ProcessedImageAdmin(admin.ModelAdmin):
             # Get fingerprint if available
             has_fingerprint = hasattr(obj, 'fingerprint')
             
-            # Get encryption data from regions
+            # Get encryption data from regions: sizes and stored headers only,
+            # the ciphertext stays deferred
             regions = obj.cropped_regions.all()
             num_regions = regions.count()
             encrypted_samples = []
@@ -119,12 +138,13 @@ class ProcessedImageAdmin(admin.ModelAdmin):
             # Collect sample encryption data (up to 2 regions)
             if num_regions > 0:
                 for region in regions[:2]:
-                    if region.cropped_image_data:
+                    preview = region.payload_preview(48)
+                    if preview:
                         import binascii
-                        data_len = len(region.cropped_image_data)
+                        data_len = region.payload_size or len(preview)
                         # Get first 16 bytes (IV) and sample of the actual encrypted data
-                        iv_hex = binascii.hexlify(region.cropped_image_data[:16]).decode('ascii')
-                        sample_hex = binascii.hexlify(region.cropped_image_data[16:48]).decode('ascii')
+                        iv_hex = binascii.hexlify(preview[:16]).decode('ascii')
+                        sample_hex = binascii.hexlify(preview[16:48]).decode('ascii')
                         encrypted_samples.append({
                             'class': region.class_name,
                             'size': data_len,
@@ -232,12 +252,11 @@ class ProcessedImageAdmin(admin.ModelAdmin):
                     
                     # Process up to 2 regions to show encryption
                     for region in regions[:2]:
-                        if region.cropped_image_data:
+                        encrypted_bytes = region.payload_preview(48)
+                        if encrypted_bytes:
                             # Extract some actual bytes to create a realistic visualization
                             import binascii
                             
-                            # Get encrypted data for visualization
-                            encrypted_bytes = region.cropped_image_data
                             byte_sample = encrypted_bytes[16:48]  # Skip IV, get sample of actual encrypted data
                             hex_bytes = binascii.hexlify(byte_sample).decode('ascii')
                             
@@ -270,8 +289,8 @@ class ProcessedImageAdmin(admin.ModelAdmin):
                             if decrypted_data:
                                 # Convert bytes to base64 for display
                                 import base64
-                                b64_img = base64.b64encode(decrypted_data).decode('utf-8')
-                                img_format = region.image_format.lower() if region.image_format else 'jpeg'
+                                image_data, img_format = region_payload_as_image_file(decrypted_data, region.image_format)
+                                b64_img = base64.b64encode(image_data).decode('utf-8')
                                 img_src = f"data:image/{img_format};base64,{b64_img}"
                                 html += f"""
                                                     <img src="{img_src}" style="max-width: 100%; max-height: 100%; object-fit: contain;" />
@@ -525,7 +544,10 @@ class ProcessedImageAdmin(admin.ModelAdmin):
                     if not user:
                         logger.warning("No user available for decryption in admin panel")
                     
-                    restored_img, _, similarity_data = restore_from_cropped(obj.id, enhance=False, user=user)
+                    restored_img, _, similarity_data = restore_from_cropped(
+                        obj.id, enhance=False, user=user, cache_policy=CachePolicy.BYPASS,
+                        compute_similarity=True
+                    )
                     
                     # Post-restoration metrics
                     similarity = similarity_data.get("similarity", 0)
@@ -706,27 +728,12 @@ class ProcessedImageAdmin(admin.ModelAdmin):
     @admin.action(description="Clear image cache and force recalculation")
     def clear_image_cache(self, request, queryset):
         for processed_image in queryset:
-            # Clear all cache entries for this image
-            cache_keys = [
-                f"restored_image:{processed_image.id}:exact",
-                f"decrypted_region_{processed_image.id}"
-            ]
-            
-            # Clear for variations of the key (with timestamps)
-            for i in range(300):  # Check a range of potential cache keys
-                cache_keys.append(f"restored_image:{processed_image.id}:exact:{i}")
+            # A single version bump invalidates every cached restoration
+            bump_image_version(processed_image.id)
             
-            for key in cache_keys:
-                cache.delete(key)
-                
-            # Clear region caches
+            # Drop decrypted regions from the model's in-process LRU
             for region in processed_image.cropped_regions.all():
-                cache_key = f"decrypted_region_{region.id}"
-                cache.delete(cache_key)
-                
-                # Also clear from the model's private cache
-                if hasattr(region, '_decrypted_cache') and cache_key in region._decrypted_cache:
-                    del region._decrypted_cache[cache_key]
+                CroppedRegion.invalidate_decrypted_cache(region.id)
         
         # Removed success message
 
@@ -822,15 +829,10 @@ class ProcessedImageAdmin(admin.ModelAdmin):
         from django.core.cache import cache
         from django.contrib.auth import get_user_model
         
-        # Get encryption key status
+        # Get encryption key status: user ids only, and one cache round trip
         User = get_user_model()
-        users = User.objects.all()
-        users_with_keys = 0
-        
-        for user in users:
-            cache_key = f"encryption_key_{user.id}"
-            if cache.get(cache_key):
-                users_with_keys += 1
+        cache_keys = [f"encryption_key_{user_id}" for user_id in User.objects.values_list('id', flat=True)]
+        users_with_keys = len(cache.get_many(cache_keys))
         
         # Check for file-based keys
         file_keys = load_encryption_keys_from_file()
@@ -850,18 +852,30 @@ class PatientAdmin(admin.ModelAdmin):
 @admin.register(CroppedRegion)
 class CroppedRegionAdmin(admin.ModelAdmin):
     list_display = ['processed_image', 'class_name', 'confidence', 'coordinates', 'encryption_status']
+    # __str__ of the processed image walks to the patient
+    list_select_related = ['processed_image__patient']
     list_filter = ['class_name', 'processed_image__patient']
     search_fields = ['class_name', 'processed_image__patient__name']
     readonly_fields = ['encrypted_data_preview', 'coordinates', 'encryption_status', 'encryption_details', 'similarity_analysis']
     
+    def get_queryset(self, request):
+        """
+        The default manager already defers the ciphertext; add its size, measured
+        by the database for rows that predate the payload_size column.
+        """
+        return super().get_queryset(request).with_payload_size()
+    
     def coordinates(self, obj):
         return format_html('({}, {}) to ({}, {})', obj.x1, obj.y1, obj.x2, obj.y2)
     coordinates.short_description = 'Coordinates'
     
     def encryption_status(self, obj):
-        if obj.cropped_image_data:
+        payload_size = getattr(obj, 'encrypted_size', None)
+        if payload_size is None:
+            payload_size = obj.payload_size or len(obj.encrypted_payload or b'')
+        if payload_size:
             return format_html('<span style="color: green; font-weight: bold;">✓ Encrypted ({} bytes)</span>', 
-                              len(obj.cropped_image_data))
+                              payload_size)
         return format_html('<span style="color: red;">Not encrypted</span>')
     encryption_status.short_description = 'Encryption Status'
     
@@ -883,9 +897,8 @@ class CroppedRegionAdmin(admin.ModelAdmin):
             from scipy.stats import entropy
             from io import BytesIO
             
-            # Decode image
-            img_array = np.frombuffer(decrypted_data, dtype=np.uint8)
-            img = cv2.imdecode(img_array, cv2.IMREAD_GRAYSCALE)
+            # Decode image (raw pixel payloads need no decode)
+            img = decode_region_payload(decrypted_data, cv2.IMREAD_GRAYSCALE)
             
             if img is None:
                 return format_html(
@@ -943,20 +956,22 @@ class CroppedRegionAdmin(admin.ModelAdmin):
     similarity_analysis.short_description = 'Similarity & Entropy Analysis'
     
     def encryption_details(self, obj):
-        if not obj.cropped_image_data:
+        encrypted_data = obj.payload_preview(48)
+        if not encrypted_data:
             return "No encrypted data"
+        total_size = obj.payload_size or len(obj.encrypted_payload or b'')
         
         # First 16 bytes are the IV
-        iv = obj.cropped_image_data[:16]
+        iv = encrypted_data[:16]
         iv_hex = binascii.hexlify(iv).decode('ascii')
         formatted_iv = ' '.join([iv_hex[i:i+2] for i in range(0, len(iv_hex), 2)])
         
         # Following bytes are the encrypted data
-        data_len = len(obj.cropped_image_data) - 16
+        data_len = total_size - 16
         
         # Display sample of encrypted data (first 32 bytes after IV)
         sample_size = min(32, data_len)
-        sample = obj.cropped_image_data[16:16+sample_size]
+        sample = encrypted_data[16:16+sample_size]
         sample_hex = binascii.hexlify(sample).decode('ascii')
         formatted_sample = ' '.join([sample_hex[i:i+2] for i in range(0, len(sample_hex), 2)])
         
@@ -971,20 +986,21 @@ class CroppedRegionAdmin(admin.ModelAdmin):
             '<p>Encrypted data sample ({} bytes of {} total):</p>'
             '<p style="color: #cc6600;">{} ...</p>'
             '</div>',
-            obj.original_filename, obj.image_format, len(obj.cropped_image_data),
+            obj.original_filename, obj.image_format, total_size,
             formatted_iv, sample_size, data_len, formatted_sample
         )
     encryption_details.short_description = 'Encryption Details'
     
     def encrypted_data_preview(self, obj):
-        if not obj.cropped_image_data:
+        preview = obj.payload_preview(64)
+        if not preview:
             return "No encrypted data"
         
         # Show encrypted data visualization
-        data_len = len(obj.cropped_image_data)
+        data_len = obj.payload_size or len(preview)
         # Get first 64 bytes for preview (including IV)
         preview_size = min(64, data_len)
-        preview_hex = binascii.hexlify(obj.cropped_image_data[:preview_size]).decode('ascii')
+        preview_hex = binascii.hexlify(preview[:preview_size]).decode('ascii')
         
         # Format in blocks of 16 bytes (32 hex chars) for readability
         formatted_blocks = []
@@ -1012,6 +1028,7 @@ class CroppedRegionAdmin(admin.ModelAdmin):
 @admin.register(ImageFingerprint)
 class ImageFingerprintAdmin(admin.ModelAdmin):
     list_display = ['processed_image', 'created_at', 'hash_preview']
+    list_select_related = ['processed_image__patient']
     list_filter = ['created_at']
     readonly_fields = ['processed_image', 'avg_hash', 'phash', 'color_histogram', 'created_at']
     
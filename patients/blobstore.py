@@ -0,0 +1,125 @@
+"""
+Content-addressed on-disk store for encrypted region payloads.
+
+Blobs are named by the SHA-256 of the ciphertext and sharded two levels deep
+(``ab/cd/abcd...``), so identical payloads are stored once and no directory
+grows too large. Rows keep only the reference and the size. Small blobs are
+read with a single readinto() into a buffer of the right size; large ones are
+memory-mapped and handed out as a read-only memoryview without any copy.
+
+The store is enabled by setting REGION_BLOB_STORE_DIR; without it payloads
+stay inline in CroppedRegion.cropped_image_data.
+"""
+import hashlib
+import logging
+import mmap
+import os
+import uuid
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Blobs at least this large are memory-mapped instead of read into memory
+DEFAULT_MMAP_THRESHOLD = 256 * 1024
+
+
+def blob_store_dir():
+    """Root directory of the blob store, or None if the store is disabled"""
+    return getattr(settings, 'REGION_BLOB_STORE_DIR', None) or None
+
+
+def blob_store_enabled():
+    return blob_store_dir() is not None
+
+
+def blob_ref(data):
+    """Reference (hex SHA-256) under which a payload is stored"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def blob_path(ref, root=None):
+    """Sharded path of a blob: <root>/ab/cd/abcd..."""
+    root = root or blob_store_dir()
+    if root is None:
+        raise RuntimeError("REGION_BLOB_STORE_DIR is not configured")
+    return os.path.join(root, ref[:2], ref[2:4], ref)
+
+
+def put_blob(data):
+    """
+    Store a payload and return its reference.
+
+    Identical payloads map to the same file, which is only written once. The
+    file is written under a temporary name, flushed to disk and renamed, so
+    readers never see a partial blob.
+
+    Args:
+        data: Encrypted payload (bytes-like)
+
+    Returns:
+        str: The blob reference
+    """
+    ref = blob_ref(data)
+    path = blob_path(ref)
+    if os.path.exists(path):
+        return ref
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return ref
+
+
+def read_blob(ref):
+    """
+    Read a payload from the store.
+
+    Args:
+        ref: Blob reference returned by put_blob
+
+    Returns:
+        bytearray for small blobs, or a read-only memoryview over a memory-mapped
+        file for blobs of at least REGION_BLOB_MMAP_THRESHOLD bytes. Both support
+        len(), slicing and the buffer protocol.
+
+    Raises:
+        FileNotFoundError: if the blob does not exist
+    """
+    threshold = getattr(settings, 'REGION_BLOB_MMAP_THRESHOLD', DEFAULT_MMAP_THRESHOLD)
+    with open(blob_path(ref), 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return bytearray()
+        if size >= threshold:
+            # The mapping outlives the file object and is released with the view
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        read = 0
+        while read < size:
+            count = f.readinto(view[read:])
+            if not count:
+                raise OSError(f"Blob {ref} was truncated while reading")
+            read += count
+        return buffer
+
+
+def delete_blob(ref):
+    """Remove a blob; returns False if it did not exist"""
+    try:
+        os.remove(blob_path(ref))
+        return True
+    except FileNotFoundError:
+        return False
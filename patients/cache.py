@@ -0,0 +1,481 @@
+"""
+Caching helpers for the image restore path.
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+# Restored images only change when their ProcessedImage, regions or fingerprint
+# change, so cached results live for an hour and are invalidated by version bumps
+RESTORED_IMAGE_TIMEOUT = 60 * 60
+
+# Byte budget of the raw pixel files when RAW_PIXEL_CACHE_MAX_BYTES is not set
+DEFAULT_RAW_PIXEL_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+
+class CachePolicy:
+    """
+    How a restore call should interact with the restored-image cache.
+
+    USE:       read cached results and store new ones (default)
+    BYPASS:    ignore the cache entirely, e.g. for admin diagnostics
+    REFRESH:   always recompute and overwrite the cached result
+    READ_ONLY: serve cached results but never store new ones
+    """
+    USE = 'use'
+    BYPASS = 'bypass'
+    REFRESH = 'refresh'
+    READ_ONLY = 'read_only'
+
+    @classmethod
+    def reads(cls, policy):
+        return policy in (cls.USE, cls.READ_ONLY)
+
+    @classmethod
+    def writes(cls, policy):
+        return policy in (cls.USE, cls.REFRESH)
+
+
+class ByteLRUCache:
+    """
+    Thread-safe LRU cache bounded by the total size of its values.
+
+    Every entry also carries a TTL, after which it is treated as a miss.
+    Hit, miss and eviction counters are kept so the cache can be monitored.
+
+    Args:
+        max_bytes: Maximum combined size of all cached values
+        ttl: Lifetime of an entry in seconds (None for no expiry)
+        sizeof: Function returning the size of a value in bytes (defaults to len)
+    """
+
+    def __init__(self, max_bytes, ttl=None, sizeof=len):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._sizeof = sizeof
+        self._entries = OrderedDict()  # key -> (value, size, expires_at)
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """Return the cached value and mark it as most recently used"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, size, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Store a value, evicting least recently used entries to stay within budget.
+
+        Returns:
+            bool: False if the value alone is larger than the byte budget
+        """
+        size = self._sizeof(value)
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if size > self.max_bytes:
+                return False
+            while self._entries and self._total_bytes + size > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+            self._entries[key] = (value, size, expires_at)
+            self._total_bytes += size
+            return True
+
+    def invalidate(self, key):
+        """Drop a single entry; returns True if it was cached"""
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+                return True
+            return False
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def stats(self):
+        """Return a snapshot of the cache counters"""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and (entry[2] is None or entry[2] > time.monotonic())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._total_bytes -= size
+
+
+class _InFlightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent computations of the same key.
+
+    Within a process, callers that arrive while a computation for their key is
+    running wait for it and share its result (or exception). Across workers,
+    the computing process holds a lock in the shared cache and the other
+    workers wait for it to be released. Restored images are plaintext and never
+    leave process memory, so waiting workers then re-read their own cache and
+    compute on a miss: a stampede restores an image once per worker, one
+    worker at a time, instead of all at once.
+
+    Args:
+        lock_timeout: Seconds after which a cross-worker lock is considered abandoned
+        wait_timeout: Maximum seconds to wait for another caller before computing anyway
+        poll_interval: Seconds between checks of the cross-worker lock
+    """
+
+    def __init__(self, lock_timeout=60, wait_timeout=30, poll_interval=0.05):
+        self.lock_timeout = lock_timeout
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, compute, reread=None):
+        """
+        Run compute() once for all concurrent callers of the same key.
+
+        Args:
+            key: Identity of the computation (should include the image version)
+            compute: Zero-argument callable producing the result
+            reread: Zero-argument callable returning this process's cached result
+                    or None; enables the cross-worker lock when given
+
+        Returns:
+            The computed (or shared) result
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _InFlightCall()
+                self._calls[key] = call
+
+        if not leader:
+            if call.done.wait(self.wait_timeout):
+                if call.error is not None:
+                    raise call.error
+                return call.result
+            # The leader is taking too long; don't block the request forever
+            return compute()
+
+        try:
+            call.result = self._run_across_workers(key, compute, reread)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+    def _run_across_workers(self, key, compute, reread):
+        if reread is None:
+            return compute()
+
+        # The lock only holds a random token, never the result
+        lock_key = f"singleflight:{key}"
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.wait_timeout
+        while not cache.add(lock_key, token, timeout=self.lock_timeout):
+            if time.monotonic() >= deadline:
+                # The lock holder is taking too long; compute without the lock
+                return compute()
+            time.sleep(self.poll_interval)
+
+        try:
+            # This process may have cached the result while we waited
+            result = reread()
+            return result if result is not None else compute()
+        finally:
+            if cache.get(lock_key) == token:
+                cache.delete(lock_key)
+
+
+def _restored_result_size(value):
+    """Bytes held by a cached restore result"""
+    if isinstance(value, tuple):
+        # (restored pixels, filename, similarity data)
+        return value[0].nbytes
+    if 'regions' in value:
+        return sum(len(region['data']) for region in value['regions'])
+    return len(value['data'])
+
+
+# Shared by all restore requests served by this process
+restore_single_flight = SingleFlight()
+
+# Restored pixels, encoded restored images and tiles, and decrypted region
+# payloads are plaintext, so they are cached per process and never written to
+# the shared cache, which is a file on disk
+restored_cache = ByteLRUCache(
+    max_bytes=getattr(settings, 'RESTORED_IMAGE_CACHE_BYTES', 256 * 1024 * 1024),
+    ttl=RESTORED_IMAGE_TIMEOUT,
+    sizeof=_restored_result_size,
+)
+
+
+def _image_version_key(processed_image_id):
+    return f"image_version:{processed_image_id}"
+
+
+def get_image_version(processed_image_id):
+    """
+    Return the current version stamp of a processed image.
+
+    The stamp is a random token stored in the shared cache. Every cache key
+    derived from the image embeds it, so bumping the stamp invalidates all of
+    them at once. A stamp lost to eviction is replaced by a fresh one, which
+    can only cause misses, never stale hits.
+
+    Args:
+        processed_image_id: ID of the ProcessedImage
+
+    Returns:
+        str: The version stamp
+    """
+    key = _image_version_key(processed_image_id)
+    version = cache.get(key)
+    if version is None:
+        # add() so concurrent workers agree on a single stamp
+        cache.add(key, uuid.uuid4().hex[:12], timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def bump_image_version(processed_image_id):
+    """Invalidate every cached artefact of a processed image"""
+    version = uuid.uuid4().hex[:12]
+    cache.set(_image_version_key(processed_image_id), version, timeout=None)
+    return version
+
+
+def restored_image_cache_key(processed_image_id, version=None):
+    """Cache key of the restored image for the given (or current) version"""
+    if version is None:
+        version = get_image_version(processed_image_id)
+    return f"restored_image:{processed_image_id}:{version}"
+
+
+def encoded_image_cache_key(processed_image_id, img_format, quality, version):
+    """Cache key of the encoded restored image for one (format, quality) variant"""
+    return f"encoded_image:{processed_image_id}:{version}:{img_format}:{quality}"
+
+
+def restored_image_etag(processed_image_id, img_format, quality, version=None):
+    """
+    Strong ETag of an encoded restored image.
+
+    Derived only from the image version and encoder settings, so it can be
+    compared against If-None-Match without loading the cached payload.
+    """
+    if version is None:
+        version = get_image_version(processed_image_id)
+    digest = hashlib.sha1(f"{processed_image_id}:{version}:{img_format}:{quality}".encode()).hexdigest()
+    return f'"{digest[:24]}"'
+
+
+def deepzoom_tile_cache_key(processed_image_id, version, level, col, row, img_format):
+    """Cache key of one encoded Deep Zoom tile"""
+    return f"deepzoom_tile:{processed_image_id}:{version}:{level}:{col}_{row}:{img_format}"
+
+
+def deepzoom_tile_etag(processed_image_id, version, level, col, row, img_format):
+    """Strong ETag of an encoded Deep Zoom tile"""
+    digest = hashlib.sha1(f"{processed_image_id}:{version}:{level}:{col}_{row}:{img_format}".encode()).hexdigest()
+    return f'"{digest[:24]}"'
+
+
+def region_payloads_cache_key(processed_image_id, version):
+    """Cache key of the encoded region payloads used for client-side compositing"""
+    return f"region_payloads:{processed_image_id}:{version}"
+
+
+def similarity_cache_key(processed_image_id, version):
+    """Cache key of the persisted similarity metrics of one image version"""
+    return f"similarity:{processed_image_id}:{version}"
+
+
+def _raw_pixel_path(image_path):
+    """
+    Location of the raw-pixel copy of an image file, or None if disabled.
+
+    The name embeds the source file's size and mtime, so a replaced blurred
+    image never maps onto a stale copy.
+    """
+    cache_dir = getattr(settings, 'RAW_PIXEL_CACHE_DIR', None)
+    if not cache_dir:
+        return None
+    stat = os.stat(image_path)
+    digest = hashlib.sha1(f"{os.path.abspath(image_path)}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()
+    return os.path.join(cache_dir, f"{digest[:24]}.npy")
+
+
+def load_image_pixels(image_path, writable=False):
+    """
+    Load the pixels of an image file, memory-mapping a cached raw copy when possible.
+
+    The first call decodes the file with cv2.imread(IMREAD_UNCHANGED) and writes
+    the pixels as .npy next to the other raw copies. Later calls map that file
+    instead of decoding. Read-only arrays share the page cache; writable arrays
+    are copy-on-write, so only the pages that are modified get copied. Each hit
+    refreshes the copy's mtime, and new copies evict the least recently used
+    ones beyond RAW_PIXEL_CACHE_MAX_BYTES (see prune_raw_pixel_cache).
+
+    Args:
+        image_path: Path of the JPEG/PNG file
+        writable: Return an array that can be modified without touching the file
+
+    Returns:
+        numpy.ndarray or None if the image could not be read
+    """
+    try:
+        raw_path = _raw_pixel_path(image_path)
+    except OSError:
+        return None
+
+    if raw_path is not None and os.path.exists(raw_path):
+        try:
+            # asarray drops the memmap subclass but keeps the mapping as the buffer
+            pixels = np.asarray(np.load(raw_path, mmap_mode='c' if writable else 'r'))
+            # The mtime orders copies for eviction; a pruned copy stays mapped
+            os.utime(raw_path)
+            return pixels
+        except FileNotFoundError:
+            # Evicted by another worker between the check and the load
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"Discarding unreadable raw pixel cache {raw_path}: {str(e)}")
+            _remove_quietly(raw_path)
+
+    img = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
+    if img is None or raw_path is None:
+        return img
+
+    # Write to a temporary name so concurrent readers never map a partial file
+    tmp_path = f"{raw_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.makedirs(os.path.dirname(raw_path), exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            np.save(f, img)
+        os.replace(tmp_path, raw_path)
+    except OSError as e:
+        logger.warning(f"Could not write raw pixel cache {raw_path}: {str(e)}")
+        _remove_quietly(tmp_path)
+    else:
+        prune_raw_pixel_cache()
+
+    # The freshly decoded array is already private to the caller
+    return img
+
+
+def prune_raw_pixel_cache(max_bytes=None):
+    """
+    Remove the least recently used raw-pixel copies until they fit the byte budget.
+
+    Files mapped by a running restore stay readable after removal; they are
+    only freed once unmapped.
+
+    Args:
+        max_bytes: Budget in bytes (defaults to RAW_PIXEL_CACHE_MAX_BYTES)
+
+    Returns:
+        int: Number of files removed
+    """
+    cache_dir = getattr(settings, 'RAW_PIXEL_CACHE_DIR', None)
+    if not cache_dir:
+        return 0
+    if max_bytes is None:
+        max_bytes = getattr(settings, 'RAW_PIXEL_CACHE_MAX_BYTES', DEFAULT_RAW_PIXEL_CACHE_MAX_BYTES)
+
+    files = []
+    total_bytes = 0
+    try:
+        with os.scandir(cache_dir) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.npy'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                files.append((stat.st_mtime_ns, stat.st_size, entry.path))
+                total_bytes += stat.st_size
+    except OSError:
+        return 0
+
+    removed = 0
+    for _, size, path in sorted(files):
+        if total_bytes <= max_bytes:
+            break
+        _remove_quietly(path)
+        total_bytes -= size
+        removed += 1
+    return removed
+
+
+def discard_image_pixels(image_path):
+    """Remove the raw-pixel copy of an image file, if any"""
+    try:
+        raw_path = _raw_pixel_path(image_path)
+    except OSError:
+        return
+    if raw_path is not None:
+        _remove_quietly(raw_path)
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
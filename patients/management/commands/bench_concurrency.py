@@ -0,0 +1,294 @@
+import json
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connections, transaction
+
+from patients.models import CroppedRegion, Patient, ProcessedImage
+
+BENCH_ALIAS = 'concurrency_bench'
+
+# Scratch SQLite profiles: Django's defaults (rollback journal, deferred
+# transactions, 5s busy timeout) against the tuned profile from settings
+SQLITE_PROFILES = {
+    'default': {'timeout': 5},
+    'tuned': None,  # settings.SQLITE_OPTIONS
+}
+
+
+def percentile(sorted_samples, p):
+    if not sorted_samples:
+        return None
+    rank = max(1, -(-len(sorted_samples) * p // 100))
+    return sorted_samples[min(rank, len(sorted_samples)) - 1]
+
+
+def run_worker(args):
+    """
+    Run reads or writes in a loop for one phase.
+
+    Module level so it can run in a forked pool process as well as in a thread.
+
+    Returns:
+        Tuple of (latencies in ms of the successful operations, number of failed operations)
+    """
+    kind, index, alias, patient_ids, seed, start_at, duration, payload_bytes = args
+    rng = random.Random(seed * 1000 + index + (500 if kind == 'write' else 0))
+    payload = os.urandom(payload_bytes)
+    samples, errors = [], 0
+
+    time.sleep(max(0.0, start_at - time.time()))
+    deadline = start_at + duration
+    try:
+        while time.time() < deadline:
+            start = time.perf_counter()
+            try:
+                if kind == 'read':
+                    # The doctor views: a patient, its latest image and that image's regions
+                    patient = Patient.objects.using(alias).get(id=rng.choice(patient_ids))
+                    image = (ProcessedImage.objects.using(alias).filter(patient=patient)
+                             .order_by('-created_at', '-id').first())
+                    list(CroppedRegion.objects.using(alias).filter(processed_image=image))
+                else:
+                    # Same shape as persisting an upload: one image and its regions in one transaction
+                    with transaction.atomic(using=alias):
+                        image = ProcessedImage.objects.using(alias).create(
+                            patient_id=rng.choice(patient_ids), blurred_image='blurred.png', grid_image='grid.png')
+                        CroppedRegion.objects.using(alias).bulk_create([
+                            CroppedRegion(processed_image=image, class_name='face', confidence=0.8, x1=0, y1=0,
+                                          x2=100, y2=100, cropped_image_data=payload, payload_size=len(payload),
+                                          payload_header=payload[:64], original_filename='crop.png',
+                                          image_format='RAW')
+                            for _ in range(2)
+                        ])
+            except OperationalError:
+                # "database is locked" once the busy timeout has run out
+                errors += 1
+                continue
+            samples.append((time.perf_counter() - start) * 1000)
+    finally:
+        connections[alias].close()
+    return samples, errors
+
+
+class Command(BaseCommand):
+    help = ('Measures read latency and throughput with and without concurrent upload-style writes, '
+            'to check that readers and writers do not serialise')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--readers',
+            type=int,
+            default=4,
+            help='Number of reader threads',
+        )
+
+        parser.add_argument(
+            '--writers',
+            type=int,
+            default=2,
+            help='Number of writer threads in the mixed phase',
+        )
+
+        parser.add_argument(
+            '--duration',
+            type=float,
+            default=5.0,
+            help='Seconds per phase',
+        )
+
+        parser.add_argument(
+            '--patients',
+            type=int,
+            default=2000,
+            help='Synthetic patients seeded before measuring (three images each)',
+        )
+
+        parser.add_argument(
+            '--payload-bytes',
+            type=int,
+            default=64 * 1024,
+            help='Inline ciphertext written per region by the writers',
+        )
+
+        parser.add_argument(
+            '--mode',
+            choices=['processes', 'threads'],
+            default='processes' if 'fork' in multiprocessing.get_all_start_methods() else 'threads',
+            help='Run the workers as forked processes (like gunicorn workers) or as threads in this process',
+        )
+
+        parser.add_argument(
+            '--database',
+            type=str,
+            default=None,
+            help='Existing database alias to measure (e.g. a local PostgreSQL); its seeded rows are removed '
+                 'afterwards. Without it, scratch SQLite files with the default and the tuned profile are compared',
+        )
+
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='Random seed for the synthetic data and the query parameters',
+        )
+
+        parser.add_argument(
+            '--json',
+            type=str,
+            default=None,
+            help='Also write the results to this JSON file',
+        )
+
+    def handle(self, *args, **options):
+        if options['readers'] < 1 or options['writers'] < 1:
+            raise CommandError('--readers and --writers must be at least 1')
+
+        results = {}
+        if options['database']:
+            alias = options['database']
+            if alias not in connections.databases:
+                raise CommandError(f'Unknown database alias {alias}')
+            results[alias] = self.run_profile(alias, options, cleanup=True)
+        else:
+            for name, profile_options in SQLITE_PROFILES.items():
+                profile_options = settings.SQLITE_OPTIONS if profile_options is None else profile_options
+                results[f'sqlite_{name}'] = self.run_scratch_sqlite(f'{BENCH_ALIAS}_{name}', profile_options, options)
+
+        self.report(results)
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['json']}"))
+
+    def run_scratch_sqlite(self, alias, sqlite_options, options):
+        fd, path = tempfile.mkstemp(suffix='.sqlite3', prefix='concurrency_bench_')
+        os.close(fd)
+        connections.databases[alias] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': path,
+            'OPTIONS': dict(sqlite_options),
+            'CONN_MAX_AGE': 0,
+            'CONN_HEALTH_CHECKS': False,
+            'ATOMIC_REQUESTS': False,
+            'AUTOCOMMIT': True,
+            'TIME_ZONE': None,
+            'USER': '',
+            'PASSWORD': '',
+            'HOST': '',
+            'PORT': '',
+            'TEST': {},
+        }
+        try:
+            call_command('migrate', database=alias, verbosity=0)
+            return self.run_profile(alias, options, cleanup=False)
+        finally:
+            connections[alias].close()
+            # Drop the cached wrapper too, it still points at the removed file
+            del connections[alias]
+            del connections.databases[alias]
+            for suffix in ('', '-wal', '-shm', '-journal'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+    def run_profile(self, alias, options, cleanup):
+        self.stdout.write(f"Measuring {alias} ({options['duration']:.0f}s per phase)...")
+        prefix = f"CONC{options['seed']}-{random.Random().getrandbits(32):08x}-"
+        patient_ids = self.seed(alias, prefix, options)
+        try:
+            profile = {
+                'vendor': connections[alias].vendor,
+                'reads_only': self.run_phase(alias, patient_ids, options, writers=0),
+                'mixed': self.run_phase(alias, patient_ids, options, writers=options['writers']),
+            }
+        finally:
+            if cleanup:
+                # Cascades to the images and regions created by the writers as well
+                Patient.objects.using(alias).filter(id__startswith=prefix).delete()
+        return profile
+
+    def seed(self, alias, prefix, options):
+        patients = [Patient(id=f'{prefix}{p:06d}', name=f'Synthetic {p}', age=40)
+                    for p in range(options['patients'])]
+        with transaction.atomic(using=alias):
+            Patient.objects.using(alias).bulk_create(patients, batch_size=500)
+            images = ProcessedImage.objects.using(alias).bulk_create(
+                [ProcessedImage(patient=patient, blurred_image='blurred.png', grid_image='grid.png')
+                 for patient in patients for _ in range(3)],
+                batch_size=500,
+            )
+            payload = os.urandom(256)
+            CroppedRegion.objects.using(alias).bulk_create(
+                [CroppedRegion(processed_image=image, class_name='name_tag', confidence=0.9, x1=0, y1=0,
+                               x2=100, y2=100, cropped_image_data=payload, payload_size=len(payload),
+                               payload_header=payload[:64], original_filename='crop.png', image_format='RAW')
+                 for image in images for _ in range(2)],
+                batch_size=500,
+            )
+        return [patient.id for patient in patients]
+
+    def run_phase(self, alias, patient_ids, options, writers):
+        tasks = [('read', i) for i in range(options['readers'])] + [('write', i) for i in range(writers)]
+        # Give the workers time to start so they all begin measuring together
+        start_at = time.time() + 1.0
+        args = [(kind, i, alias, patient_ids, options['seed'], start_at, options['duration'],
+                 options['payload_bytes']) for kind, i in tasks]
+
+        if options['mode'] == 'processes':
+            # Like gunicorn workers: separate processes with their own connections.
+            # Connections must not be shared across the fork.
+            connections.close_all()
+            with multiprocessing.get_context('fork').Pool(len(tasks)) as pool:
+                outcomes = pool.map(run_worker, args, chunksize=1)
+        else:
+            with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
+                outcomes = list(executor.map(run_worker, args))
+
+        phase = {}
+        for kind in ('read', 'write'):
+            if kind == 'write' and not writers:
+                continue
+            timings = sorted(ms for (task_kind, _), (samples, _) in zip(tasks, outcomes)
+                             if task_kind == kind for ms in samples)
+            phase[kind] = {
+                'ops': len(timings),
+                'ops_per_s': len(timings) / options['duration'],
+                'errors': sum(errors for (task_kind, _), (_, errors) in zip(tasks, outcomes) if task_kind == kind),
+                'p50_ms': percentile(timings, 50),
+                'p95_ms': percentile(timings, 95),
+                'p99_ms': percentile(timings, 99),
+                'max_ms': timings[-1] if timings else None,
+            }
+        return phase
+
+    def report(self, results):
+        def fmt(value):
+            return f'{value:>8.2f}ms' if value is not None else f"{'-':>10}"
+
+        self.stdout.write('')
+        self.stdout.write(f"{'Profile / phase':<28} | {'Op':<5} | {'ops/s':>8} | {'errors':>6} | "
+                          f"{'p50':>10} | {'p95':>10} | {'p99':>10}")
+        self.stdout.write('-' * 96)
+        for profile_name, profile in results.items():
+            for phase_name in ('reads_only', 'mixed'):
+                for kind, stats in profile[phase_name].items():
+                    self.stdout.write(
+                        f"{profile_name + ' / ' + phase_name:<28} | {kind:<5} | {stats['ops_per_s']:>8.1f} | "
+                        f"{stats['errors']:>6} | {fmt(stats['p50_ms'])} | {fmt(stats['p95_ms'])} | "
+                        f"{fmt(stats['p99_ms'])}"
+                    )
+
+        self.stdout.write('')
+        for profile_name, profile in results.items():
+            alone, mixed = profile['reads_only']['read'], profile['mixed']['read']
+            if alone['p95_ms'] and mixed['p95_ms']:
+                self.stdout.write(f"{profile_name}: read p95 under writes is {mixed['p95_ms'] / alone['p95_ms']:.1f}x "
+                                  f"the read-only p95, {mixed['errors'] + profile['mixed']['write']['errors']} "
+                                  f"operations failed")
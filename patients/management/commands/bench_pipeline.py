@@ -0,0 +1,481 @@
+import contextlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+import cv2
+import numpy as np
+import torch
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from patients.cache import load_image_pixels
+from patients.encoders import encode_image
+from patients.models import CroppedRegion, Patient, ProcessedImage
+from patients.synthetic import random_boxes, synthetic_scan
+from patients.utils import (
+    _persist_processed_image,
+    calculate_restoration_similarity,
+    create_image_fingerprint,
+    create_output_grid,
+    decode_region_payload,
+    decrypt_image,
+    encrypt_image,
+    get_model,
+    measure_original_entropy,
+    obscure_region,
+    pack_raw_pixels,
+)
+
+PROCESS_STAGES = ['decode', 'fingerprint', 'analytics', 'inference', 'blur', 'grid', 'encrypt', 'persist']
+RESTORE_STAGES = ['fetch', 'decrypt', 'decode', 'composite', 'similarity', 'encode']
+
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(sorted_samples, p):
+    """Nearest-rank percentile of an already sorted list"""
+    rank = max(1, int(np.ceil(len(sorted_samples) * p / 100.0)))
+    return sorted_samples[min(rank, len(sorted_samples)) - 1]
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    summary = {'count': len(samples), 'mean_ms': sum(samples) / len(samples)}
+    for p in PERCENTILES:
+        summary[f'p{p}_ms'] = percentile(samples, p)
+    return summary
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far"""
+    try:
+        import resource
+    except ImportError:
+        # No getrusage on Windows; the current RSS is the best available bound
+        import psutil
+        return psutil.Process().memory_info().rss / (1024 * 1024)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+class Command(BaseCommand):
+    help = ('Times every stage of process_image and restore_from_cropped on a fixed synthetic corpus '
+            'and optionally compares the results with a saved baseline')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--images',
+            type=int,
+            default=8,
+            help='Number of images in the synthetic corpus',
+        )
+
+        parser.add_argument(
+            '--width',
+            type=int,
+            default=1024,
+            help='Width of the synthetic scans in pixels',
+        )
+
+        parser.add_argument(
+            '--height',
+            type=int,
+            default=768,
+            help='Height of the synthetic scans in pixels',
+        )
+
+        parser.add_argument(
+            '--regions-per-image',
+            type=int,
+            default=2,
+            help='Sensitive regions per image',
+        )
+
+        parser.add_argument(
+            '--region-size',
+            type=int,
+            default=160,
+            help='Edge length of the sensitive regions in pixels',
+        )
+
+        parser.add_argument(
+            '--warmup',
+            type=int,
+            default=1,
+            help='Untimed passes over the corpus before measuring',
+        )
+
+        parser.add_argument(
+            '--repetitions',
+            type=int,
+            default=5,
+            help='Timed passes over the corpus',
+        )
+
+        parser.add_argument(
+            '--format',
+            type=str,
+            default='png',
+            help='Output format of the restore encode stage (png, jpeg or webp)',
+        )
+
+        parser.add_argument(
+            '--skip-inference',
+            action='store_true',
+            help='Leave out the model inference stage (it is skipped automatically when no model is installed)',
+        )
+
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='Random seed of the synthetic corpus',
+        )
+
+        parser.add_argument(
+            '--json',
+            type=str,
+            default=None,
+            help='Write the results to this JSON file (usable as a later --baseline)',
+        )
+
+        parser.add_argument(
+            '--baseline',
+            type=str,
+            default=None,
+            help='JSON results of an earlier run to compare against',
+        )
+
+        parser.add_argument(
+            '--metric',
+            choices=[f'p{p}_ms' for p in PERCENTILES] + ['mean_ms'],
+            default='p50_ms',
+            help='Statistic compared against the baseline',
+        )
+
+        parser.add_argument(
+            '--threshold',
+            type=float,
+            default=10.0,
+            help='Slowdown in percent that counts as a regression',
+        )
+
+        parser.add_argument(
+            '--min-delta-ms',
+            type=float,
+            default=0.5,
+            help='Ignore slowdowns smaller than this many milliseconds (timer noise on tiny stages)',
+        )
+
+    def handle(self, *args, **options):
+        for name in ('images', 'width', 'height', 'regions_per_image', 'region_size', 'repetitions'):
+            if options[name] < 1:
+                raise CommandError(f"--{name.replace('_', '-')} must be at least 1")
+        if options['region_size'] > min(options['width'], options['height']):
+            raise CommandError('--region-size must fit inside the scan')
+
+        baseline = None
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+
+        model, skipped = None, {}
+        if options['skip_inference']:
+            skipped['inference'] = 'disabled with --skip-inference'
+        else:
+            try:
+                model = get_model()
+            except Exception as e:
+                skipped['inference'] = str(e)
+
+        corpus = self.build_corpus(options)
+        work_dir = tempfile.mkdtemp(prefix='bench_pipeline_')
+        patient = None
+        try:
+            # Files, raw pixel caches and grids go to a scratch directory; rows are
+            # written to the configured database and removed again afterwards
+            with override_settings(MEDIA_ROOT=os.path.join(work_dir, 'media'),
+                                   RAW_PIXEL_CACHE_DIR=os.path.join(work_dir, 'raw')), \
+                    open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                patient = Patient.objects.create(id=f'BENCH-{uuid.uuid4().hex[:12]}', name='Pipeline Benchmark',
+                                                 age=0, note='Temporary benchmark data')
+                process, image_ids = self.run_process(corpus, patient, model, work_dir, options)
+                process['skipped'] = skipped
+                restore = self.run_restore(image_ids, options)
+
+                # Deleting the patient removes the images, regions, files and blobs
+                patient.delete()
+                patient = None
+        finally:
+            if patient is not None:
+                patient.delete()
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        results = {
+            'config': {name: options[name] for name in (
+                'images', 'width', 'height', 'regions_per_image', 'region_size',
+                'warmup', 'repetitions', 'format', 'seed')},
+            'environment': {
+                'python': sys.version.split()[0],
+                'opencv': cv2.__version__,
+                'numpy': np.__version__,
+                'payload_format': getattr(settings, 'CROP_PAYLOAD_FORMAT', 'RAW').upper(),
+                'blob_store': bool(getattr(settings, 'REGION_BLOB_STORE_DIR', None)),
+            },
+            'pipelines': {'process_image': process, 'restore_from_cropped': restore},
+            'peak_rss_mb': peak_rss_mb(),
+        }
+        self.report(results)
+
+        regressions = []
+        if baseline is not None:
+            results['comparison'] = self.compare(results, baseline, options)
+            self.report_comparison(results['comparison'], options)
+            regressions = [row for row in results['comparison'] if row['regressed']]
+
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Results written to {options['json']}"))
+
+        if regressions:
+            names = ', '.join(f"{row['pipeline']}.{row['stage']}" for row in regressions)
+            raise CommandError(f"{len(regressions)} stages regressed by more than {options['threshold']}%: {names}")
+
+    def build_corpus(self, options):
+        """Encoded synthetic scans with fixed region boxes, identical for the same seed and sizes"""
+        corpus = []
+        for n in range(options['images']):
+            rng = np.random.default_rng([options['seed'], n])
+            scan = synthetic_scan(rng, options['width'], options['height'])
+            success, buffer = cv2.imencode('.png', scan)
+            corpus.append({
+                'name': f'bench_{n}.png',
+                'data': buffer.tobytes(),
+                'boxes': random_boxes(rng, options['width'], options['height'],
+                                      options['regions_per_image'], options['region_size']),
+                'noise_seed': [options['seed'], n, 1],
+            })
+        return corpus
+
+    def passes(self, options):
+        """(pass number, whether it is timed) for the warm-up and measured passes"""
+        for n in range(options['warmup'] + options['repetitions']):
+            yield n, n >= options['warmup']
+
+    def run_process(self, corpus, patient, model, work_dir, options):
+        """
+        Run process_image stage by stage.
+
+        The detection boxes come from the corpus rather than from the model, so
+        every stage after inference does the same work whether or not a model
+        is installed.
+        """
+        stages = {name: [] for name in PROCESS_STAGES if name != 'inference' or model is not None}
+        totals = []
+        image_ids = []
+        payload_format = getattr(settings, 'CROP_PAYLOAD_FORMAT', 'RAW').upper()
+        peak_before = peak_rss_mb()
+
+        for n, timed in self.passes(options):
+            temp_dir = os.path.join(work_dir, f'process_{n}')
+            os.makedirs(temp_dir)
+            for item in corpus:
+                samples = {}
+                start = time.perf_counter()
+
+                with self.stage(samples, 'decode'):
+                    original_img = cv2.imdecode(np.frombuffer(item['data'], dtype=np.uint8), cv2.IMREAD_COLOR)
+
+                with self.stage(samples, 'fingerprint'):
+                    fingerprint_data = create_image_fingerprint(original_img)
+
+                with self.stage(samples, 'analytics'):
+                    original_entropy, _ = measure_original_entropy(original_img, item['data'])
+
+                if model is not None:
+                    with self.stage(samples, 'inference'):
+                        model.predict(source=original_img, conf=0.25, iou=0.45, max_det=10, verbose=False,
+                                      device=0 if torch.cuda.is_available() else 'cpu')
+
+                with self.stage(samples, 'blur'):
+                    rng = np.random.default_rng(item['noise_seed'])
+                    modified = original_img.copy()
+                    cropped_images = []
+                    for box in item['boxes']:
+                        x1, y1, x2, y2 = box['coords']
+                        cropped_images.append({
+                            'image': original_img[y1:y2, x1:x2].copy(),
+                            'label': f"{box['class_name']}: {box['confidence']:.2f}",
+                            **box,
+                        })
+                        modified[y1:y2, x1:x2] = obscure_region(modified[y1:y2, x1:x2], rng=rng)
+                    blurred_path = os.path.join(temp_dir, f"blurred_{item['name']}")
+                    cv2.imwrite(blurred_path, modified)
+
+                with self.stage(samples, 'grid'):
+                    result_img = original_img.copy()
+                    for crop_info in cropped_images:
+                        x1, y1, x2, y2 = crop_info['coords']
+                        cv2.rectangle(result_img, (x1, y1), (x2, y2), (0, 255, 0), 3)
+                    grid_path = create_output_grid(original_img, result_img, modified, cropped_images,
+                                                   item['name'], temp_dir)
+
+                with self.stage(samples, 'encrypt'):
+                    encrypted = []
+                    for crop_info in cropped_images:
+                        if payload_format == 'RAW':
+                            payload = pack_raw_pixels(crop_info['image'],
+                                                      compress_level=getattr(settings, 'CROP_PAYLOAD_ZLIB_LEVEL', 1))
+                        else:
+                            success, buffer = cv2.imencode('.jpg', crop_info['image'])
+                            payload = buffer.tobytes()
+                        encrypted.append(encrypt_image(payload))
+
+                with self.stage(samples, 'persist'):
+                    processed_image = ProcessedImage(patient=patient, original_entropy=original_entropy,
+                                                     encryption_time=sum(ms for _, ms in encrypted) / len(encrypted))
+                    cropped_regions = []
+                    for crop_info, (encrypted_data, _) in zip(cropped_images, encrypted):
+                        x1, y1, x2, y2 = crop_info['coords']
+                        region = CroppedRegion(
+                            processed_image=processed_image, class_name=crop_info['class_name'],
+                            confidence=crop_info['confidence'], x1=x1, y1=y1, x2=x2, y2=y2,
+                            original_filename=f"crop_{item['name']}",
+                            image_format='RAW' if payload_format == 'RAW' else 'JPEG',
+                        )
+                        region.set_encrypted_payload(encrypted_data)
+                        cropped_regions.append(region)
+                    _persist_processed_image(processed_image, [
+                        ('blurred_image', f"blurred_{item['name']}", blurred_path),
+                        ('grid_image', f"grid_{item['name']}", grid_path),
+                    ], fingerprint_data, cropped_regions)
+
+                # The first pass supplies the images the restore benchmark reads back
+                if n == 0:
+                    image_ids.append(processed_image.id)
+                if timed:
+                    totals.append((time.perf_counter() - start) * 1000)
+                    for name, elapsed_ms in samples.items():
+                        stages[name].append(elapsed_ms)
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+        return self.pipeline_result(stages, totals, peak_before), image_ids
+
+    def run_restore(self, image_ids, options):
+        """Run restore_from_cropped stage by stage, bypassing every cache except the raw pixel files"""
+        stages = {name: [] for name in RESTORE_STAGES}
+        totals = []
+        peak_before = peak_rss_mb()
+
+        for n, timed in self.passes(options):
+            for image_id in image_ids:
+                samples = {}
+                start = time.perf_counter()
+
+                with self.stage(samples, 'fetch'):
+                    processed_image = ProcessedImage.objects.get(id=image_id)
+                    cropped_regions = list(processed_image.cropped_regions.with_payload())
+
+                with self.stage(samples, 'decrypt'):
+                    decrypted = [decrypt_image(region.encrypted_payload)[0] for region in cropped_regions]
+
+                with self.stage(samples, 'decode'):
+                    restored_img = load_image_pixels(processed_image.blurred_image.path, writable=True)
+                    crops = [decode_region_payload(data) for data in decrypted]
+
+                with self.stage(samples, 'composite'):
+                    for region, crop_img in zip(cropped_regions, crops):
+                        restored_img[region.y1:region.y2, region.x1:region.x2] = crop_img
+
+                with self.stage(samples, 'similarity'):
+                    blurred_img = load_image_pixels(processed_image.blurred_image.path)
+                    calculate_restoration_similarity(processed_image, blurred_img, restored_img, cropped_regions)
+
+                with self.stage(samples, 'encode'):
+                    encode_image(restored_img, options['format'])
+
+                if timed:
+                    totals.append((time.perf_counter() - start) * 1000)
+                    for name, elapsed_ms in samples.items():
+                        stages[name].append(elapsed_ms)
+
+        return self.pipeline_result(stages, totals, peak_before)
+
+    @contextlib.contextmanager
+    def stage(self, samples, name):
+        start = time.perf_counter()
+        yield
+        samples[name] = (time.perf_counter() - start) * 1000
+
+    def pipeline_result(self, stages, totals, peak_before):
+        return {
+            'stages': {name: summarize(samples) for name, samples in stages.items()},
+            'total': summarize(totals),
+            'throughput_per_s': len(totals) / (sum(totals) / 1000) if sum(totals) else None,
+            # ru_maxrss only grows, so this is the process peak once the pipeline has run
+            'peak_rss_mb': peak_rss_mb(),
+            'peak_rss_growth_mb': peak_rss_mb() - peak_before,
+        }
+
+    def compare(self, results, baseline, options):
+        """
+        Compare every stage and pipeline total with the baseline.
+
+        A stage regresses when it is slower by more than --threshold percent and
+        by more than --min-delta-ms; stages missing on either side are skipped.
+        """
+        metric = options['metric']
+        rows = []
+        for pipeline, data in results['pipelines'].items():
+            base_pipeline = baseline.get('pipelines', {}).get(pipeline)
+            if not base_pipeline:
+                continue
+            current_stages = {**data['stages'], 'total': data['total']}
+            base_stages = {**base_pipeline.get('stages', {}), 'total': base_pipeline.get('total', {})}
+            for stage, summary in current_stages.items():
+                base_value = base_stages.get(stage, {}).get(metric)
+                if base_value is None:
+                    continue
+                delta = summary[metric] - base_value
+                change = delta / base_value * 100 if base_value else 0.0
+                rows.append({
+                    'pipeline': pipeline,
+                    'stage': stage,
+                    'baseline_ms': base_value,
+                    'current_ms': summary[metric],
+                    'change_percent': change,
+                    'regressed': change > options['threshold'] and delta > options['min_delta_ms'],
+                })
+        return rows
+
+    def report(self, results):
+        for pipeline, data in results['pipelines'].items():
+            self.stdout.write('')
+            self.stdout.write(self.style.MIGRATE_HEADING(pipeline))
+            self.stdout.write(f"  {'Stage':<12} | {'p50':>10} | {'p95':>10} | {'p99':>10} | {'mean':>10}")
+            self.stdout.write('  ' + '-' * 64)
+            for name, summary in {**data['stages'], 'total': data['total']}.items():
+                self.stdout.write(f"  {name:<12} | {summary['p50_ms']:>8.2f}ms | {summary['p95_ms']:>8.2f}ms | "
+                                  f"{summary['p99_ms']:>8.2f}ms | {summary['mean_ms']:>8.2f}ms")
+            for name, reason in data.get('skipped', {}).items():
+                self.stdout.write(f"  {name:<12} | skipped: {reason}")
+            throughput = data['throughput_per_s']
+            self.stdout.write(f"  Throughput: {throughput:.2f} images/s, peak RSS {data['peak_rss_mb']:.1f} MiB "
+                              f"(+{data['peak_rss_growth_mb']:.1f} MiB)" if throughput else
+                              f"  Peak RSS {data['peak_rss_mb']:.1f} MiB")
+
+    def report_comparison(self, rows, options):
+        self.stdout.write('')
+        self.stdout.write(self.style.MIGRATE_HEADING(f"Comparison with baseline ({options['metric']})"))
+        for row in rows:
+            line = (f"  {row['pipeline'] + '.' + row['stage']:<34} | {row['baseline_ms']:>8.2f}ms -> "
+                    f"{row['current_ms']:>8.2f}ms | {row['change_percent']:>+7.1f}%")
+            self.stdout.write(self.style.ERROR(line + '  REGRESSION') if row['regressed'] else line)
@@ -0,0 +1,324 @@
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.utils import timezone
+
+from patients.models import CroppedRegion, Patient, ProcessedImage
+from patients.pagination import KeysetCursorPagination
+
+BENCH_ALIAS = 'query_bench'
+
+CLASS_NAMES = ['xray_region', 'name_tag', 'face', 'barcode', 'date_stamp']
+
+
+class Command(BaseCommand):
+    help = ('Seeds a scratch database with synthetic rows and reports query plans and latency '
+            'of the hot lookups with and without the tailored indexes')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--patients',
+            type=int,
+            default=20000,
+            help='Number of synthetic patients',
+        )
+
+        parser.add_argument(
+            '--images-per-patient',
+            type=int,
+            default=3,
+            help='Processed images per patient',
+        )
+
+        parser.add_argument(
+            '--regions-per-image',
+            type=int,
+            default=2,
+            help='Cropped regions per processed image',
+        )
+
+        parser.add_argument(
+            '--payload-bytes',
+            type=int,
+            default=256,
+            help='Size of the synthetic inline ciphertext of each region',
+        )
+
+        parser.add_argument(
+            '--repetitions',
+            type=int,
+            default=200,
+            help='Timed executions of each query per phase',
+        )
+
+        parser.add_argument(
+            '--database',
+            type=str,
+            default=None,
+            help='Existing scratch database alias to use instead of a temporary SQLite file (its data is added to)',
+        )
+
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='Random seed for the synthetic data and the query parameters',
+        )
+
+        parser.add_argument(
+            '--json',
+            type=str,
+            default=None,
+            help='Also write the results to this JSON file',
+        )
+
+    def handle(self, *args, **options):
+        temp_path = None
+        alias = options['database']
+        if alias is None:
+            # Never touch the real database: register a throwaway SQLite file
+            fd, temp_path = tempfile.mkstemp(suffix='.sqlite3', prefix='query_bench_')
+            os.close(fd)
+            alias = BENCH_ALIAS
+            connections.databases[alias] = {**connections.databases['default'],
+                                            'ENGINE': 'django.db.backends.sqlite3', 'NAME': temp_path,
+                                            'OPTIONS': dict(getattr(settings, 'SQLITE_OPTIONS', {}))}
+        elif alias not in connections.databases:
+            raise CommandError(f'Unknown database alias {alias}')
+
+        try:
+            call_command('migrate', database=alias, verbosity=0)
+            rng = random.Random(options['seed'])
+            start = time.perf_counter()
+            counts = self.seed(alias, rng, options)
+            self.stdout.write(f"Seeded {counts['patients']} patients, {counts['images']} images and "
+                              f"{counts['regions']} regions in {time.perf_counter() - start:.1f}s")
+
+            queries = self.build_queries(alias, rng, counts)
+            results = {'rows': counts, 'phases': {}}
+            # Measure with the indexes from the migrations, then without them
+            results['phases']['indexed'] = self.run_phase(alias, queries, options['repetitions'])
+            removed = self.drop_indexes(alias)
+            try:
+                results['phases']['unindexed'] = self.run_phase(alias, queries, options['repetitions'])
+            finally:
+                self.restore_indexes(alias, removed)
+
+            self.report(results)
+            if options['json']:
+                with open(options['json'], 'w') as f:
+                    json.dump(results, f, indent=2)
+                self.stdout.write(self.style.SUCCESS(f"Results written to {options['json']}"))
+        finally:
+            if temp_path is not None:
+                connections[alias].close()
+                del connections.databases[alias]
+                for suffix in ('', '-wal', '-shm'):
+                    if os.path.exists(temp_path + suffix):
+                        os.remove(temp_path + suffix)
+
+    def seed(self, alias, rng, options):
+        """Insert synthetic rows with raw executemany; bulk_create would overwrite created_at"""
+        connection = connections[alias]
+        now = timezone.now()
+        payload = bytes(rng.getrandbits(8) for _ in range(options['payload_bytes']))
+        header = payload[:64]
+        batch_size = 5000
+
+        patient_table = Patient._meta.db_table
+        image_table = ProcessedImage._meta.db_table
+        region_table = CroppedRegion._meta.db_table
+
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT COALESCE(MAX(id), 0) FROM {image_table}')
+            next_image_id = cursor.fetchone()[0] + 1
+            patient_rows, image_rows, region_rows = [], [], []
+            counts = {'patients': 0, 'images': 0, 'regions': 0, 'first_image_id': next_image_id}
+
+            def flush():
+                # One transaction per batch; in autocommit SQLite would sync after every row
+                with transaction.atomic(using=alias):
+                    insert_rows()
+                patient_rows.clear()
+                image_rows.clear()
+                region_rows.clear()
+
+            def insert_rows():
+                if patient_rows:
+                    cursor.executemany(
+                        f'INSERT INTO {patient_table} (id, name, age, note, created_at, updated_at) '
+                        f'VALUES (%s, %s, %s, %s, %s, %s)', patient_rows)
+                if image_rows:
+                    cursor.executemany(
+                        f'INSERT INTO {image_table} (id, patient_id, blurred_image, grid_image, restored_image, '
+                        f'enhanced, created_at, updated_at) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)', image_rows)
+                if region_rows:
+                    cursor.executemany(
+                        f'INSERT INTO {region_table} (processed_image_id, class_name, confidence, x1, y1, x2, y2, '
+                        f'cropped_image_data, payload_ref, payload_size, payload_header, original_filename, '
+                        f'image_format, created_at) '
+                        f'VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)', region_rows)
+
+            for p in range(options['patients']):
+                patient_id = f"BENCH{options['seed']}-{p:08d}"
+                created = now - timedelta(minutes=rng.randrange(0, 60 * 24 * 365 * 3))
+                patient_rows.append((patient_id, f'Synthetic {p}', rng.randrange(1, 100), None, created, created))
+                counts['patients'] += 1
+
+                for i in range(options['images_per_patient']):
+                    image_created = created + timedelta(minutes=rng.randrange(0, 60 * 24 * 90))
+                    image_rows.append((next_image_id, patient_id, f'synthetic/{next_image_id}.png', 'grid.png',
+                                       None, False, image_created, image_created))
+                    for _ in range(options['regions_per_image']):
+                        x1, y1 = rng.randrange(0, 900), rng.randrange(0, 900)
+                        region_rows.append((next_image_id, rng.choice(CLASS_NAMES), rng.random(), x1, y1,
+                                            x1 + 100, y1 + 100, payload, '', len(payload), header,
+                                            'crop.png', 'RAW', image_created))
+                    next_image_id += 1
+                    counts['images'] += 1
+                    counts['regions'] += options['regions_per_image']
+
+                if len(region_rows) >= batch_size or len(image_rows) >= batch_size:
+                    flush()
+            flush()
+
+            if connection.vendor == 'sqlite':
+                cursor.execute('ANALYZE')
+        counts['last_image_id'] = next_image_id - 1
+        return counts
+
+    def build_queries(self, alias, rng, counts):
+        """Hot lookups, each a callable taking a parameter drawn per repetition"""
+        patient_ids = list(Patient.objects.using(alias).values_list('id', flat=True)[:5000])
+        if not patient_ids:
+            raise CommandError('No patients to query; seed at least one')
+
+        def random_patient():
+            return rng.choice(patient_ids)
+
+        def random_image():
+            return rng.randint(counts['first_image_id'], max(counts['first_image_id'], counts['last_image_id']))
+
+        keyset = KeysetCursorPagination()
+        keyset_ordering = ('-created_at', '-id')
+
+        def random_image_position():
+            # Cursor of a random image, as the listing would hand it out
+            image = ProcessedImage.objects.using(alias).only('id', 'created_at').get(id=random_image())
+            return keyset._get_position_from_instance(image, keyset_ordering)
+
+        return {
+            'latest_image_of_patient': (
+                random_patient,
+                lambda pid: ProcessedImage.objects.using(alias).filter(patient_id=pid).order_by('-created_at')[:1],
+            ),
+            'recent_patients': (
+                lambda: None,
+                lambda _: Patient.objects.using(alias).order_by('-created_at')[:50],
+            ),
+            'image_keyset_page': (
+                random_image_position,
+                lambda position: ProcessedImage.objects.using(alias).filter(
+                    keyset.after(ProcessedImage, keyset_ordering, position)).order_by(*keyset_ordering)[:51],
+            ),
+            'regions_of_image': (
+                random_image,
+                lambda iid: CroppedRegion.objects.using(alias).filter(processed_image_id=iid).order_by('id'),
+            ),
+            'admin_regions_by_class': (
+                lambda: rng.choice(CLASS_NAMES),
+                lambda name: CroppedRegion.objects.using(alias).filter(class_name=name).order_by('-id')[:100],
+            ),
+            'admin_regions_by_patient': (
+                random_patient,
+                lambda pid: CroppedRegion.objects.using(alias).filter(
+                    processed_image__patient_id=pid).order_by('-id')[:100],
+            ),
+        }
+
+    def run_phase(self, alias, queries, repetitions):
+        if connections[alias].vendor == 'sqlite':
+            with connections[alias].cursor() as cursor:
+                cursor.execute('ANALYZE')
+
+        phase = {}
+        for name, (make_param, make_query) in queries.items():
+            plan = make_query(make_param()).explain()
+            # Warm the page cache before timing
+            for _ in range(min(10, repetitions)):
+                list(make_query(make_param()))
+            timings = []
+            for _ in range(repetitions):
+                queryset = make_query(make_param())
+                start = time.perf_counter()
+                list(queryset)
+                timings.append((time.perf_counter() - start) * 1000)
+            timings.sort()
+            phase[name] = {
+                'plan': plan,
+                'p50_ms': statistics.median(timings),
+                'p95_ms': timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+                'max_ms': timings[-1],
+            }
+        return phase
+
+    def tailored_indexes(self):
+        return [(model, index) for model in (Patient, ProcessedImage, CroppedRegion) for index in model._meta.indexes]
+
+    def drop_indexes(self, alias):
+        """
+        Go back to the schema without the tailored indexes.
+
+        Foreign keys whose default index was folded into a composite index get
+        a plain single-column index again, as Django would create it.
+        """
+        from django.db import models
+
+        removed, added = [], []
+        with connections[alias].schema_editor() as schema_editor:
+            for model, index in self.tailored_indexes():
+                schema_editor.remove_index(model, index)
+                removed.append((model, index))
+
+                field = model._meta.get_field(index.fields[0].lstrip('-'))
+                if field.is_relation and not field.db_index:
+                    fk_index = models.Index(fields=[field.name], name=f'bench_{field.column}'[:30])
+                    schema_editor.add_index(model, fk_index)
+                    added.append((model, fk_index))
+        return removed, added
+
+    def restore_indexes(self, alias, changes):
+        removed, added = changes
+        with connections[alias].schema_editor() as schema_editor:
+            for model, index in added:
+                schema_editor.remove_index(model, index)
+            for model, index in removed:
+                schema_editor.add_index(model, index)
+
+    def report(self, results):
+        indexed = results['phases']['indexed']
+        unindexed = results['phases']['unindexed']
+        self.stdout.write('')
+        self.stdout.write(f"{'Query':<26} | {'No index p50':>12} | {'Indexed p50':>11} | {'No index p95':>12} | "
+                          f"{'Indexed p95':>11} | {'Speedup':>7}")
+        self.stdout.write('-' * 96)
+        for name in indexed:
+            before, after = unindexed[name], indexed[name]
+            speedup = before['p50_ms'] / after['p50_ms'] if after['p50_ms'] else float('inf')
+            self.stdout.write(f"{name:<26} | {before['p50_ms']:>10.3f}ms | {after['p50_ms']:>9.3f}ms | "
+                              f"{before['p95_ms']:>10.3f}ms | {after['p95_ms']:>9.3f}ms | {speedup:>6.1f}x")
+
+        self.stdout.write('')
+        for name in indexed:
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            self.stdout.write(f"  without indexes: {unindexed[name]['plan']}")
+            self.stdout.write(f"  with indexes:    {indexed[name]['plan']}")
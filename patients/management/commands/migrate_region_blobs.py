@@ -0,0 +1,103 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models.functions import Length
+
+from patients.blobstore import blob_store_dir, delete_blob, put_blob, read_blob
+from patients.models import CroppedRegion
+
+
+class Command(BaseCommand):
+    help = 'Moves encrypted region payloads between the database and the region blob store in streaming batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=100,
+            help='Number of regions loaded and updated per transaction',
+        )
+
+        parser.add_argument(
+            '--inline',
+            action='store_true',
+            help='Move payloads from the blob store back into the database',
+        )
+
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only report how many regions and bytes would be moved',
+        )
+
+        parser.add_argument(
+            '--vacuum',
+            action='store_true',
+            help='Run VACUUM afterwards so SQLite returns the freed pages to the filesystem',
+        )
+
+    def handle(self, *args, **options):
+        if blob_store_dir() is None:
+            raise CommandError('REGION_BLOB_STORE_DIR is not configured')
+        batch_size = max(1, options['batch_size'])
+
+        if options['inline']:
+            pending = CroppedRegion.objects.exclude(payload_ref='')
+        else:
+            pending = CroppedRegion.objects.filter(payload_ref='').annotate(
+                inline_size=Length('cropped_image_data')
+            ).filter(inline_size__gt=0)
+
+        if options['dry_run']:
+            count = pending.count()
+            self.stdout.write(f'{count} regions would be moved')
+            return
+
+        moved, moved_bytes = 0, 0
+        last_id = 0
+        while True:
+            # Keyset pagination keeps memory flat: only one batch of payloads is loaded at a time
+            batch = list(
+                pending.filter(id__gt=last_id).order_by('id')
+                .only('id', 'cropped_image_data', 'payload_ref', 'payload_size')[:batch_size]
+            )
+            if not batch:
+                break
+            last_id = batch[-1].id
+
+            released_refs = set()
+            for region in batch:
+                if options['inline']:
+                    data = bytes(read_blob(region.payload_ref))
+                    released_refs.add(region.payload_ref)
+                    region.cropped_image_data = data
+                    region.payload_ref = ''
+                else:
+                    data = region.cropped_image_data
+                    region.payload_ref = put_blob(data)
+                    region.cropped_image_data = b''
+                region.payload_size = len(data)
+                moved_bytes += len(data)
+
+            # bulk_update sends no post_save: the ciphertext itself is unchanged,
+            # so cached plaintext and restorations stay valid
+            with transaction.atomic():
+                CroppedRegion.objects.bulk_update(batch, ['cropped_image_data', 'payload_ref', 'payload_size'])
+
+            # Blobs are shared between identical payloads; drop only those nobody references now
+            if released_refs:
+                still_used = set(CroppedRegion.objects.filter(payload_ref__in=released_refs)
+                                 .values_list('payload_ref', flat=True))
+                for ref in released_refs - still_used:
+                    delete_blob(ref)
+
+            moved += len(batch)
+            self.stdout.write(f'  Moved {moved} regions ({moved_bytes / (1024 * 1024):.1f} MiB)')
+
+        destination = 'the database' if options['inline'] else blob_store_dir()
+        self.stdout.write(self.style.SUCCESS(f'Moved {moved} region payloads to {destination}'))
+
+        if options['vacuum'] and connection.vendor == 'sqlite':
+            self.stdout.write('Running VACUUM...')
+            with connection.cursor() as cursor:
+                cursor.execute('VACUUM')
+            self.stdout.write(self.style.SUCCESS('VACUUM complete'))
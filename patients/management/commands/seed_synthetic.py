@@ -0,0 +1,258 @@
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import cv2
+import numpy as np
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from patients.models import CroppedRegion, Patient, ProcessedImage
+from patients.synthetic import random_boxes, synthetic_scan
+from patients.utils import (
+    _persist_processed_image,
+    create_image_fingerprint,
+    encrypt_image,
+    obscure_region,
+    pack_raw_pixels,
+    process_image,
+)
+
+
+class Command(BaseCommand):
+    help = ('Generates synthetic patients with scans, regions, fingerprints and encrypted payloads '
+            'for reproducible performance measurements')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--patients',
+            type=int,
+            default=50,
+            help='Number of synthetic patients',
+        )
+
+        parser.add_argument(
+            '--images-per-patient',
+            type=int,
+            default=1,
+            help='Processed images per patient',
+        )
+
+        parser.add_argument(
+            '--regions-per-image',
+            type=int,
+            default=2,
+            help='Sensitive regions per image (stub mode only; the model decides in pipeline mode)',
+        )
+
+        parser.add_argument(
+            '--width',
+            type=int,
+            default=1024,
+            help='Width of the synthetic scans in pixels',
+        )
+
+        parser.add_argument(
+            '--height',
+            type=int,
+            default=768,
+            help='Height of the synthetic scans in pixels',
+        )
+
+        parser.add_argument(
+            '--region-size',
+            type=int,
+            default=160,
+            help='Edge length of the sensitive regions in pixels; controls the encrypted payload size',
+        )
+
+        parser.add_argument(
+            '--mode',
+            choices=['stub', 'pipeline'],
+            default='stub',
+            help='stub writes the rows directly without running the model; pipeline calls process_image',
+        )
+
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=4,
+            help='Number of images generated in parallel',
+        )
+
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='Random seed; the same seed produces the same patients, scans and regions',
+        )
+
+        parser.add_argument(
+            '--prefix',
+            type=str,
+            default='SYN',
+            help='Prefix of the generated patient IDs',
+        )
+
+    def handle(self, *args, **options):
+        for name in ('patients', 'images_per_patient', 'width', 'height', 'region_size', 'workers'):
+            if options[name] < 1:
+                raise CommandError(f"--{name.replace('_', '-')} must be at least 1")
+        if options['regions_per_image'] < 0:
+            raise CommandError('--regions-per-image must not be negative')
+        if options['region_size'] > min(options['width'], options['height']):
+            raise CommandError('--region-size must fit inside the scan')
+
+        # Patients that already exist from an earlier run with the same seed are kept as they are
+        patient_ids = [self.patient_id(options, p) for p in range(options['patients'])]
+        existing = set(Patient.objects.filter(id__in=patient_ids).values_list('id', flat=True))
+        tasks = [(p, i) for p in range(options['patients']) if patient_ids[p] not in existing
+                 for i in range(options['images_per_patient'])]
+        if existing:
+            self.stdout.write(f'Skipping {len(existing)} patients that already exist')
+        if not tasks:
+            self.stdout.write(self.style.SUCCESS('Nothing to generate'))
+            return
+
+        new_patients = sorted({p for p, _ in tasks})
+        Patient.objects.bulk_create([
+            Patient(
+                id=patient_ids[p],
+                name=f'Synthetic Patient {p}',
+                age=int(np.random.default_rng([options['seed'], p]).integers(1, 100)),
+                note=f"Synthetic data (seed {options['seed']})",
+            )
+            for p in new_patients
+        ])
+
+        self.stdout.write(f"Generating {len(tasks)} images in {options['mode']} mode "
+                          f"with {options['workers']} workers...")
+        start = time.perf_counter()
+        totals = {'images': 0, 'regions': 0, 'payload_bytes': 0}
+
+        def collect(stats):
+            totals['images'] += 1
+            totals['regions'] += stats['regions']
+            totals['payload_bytes'] += stats['payload_bytes']
+            if totals['images'] % 50 == 0:
+                self.stdout.write(f"  {totals['images']}/{len(tasks)} images")
+
+        if options['workers'] == 1:
+            for p, i in tasks:
+                collect(self.generate(p, i, patient_ids[p], options))
+        else:
+            with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+                futures = [executor.submit(self.run_in_thread, p, i, patient_ids[p], options) for p, i in tasks]
+                for future in as_completed(futures):
+                    collect(future.result())
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f"Created {len(new_patients)} patients, {totals['images']} images and "
+            f"{totals['regions']} regions ({totals['payload_bytes'] / 1024:.1f} KiB encrypted) "
+            f"in {elapsed:.1f}s ({totals['images'] / elapsed:.1f} images/s)"
+        ))
+
+    def patient_id(self, options, index):
+        return f"{options['prefix']}{options['seed']}-{index:06d}"
+
+    def run_in_thread(self, p, i, patient_id, options):
+        try:
+            return self.generate(p, i, patient_id, options)
+        finally:
+            # Each worker thread opens its own connection; do not leak it
+            connections.close_all()
+
+    def generate(self, p, i, patient_id, options):
+        """Create one processed image; all randomness comes from a generator seeded per image"""
+        rng = np.random.default_rng([options['seed'], p, i])
+        scan = synthetic_scan(rng, options['width'], options['height'])
+        patient = Patient.objects.get(id=patient_id)
+        name = f'{patient_id}_{i}.png'
+
+        if options['mode'] == 'pipeline':
+            success, buffer = cv2.imencode('.png', scan)
+            if not success:
+                raise CommandError(f'Could not encode {name}')
+            processed_image = process_image(SimpleUploadedFile(name, buffer.tobytes(), 'image/png'), patient)
+            if processed_image is None:
+                raise CommandError(f'process_image failed for {name}')
+            regions = list(processed_image.cropped_regions.values_list('payload_size', flat=True))
+            return {'regions': len(regions), 'payload_bytes': sum(size or 0 for size in regions)}
+
+        boxes = random_boxes(rng, options['width'], options['height'],
+                             options['regions_per_image'], options['region_size'])
+        return self.persist_stub(rng, scan, boxes, patient, name)
+
+    def persist_stub(self, rng, scan, boxes, patient, name):
+        """
+        Write the same rows and files as process_image without model inference.
+
+        Blurring, fingerprinting, payload packing and encryption use the real
+        helpers, so payload sizes and storage behaviour match the pipeline.
+        """
+        processed_image = ProcessedImage(patient=patient)
+        processed_image.original_entropy = float(rng.uniform(5.0, 7.0))
+
+        modified = scan.copy()
+        grid = scan.copy()
+        payload_format = getattr(settings, 'CROP_PAYLOAD_FORMAT', 'RAW').upper()
+        cropped_regions = []
+        payload_bytes = 0
+
+        for box in boxes:
+            x1, y1, x2, y2 = box['coords']
+            cropped = scan[y1:y2, x1:x2].copy()
+            modified[y1:y2, x1:x2] = obscure_region(modified[y1:y2, x1:x2], rng=rng)
+            cv2.rectangle(grid, (x1, y1), (x2, y2), (0, 255, 0), 3)
+
+            if payload_format == 'RAW':
+                payload = pack_raw_pixels(cropped, compress_level=getattr(settings, 'CROP_PAYLOAD_ZLIB_LEVEL', 1))
+                image_format = 'RAW'
+            else:
+                success, buffer = cv2.imencode('.jpg', cropped)
+                if not success:
+                    raise CommandError(f'Could not encode a region of {name}')
+                payload = buffer.tobytes()
+                image_format = 'JPEG'
+
+            encrypted_data, encryption_time_ms = encrypt_image(payload)
+            if not processed_image.encryption_time:
+                processed_image.encryption_time = encryption_time_ms
+            else:
+                processed_image.encryption_time = (processed_image.encryption_time + encryption_time_ms) / 2
+
+            region = CroppedRegion(
+                processed_image=processed_image,
+                class_name=box['class_name'],
+                confidence=box['confidence'],
+                x1=x1, y1=y1, x2=x2, y2=y2,
+                original_filename=f"crop_{box['class_name']}_{name}",
+                image_format=image_format,
+            )
+            region.set_encrypted_payload(encrypted_data)
+            cropped_regions.append(region)
+            payload_bytes += len(encrypted_data)
+
+        if cropped_regions:
+            # Ciphertext is close to 8 bits per byte; no need to run the full analysis here
+            processed_image.encrypted_entropy = float(rng.uniform(7.8, 8.0))
+
+        temp_dir = tempfile.mkdtemp(prefix='seed_synthetic_')
+        try:
+            blurred_path = os.path.join(temp_dir, f'blurred_{name}')
+            grid_path = os.path.join(temp_dir, f'grid_{name}')
+            cv2.imwrite(blurred_path, modified)
+            cv2.imwrite(grid_path, cv2.resize(grid, (grid.shape[1] // 2, grid.shape[0] // 2)))
+            _persist_processed_image(processed_image, [
+                ('blurred_image', f'blurred_{name}', blurred_path),
+                ('grid_image', f'grid_{name}', grid_path),
+            ], create_image_fingerprint(scan), cropped_regions)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+        return {'regions': len(cropped_regions), 'payload_bytes': payload_bytes}
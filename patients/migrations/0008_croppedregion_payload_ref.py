@@ -0,0 +1,36 @@
+# Generated by Django 5.2.1 on 2026-10-19 16:17
+
+from django.db import migrations, models
+from django.db.models.functions import Length
+
+
+def fill_payload_size(apps, schema_editor):
+    # Existing payloads are all inline; size them in a single UPDATE
+    CroppedRegion = apps.get_model('patients', 'CroppedRegion')
+    CroppedRegion.objects.using(schema_editor.connection.alias).update(payload_size=Length('cropped_image_data'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0007_processedimage_decryption_time_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='croppedregion',
+            name='payload_ref',
+            field=models.CharField(blank=True, db_index=True, default='', help_text='SHA-256 of the ciphertext in the region blob store', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='croppedregion',
+            name='payload_size',
+            field=models.PositiveIntegerField(blank=True, help_text='Ciphertext size in bytes', null=True),
+        ),
+        migrations.AlterField(
+            model_name='croppedregion',
+            name='cropped_image_data',
+            field=models.BinaryField(blank=True, default=b''),
+        ),
+        migrations.RunPython(fill_payload_size, migrations.RunPython.noop),
+    ]
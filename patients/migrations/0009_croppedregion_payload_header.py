@@ -0,0 +1,47 @@
+# Generated by Django 5.2.1 on 2026-10-19 16:19
+
+import os
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models.functions import Substr
+
+HEADER_BYTES = 64
+
+
+def fill_payload_header(apps, schema_editor):
+    CroppedRegion = apps.get_model('patients', 'CroppedRegion')
+    regions = CroppedRegion.objects.using(schema_editor.connection.alias)
+    # Inline payloads: one UPDATE slicing the blob in the database
+    regions.filter(payload_ref='').update(
+        payload_header=Substr('cropped_image_data', 1, HEADER_BYTES, output_field=models.BinaryField())
+    )
+    
+    # Blob-store payloads: read just the first bytes of each file
+    blob_dir = getattr(settings, 'REGION_BLOB_STORE_DIR', None)
+    if not blob_dir:
+        return
+    for region in regions.exclude(payload_ref='').only('id', 'payload_ref').iterator(chunk_size=500):
+        ref = region.payload_ref
+        try:
+            with open(os.path.join(blob_dir, ref[:2], ref[2:4], ref), 'rb') as f:
+                region.payload_header = f.read(HEADER_BYTES)
+        except OSError:
+            continue
+        region.save(update_fields=['payload_header'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0008_croppedregion_payload_ref'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='croppedregion',
+            name='payload_header',
+            field=models.BinaryField(blank=True, default=b'', help_text='IV and leading ciphertext bytes, for previews', max_length=64),
+        ),
+        migrations.RunPython(fill_payload_header, migrations.RunPython.noop),
+    ]
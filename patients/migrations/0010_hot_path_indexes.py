@@ -0,0 +1,27 @@
+# Generated by Django 5.2.1 on 2026-10-19 16:28
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0009_croppedregion_payload_header'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='processedimage',
+            name='patient',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='processed_images', to='patients.patient'),
+        ),
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(fields=['-created_at'], name='patient_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='processedimage',
+            index=models.Index(fields=['patient', '-created_at'], name='image_patient_created_idx'),
+        ),
+    ]
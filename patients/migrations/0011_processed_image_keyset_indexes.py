@@ -0,0 +1,25 @@
+# Generated by Django 5.2.1 on 2026-10-19 16:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0010_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='processedimage',
+            name='image_patient_created_idx',
+        ),
+        migrations.AddIndex(
+            model_name='processedimage',
+            index=models.Index(fields=['patient', '-created_at', '-id'], name='image_patient_keyset_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='processedimage',
+            index=models.Index(fields=['-created_at', '-id'], name='image_created_keyset_idx'),
+        ),
+    ]
@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, transaction
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 import os
@@ -7,10 +7,16 @@ from django.utils.safestring import mark_safe
 from .utils import decrypt_image, load_encryption_keys_from_file
 import base64
 import logging
-from django.core.cache import cache
+from django.conf import settings
+from .cache import ByteLRUCache, bump_image_version, discard_image_pixels
+from .timing import decryption_timings
 
 # Create your models here.
 
+# ProcessedImage fields that are bookkeeping only; saving them must not
+# invalidate cached restorations
+VERSION_NEUTRAL_FIELDS = {'decryption_time', 'encryption_time', 'original_entropy', 'encrypted_entropy'}
+
 class EncryptedImageField(models.BinaryField):
     """
     A custom field that stores images as encrypted binary data
@@ -35,9 +41,14 @@ class Patient(models.Model):
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Default ordering of patient lists
+            models.Index(fields=['-created_at'], name='patient_created_idx'),
+        ]
 
 class ProcessedImage(models.Model):
-    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='processed_images')
+    # Indexed by image_patient_created_idx, whose leading column is the patient
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='processed_images', db_index=False)
     blurred_image = models.ImageField(upload_to='patient_images/blurred/')
     grid_image = models.ImageField(upload_to='patient_images/grid/')
     restored_image = models.ImageField(upload_to='patient_images/restored/', blank=True, null=True)
@@ -51,6 +62,14 @@ class ProcessedImage(models.Model):
     
     def __str__(self):
         return f"Processed Image for {self.patient.name} ({self.created_at})"
+    
+    class Meta:
+        indexes = [
+            # Latest image of a patient, and keyset pages of one patient's images
+            models.Index(fields=['patient', '-created_at', '-id'], name='image_patient_keyset_idx'),
+            # Keyset pages of the whole archive: order_by('-created_at', '-id')
+            models.Index(fields=['-created_at', '-id'], name='image_created_keyset_idx'),
+        ]
 
 class ImageFingerprint(models.Model):
     """
@@ -65,6 +84,42 @@ class ImageFingerprint(models.Model):
     def __str__(self):
         return f"Fingerprint for {self.processed_image}"
 
+# Leading ciphertext bytes kept next to each region: the 16-byte IV plus enough
+# of the ciphertext for the admin previews
+PAYLOAD_HEADER_BYTES = 64
+
+class CroppedRegionQuerySet(models.QuerySet):
+    def with_payload(self):
+        """Load the inline ciphertext too; for paths that decrypt every region"""
+        field_names, deferring = self.query.deferred_loading
+        if deferring:
+            return self.defer(None).defer(*(set(field_names) - {'cropped_image_data'}))
+        return self.only(*(set(field_names) | {'cropped_image_data'}))
+
+    def with_payload_size(self):
+        """
+        Annotate encrypted_size: the stored payload_size, or the database-measured
+        length of inline ciphertext for rows that predate the column.
+        """
+        from django.db.models.functions import Coalesce, Length
+        
+        return self.annotate(encrypted_size=Coalesce('payload_size', Length('cropped_image_data')))
+
+
+class CroppedRegionManager(models.Manager.from_queryset(CroppedRegionQuerySet)):
+    """
+    Default manager that never loads ciphertext unless asked.
+    
+    Metadata views (lists, admin, serializers) get coordinates, payload_size and
+    payload_header without the blob; decrypting paths call with_payload().
+    Accessing cropped_image_data on a deferred row still works, at the cost of
+    one query for that row.
+    """
+    
+    def get_queryset(self):
+        return super().get_queryset().defer('cropped_image_data')
+
+
 class CroppedRegion(models.Model):
     """
     Model to store cropped sensitive regions from processed images.
@@ -77,13 +132,96 @@ class CroppedRegion(models.Model):
     y1 = models.IntegerField()
     x2 = models.IntegerField()
     y2 = models.IntegerField()
-    cropped_image_data = models.BinaryField()
+    # Ciphertext inline, or empty when it lives in the blob store under payload_ref
+    cropped_image_data = models.BinaryField(blank=True, default=b'')
+    payload_ref = models.CharField(max_length=64, blank=True, default='', db_index=True,
+                                   help_text="SHA-256 of the ciphertext in the region blob store")
+    payload_size = models.PositiveIntegerField(null=True, blank=True, help_text="Ciphertext size in bytes")
+    payload_header = models.BinaryField(blank=True, default=b'', max_length=PAYLOAD_HEADER_BYTES,
+                                        help_text="IV and leading ciphertext bytes, for previews")
     original_filename = models.CharField(max_length=255)
     image_format = models.CharField(max_length=10, default='JPEG')
     created_at = models.DateTimeField(auto_now_add=True)
     
-    # Cache for decrypted images to avoid repeated decryption
-    _decrypted_cache = {}
+    objects = CroppedRegionManager()
+    
+    # Process-wide LRU of decrypted images to avoid repeated decryption,
+    # bounded by total bytes rather than entry count. Plaintext is only ever
+    # kept here, never in the shared cache, which is a file on disk.
+    _decrypted_cache = ByteLRUCache(
+        max_bytes=getattr(settings, 'DECRYPTED_REGION_CACHE_BYTES', 64 * 1024 * 1024),
+        ttl=getattr(settings, 'DECRYPTED_REGION_CACHE_TTL', 3600),
+    )
+    
+    @classmethod
+    def invalidate_decrypted_cache(cls, region_id):
+        """
+        Drop the decrypted data of a region from the in-process cache.
+        
+        Args:
+            region_id: ID of the CroppedRegion that was re-encrypted or deleted
+        """
+        cls._decrypted_cache.invalidate(f"decrypted_region_{region_id}")
+    
+    def set_encrypted_payload(self, data):
+        """
+        Store ciphertext in the blob store when it is configured, inline otherwise.
+        
+        Args:
+            data: Encrypted payload (IV + ciphertext)
+        """
+        from .blobstore import blob_store_enabled, put_blob
+        
+        if blob_store_enabled():
+            self.payload_ref = put_blob(data)
+            self.cropped_image_data = b''
+        else:
+            self.payload_ref = ''
+            self.cropped_image_data = data
+        self.payload_size = len(data)
+        self.payload_header = bytes(data[:PAYLOAD_HEADER_BYTES])
+    
+    def payload_preview(self, length=PAYLOAD_HEADER_BYTES):
+        """
+        The first `length` bytes of the ciphertext, from payload_header when it
+        covers them, so previews don't load the payload.
+        """
+        header = self.payload_header or b''
+        if len(header) >= length or (header and self.payload_size is not None and len(header) >= self.payload_size):
+            return bytes(header[:length])
+        encrypted_data = self.encrypted_payload
+        return bytes(encrypted_data[:length]) if encrypted_data else b''
+    
+    def save(self, *args, **kwargs):
+        # Keep the size and header columns in step with inline ciphertext that
+        # was assigned directly rather than through set_encrypted_payload
+        if not self.payload_ref and 'cropped_image_data' not in self.get_deferred_fields():
+            data = self.cropped_image_data or b''
+            self.payload_size = len(data)
+            self.payload_header = bytes(data[:PAYLOAD_HEADER_BYTES])
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None and 'cropped_image_data' in update_fields:
+                kwargs['update_fields'] = set(update_fields) | {'payload_size', 'payload_header'}
+        super().save(*args, **kwargs)
+    
+    @property
+    def encrypted_payload(self):
+        """
+        The region's ciphertext, wherever it is stored.
+        
+        Blob-store payloads are returned as a bytearray or a zero-copy view of a
+        memory-mapped file; a missing blob is logged and returned as None.
+        """
+        if not self.payload_ref:
+            return self.cropped_image_data
+        
+        from .blobstore import read_blob
+        
+        try:
+            return read_blob(self.payload_ref)
+        except OSError as e:
+            logging.getLogger(__name__).error(f"Missing blob {self.payload_ref} for region {self.id}: {str(e)}")
+            return None
     
     def get_decrypted_image(self, user=None, use_static_key=False):
         """
@@ -111,31 +249,25 @@ class CroppedRegion(models.Model):
         
         logger.info(f"Attempting to decrypt region {self.id} for class {self.class_name}")
         
-        # First check local cache (in-memory)
-        if cache_key in self._decrypted_cache:
+        # Check the in-memory cache
+        cached_data = self._decrypted_cache.get(cache_key)
+        if cached_data is not None:
             logger.info(f"Using in-memory cached decrypted data for region {self.id}")
-            return self._decrypted_cache[cache_key]
-        
-        # Then check Django's cache (persistent between restarts)
-        cached_data = cache.get(cache_key)
-        if cached_data:
-            logger.info(f"Using persistent cached decrypted data for region {self.id}")
-            # Store in local cache for faster future access
-            self._decrypted_cache[cache_key] = cached_data
             return cached_data
         
         try:
-            if not self.cropped_image_data:
+            encrypted_data = self.encrypted_payload
+            if not encrypted_data:
                 logger.error(f"No encrypted data available for region {self.id}")
                 return None
                 
             # Get the encrypted data size for logging
-            encrypted_size = len(self.cropped_image_data)
+            encrypted_size = len(encrypted_data)
             logger.info(f"Decrypting region {self.id}, encrypted size: {encrypted_size} bytes")
             
             # Simple decryption using the static key
             start_time = time.time()
-            decrypted_data, decryption_time_ms = decrypt_image(self.cropped_image_data)
+            decrypted_data, decryption_time_ms = decrypt_image(encrypted_data)
             
             # Final check if decryption was successful
             if decrypted_data is None:
@@ -144,30 +276,12 @@ class CroppedRegion(models.Model):
                 
             logger.info(f"Successfully decrypted region {self.id}, decrypted size: {len(decrypted_data)} bytes in {decryption_time_ms:.2f}ms")
             
-            # Store decryption time in the parent ProcessedImage
-            processed_image = self.processed_image
-            if not processed_image.decryption_time:
-                processed_image.decryption_time = decryption_time_ms
-            else:
-                # Average with existing time using a weighted approach
-                # This gives more weight to recent decryptions while maintaining history
-                processed_image.decryption_time = (processed_image.decryption_time * 0.7) + (decryption_time_ms * 0.3)
-                
-            # Save the updated decryption time
-            processed_image.save(update_fields=['decryption_time'])
-            
-            # Store in both caches - local and Django's cache
-            self._decrypted_cache[cache_key] = decrypted_data
-            
-            # Store in Django's cache with 1 hour timeout
-            cache.set(cache_key, decrypted_data, 3600) 
+            # Hand the timing to the in-process aggregator; it is folded into
+            # the parent's decryption_time in batches instead of a write per decrypt
+            decryption_timings.record(self.processed_image_id, decryption_time_ms)
             
-            # Clean local cache if it gets too large (limit to 50 entries)
-            if len(self._decrypted_cache) > 50:
-                # Remove oldest items
-                keys = list(self._decrypted_cache.keys())
-                for key in keys[:10]:  # Remove 10 oldest
-                    del self._decrypted_cache[key]
+            # Store in the in-memory cache (the LRU evicts least recently used entries by size)
+            self._decrypted_cache.set(cache_key, decrypted_data)
             
             return decrypted_data
         except Exception as e:
@@ -187,6 +301,7 @@ def delete_processed_images(sender, instance, **kwargs):
     try:
         if instance.blurred_image:
             if os.path.isfile(instance.blurred_image.path):
+                discard_image_pixels(instance.blurred_image.path)
                 os.remove(instance.blurred_image.path)
         if instance.grid_image:
             if os.path.isfile(instance.grid_image.path):
@@ -197,3 +312,61 @@ def delete_processed_images(sender, instance, **kwargs):
     except Exception as e:
         # Log but don't crash if file deletion fails
         print(f"Error deleting processed images: {e}")
+
+@receiver(post_save, sender=CroppedRegion)
+def invalidate_reencrypted_region(sender, instance, created, update_fields=None, **kwargs):
+    """Drop cached plaintext when a region's encrypted data is rewritten"""
+    if created:
+        return
+    if update_fields is None or {'cropped_image_data', 'payload_ref'} & set(update_fields):
+        CroppedRegion.invalidate_decrypted_cache(instance.id)
+
+@receiver(post_delete, sender=CroppedRegion)
+def invalidate_deleted_region(sender, instance, **kwargs):
+    """Drop cached plaintext of deleted regions"""
+    CroppedRegion.invalidate_decrypted_cache(instance.id)
+
+@receiver(post_delete, sender=CroppedRegion)
+def delete_unreferenced_blob(sender, instance, using, **kwargs):
+    """
+    Remove a region's blob once no other region shares it.
+    
+    Both the reference check and the unlink wait for the delete to commit: a
+    rolled-back delete keeps its blob, and the check sees every reference
+    committed by other transactions in the meantime.
+    """
+    payload_ref = instance.payload_ref
+    if not payload_ref:
+        return
+    
+    def delete_if_unreferenced():
+        from .blobstore import blob_store_dir, delete_blob
+        
+        if blob_store_dir() is None or CroppedRegion.objects.using(using).filter(payload_ref=payload_ref).exists():
+            return
+        delete_blob(payload_ref)
+    
+    transaction.on_commit(delete_if_unreferenced, using=using)
+
+# Signals to invalidate cached restorations when any of their inputs change.
+# The stamp is only bumped once the change commits, so a concurrent restore
+# cannot cache the old rows under the new stamp.
+def bump_version_on_commit(processed_image_id, using):
+    transaction.on_commit(lambda: bump_image_version(processed_image_id), using=using)
+
+@receiver(post_save, sender=ProcessedImage)
+def bump_version_on_image_save(sender, instance, using, update_fields=None, **kwargs):
+    if update_fields is not None and set(update_fields) <= VERSION_NEUTRAL_FIELDS:
+        return
+    bump_version_on_commit(instance.id, using)
+
+@receiver(post_delete, sender=ProcessedImage)
+def bump_version_on_image_delete(sender, instance, using, **kwargs):
+    bump_version_on_commit(instance.id, using)
+
+@receiver(post_save, sender=CroppedRegion)
+@receiver(post_delete, sender=CroppedRegion)
+@receiver(post_save, sender=ImageFingerprint)
+@receiver(post_delete, sender=ImageFingerprint)
+def bump_version_on_related_change(sender, instance, using, **kwargs):
+    bump_version_on_commit(instance.processed_image_id, using)
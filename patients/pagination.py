@@ -0,0 +1,113 @@
+"""
+Keyset pagination for large listings.
+
+DRF's CursorPagination filters on the first ordering field only and skips
+rows that share its value with an offset. KeysetCursorPagination stores the
+values of every ordering field in the cursor instead. The last ordering field
+must be unique (usually the primary key), and the next page is the range
+strictly after that tuple. Each page is therefore a single index range scan,
+no matter how deep it is, and pages never skip or repeat rows that share a
+timestamp.
+"""
+import json
+
+from django.conf import settings
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import Cursor, CursorPagination, _reverse_ordering
+
+
+class KeysetCursorPagination(CursorPagination):
+    ordering = ('-created_at', '-id')
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+
+    def get_page_size(self, request):
+        # Read per request so settings overrides apply
+        self.page_size = getattr(settings, 'PROCESSED_IMAGE_PAGE_SIZE', 50)
+        return super().get_page_size(request)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request)
+        reverse = bool(self.cursor and self.cursor.reverse)
+        position = self.cursor.position if self.cursor else None
+
+        ordering = _reverse_ordering(self.ordering) if reverse else self.ordering
+        queryset = queryset.order_by(*ordering)
+        if position is not None:
+            queryset = queryset.filter(self.after(queryset.model, ordering, position))
+
+        # One extra row tells whether another page follows in this direction
+        results = list(queryset[:self.page_size + 1])
+        self.page = results[:self.page_size]
+        has_more = len(results) > self.page_size
+
+        if reverse:
+            self.page.reverse()
+            self.has_next = position is not None
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = position is not None
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+        return self.page
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        position = self._get_position_from_instance(self.page[-1], self.ordering) if self.page \
+            else self.cursor.position
+        return self.encode_cursor(Cursor(offset=0, reverse=False, position=position))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        position = self._get_position_from_instance(self.page[0], self.ordering) if self.page \
+            else self.cursor.position
+        return self.encode_cursor(Cursor(offset=0, reverse=True, position=position))
+
+    def _get_position_from_instance(self, instance, ordering):
+        """JSON list with the value of every ordering field"""
+        values = []
+        for order in ordering:
+            field = instance._meta.get_field(order.lstrip('-'))
+            values.append(field.value_to_string(instance))
+        return json.dumps(values)
+
+    def after(self, model, ordering, position):
+        """
+        Filter for the rows strictly after `position` in `ordering`.
+
+        (a, b) after (x, y) expands to a > x OR (a = x AND b > y), with the
+        comparisons flipped for descending fields. The extra a >= x bound lets
+        the database seek straight to x in an index on (a, b) instead of
+        scanning from the start.
+        """
+        try:
+            values = json.loads(position)
+            if not isinstance(values, list) or len(values) != len(ordering):
+                raise ValueError
+            fields = [model._meta.get_field(order.lstrip('-')) for order in ordering]
+            values = [field.to_python(value) for field, value in zip(fields, values)]
+        except Exception:
+            raise NotFound(self.invalid_cursor_message)
+
+        condition = Q()
+        equal = Q()
+        for order, field, value in zip(ordering, fields, values):
+            lookup = 'lt' if order.startswith('-') else 'gt'
+            condition |= equal & Q(**{f'{field.name}__{lookup}': value})
+            equal &= Q(**{field.name: value})
+
+        first = ordering[0]
+        seek = Q(**{f"{first.lstrip('-')}__{'lte' if first.startswith('-') else 'gte'}": values[0]})
+        return seek & condition
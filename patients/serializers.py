@@ -8,7 +8,21 @@ class CroppedRegionSerializer(serializers.ModelSerializer):
         model = CroppedRegion
         fields = ['id', 'class_name', 'confidence', 'x1', 'y1', 'x2', 'y2']
 
-class ProcessedImageSerializer(serializers.ModelSerializer):
+class SparseFieldsetMixin:
+    """
+    Serialize only the fields listed in the context's 'fields' entry.
+    
+    The view puts the parsed ?fields= parameter into the context; without it
+    every declared field is returned.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        requested = self.context.get('fields')
+        if requested is not None:
+            for name in set(self.fields) - set(requested):
+                self.fields.pop(name)
+
+class ProcessedImageSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     cropped_regions = CroppedRegionSerializer(many=True, read_only=True)
     
     class Meta:
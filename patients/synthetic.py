@@ -0,0 +1,51 @@
+"""
+Synthetic scans for load generation and benchmarks.
+
+All randomness is drawn from the numpy Generator passed in, so a generator
+seeded with the same values always produces the same scan and regions.
+"""
+import cv2
+import numpy as np
+
+CLASS_NAMES = ['name_tag', 'face', 'barcode', 'date_stamp']
+
+
+def synthetic_scan(rng, width, height):
+    """Greyscale radiograph-like BGR image: vignetted background, soft blobs, noise and a text label"""
+    yy, xx = np.mgrid[0:height, 0:width].astype(np.float32)
+    cx, cy = width / 2, height / 2
+    distance = np.sqrt(((xx - cx) / cx) ** 2 + ((yy - cy) / cy) ** 2)
+    base = np.clip(200 - 120 * distance, 10, 255)
+
+    image = base.astype(np.uint8)
+    for _ in range(int(rng.integers(4, 10))):
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        axes = (int(rng.integers(width // 20, width // 5)), int(rng.integers(height // 20, height // 5)))
+        cv2.ellipse(image, center, axes, float(rng.uniform(0, 180)), 0, 360,
+                    int(rng.integers(60, 240)), -1)
+    image = cv2.GaussianBlur(image, (0, 0), max(1.0, width / 200))
+    noise = rng.normal(0, 8, image.shape)
+    image = np.clip(image.astype(np.float32) + noise, 0, 255).astype(np.uint8)
+    cv2.putText(image, f'ID {int(rng.integers(10 ** 7, 10 ** 8))}', (10, max(30, height // 20)),
+                cv2.FONT_HERSHEY_SIMPLEX, max(0.5, width / 1200), 255, 2)
+    return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+
+
+def random_boxes(rng, width, height, count, size):
+    """
+    Square sensitive regions inside a width x height scan.
+
+    Returns:
+        List of dicts with 'coords' (x1, y1, x2, y2), 'class_name' and 'confidence',
+        the same shape process_image builds from detections
+    """
+    boxes = []
+    for _ in range(count):
+        x1 = int(rng.integers(0, width - size + 1))
+        y1 = int(rng.integers(0, height - size + 1))
+        boxes.append({
+            'coords': (x1, y1, x1 + size, y1 + size),
+            'class_name': CLASS_NAMES[int(rng.integers(0, len(CLASS_NAMES)))],
+            'confidence': float(rng.uniform(0.25, 0.99)),
+        })
+    return boxes
@@ -1,3 +1,1257 @@
-from django.test import TestCase
+import base64
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+import cv2
+import numpy as np
+from Crypto.Cipher import AES
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache, caches
+from django.core.management import CommandError, call_command
+from django.core.signals import request_finished
+from django.db import connection, transaction
+from django.test import TestCase, SimpleTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from .blobstore import blob_path, put_blob, read_blob
+from .cache import (
+    ByteLRUCache, CachePolicy, SingleFlight, get_image_version, load_image_pixels, prune_raw_pixel_cache,
+    restored_cache, restored_image_cache_key,
+)
+from .encoders import encode_image, negotiate_format, resolve_encoding
+from .models import Patient, ProcessedImage, CroppedRegion, ImageFingerprint
+from .tiles import render_tile
+from .timing import DecryptionTimingAggregator, TimingHistogram, decryption_timings
+from .utils import (
+    _persist_processed_image, decrypt_image, encrypt_image, is_raw_pixel_payload, pack_raw_pixels,
+    restore_from_cropped, unpack_raw_pixels,
+)
+
+
+class ByteLRUCacheTests(SimpleTestCase):
+    def test_evicts_least_recently_used_by_size(self):
+        lru = ByteLRUCache(max_bytes=30)
+        lru.set('a', b'x' * 10)
+        lru.set('b', b'x' * 10)
+        lru.set('c', b'x' * 10)
+        lru.get('a')  # 'b' is now least recently used
+        lru.set('d', b'x' * 10)
+        self.assertNotIn('b', lru)
+        self.assertIn('a', lru)
+        self.assertEqual(lru.stats()['evictions'], 1)
+        self.assertEqual(lru.stats()['bytes'], 30)
+
+    def test_rejects_values_over_budget(self):
+        lru = ByteLRUCache(max_bytes=10)
+        self.assertFalse(lru.set('big', b'x' * 11))
+        self.assertEqual(len(lru), 0)
+
+    def test_ttl_and_counters(self):
+        lru = ByteLRUCache(max_bytes=100, ttl=0)
+        lru.set('k', b'v')
+        self.assertIsNone(lru.get('k'))
+        lru.set('k', b'v', ttl=60)
+        self.assertEqual(lru.get('k'), b'v')
+        stats = lru.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+
+class DecryptedRegionCacheInvalidationTests(TestCase):
+    def setUp(self):
+        patient = Patient.objects.create(id='P1', name='Test', age=40)
+        self.processed_image = ProcessedImage.objects.create(
+            patient=patient, blurred_image='blurred.jpg', grid_image='grid.jpg'
+        )
+        self.region = CroppedRegion.objects.create(
+            processed_image=self.processed_image, class_name='xray_region', confidence=0.9,
+            x1=0, y1=0, x2=10, y2=10, cropped_image_data=b'\x00' * 32, original_filename='crop.jpg'
+        )
+        self.cache_key = f"decrypted_region_{self.region.id}"
+        CroppedRegion._decrypted_cache.set(self.cache_key, b'plaintext')
+
+    def test_reencrypting_region_invalidates_cache(self):
+        self.region.cropped_image_data = b'\x01' * 32
+        self.region.save(update_fields=['cropped_image_data'])
+        self.assertNotIn(self.cache_key, CroppedRegion._decrypted_cache)
+
+    def test_deleting_region_invalidates_cache(self):
+        self.region.delete()
+        self.assertNotIn(self.cache_key, CroppedRegion._decrypted_cache)
+
+
+class ImageVersionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        patient = Patient.objects.create(id='P2', name='Test', age=40)
+        self.processed_image = ProcessedImage.objects.create(
+            patient=patient, blurred_image='blurred.jpg', grid_image='grid.jpg'
+        )
+
+    def test_version_is_stable_between_changes(self):
+        key = restored_image_cache_key(self.processed_image.id)
+        self.assertEqual(restored_image_cache_key(self.processed_image.id), key)
+
+    def test_timing_updates_do_not_bump_version(self):
+        version = get_image_version(self.processed_image.id)
+        self.processed_image.decryption_time = 12.5
+        self.processed_image.save(update_fields=['decryption_time'])
+        self.assertEqual(get_image_version(self.processed_image.id), version)
+
+    def test_region_changes_bump_version(self):
+        version = get_image_version(self.processed_image.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            region = CroppedRegion.objects.create(
+                processed_image=self.processed_image, class_name='xray_region', confidence=0.9,
+                x1=0, y1=0, x2=10, y2=10, cropped_image_data=b'\x00' * 32, original_filename='crop.jpg'
+            )
+            # Restores running before the commit keep the old stamp
+            self.assertEqual(get_image_version(self.processed_image.id), version)
+        after_create = get_image_version(self.processed_image.id)
+        self.assertNotEqual(after_create, version)
+        with self.captureOnCommitCallbacks(execute=True):
+            region.delete()
+        self.assertNotEqual(get_image_version(self.processed_image.id), after_create)
+
+    def test_rolled_back_change_keeps_version(self):
+        version = get_image_version(self.processed_image.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    self.processed_image.enhanced = True
+                    self.processed_image.save()
+                    raise RuntimeError('roll back')
+            except RuntimeError:
+                pass
+        self.assertEqual(get_image_version(self.processed_image.id), version)
+
+
+class PatientImageViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        # Region ids are reused across tests, so drop plaintext cached by earlier ones
+        CroppedRegion._decrypted_cache.clear()
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(
+            MEDIA_ROOT=self.media_root, RAW_PIXEL_CACHE_DIR=f"{self.media_root}/raw"
+        )
+        self.settings_override.enable()
+        
+        # A small blurred image with no encrypted regions
+        blurred = np.full((40, 60, 3), 120, dtype=np.uint8)
+        cv2.imwrite(f"{self.media_root}/blurred.png", blurred)
+        
+        self.patient = Patient.objects.create(id='P3', name='Test', age=40)
+        self.processed_image = ProcessedImage.objects.create(
+            patient=self.patient, blurred_image='blurred.png', grid_image='grid.png'
+        )
+        doctor = get_user_model().objects.create_user(
+            email='doctor@example.com', password='testpassword123', role='DOCTOR'
+        )
+        self.client = APIClient()
+        self.doctor = doctor
+        self.client.force_authenticate(doctor)
+        self.url = reverse('patient-image', kwargs={'patient_id': self.patient.id})
+
+    def tearDown(self):
+        decryption_timings.reset()
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def test_returns_png_with_etag(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertTrue(response['ETag'])
+        content = b''.join(response.streaming_content)
+        self.assertEqual(int(response['Content-Length']), len(content))
+        decoded = cv2.imdecode(np.frombuffer(content, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        self.assertEqual(decoded.shape, (40, 60, 3))
+
+    def test_if_none_match_returns_304(self):
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    def test_new_version_changes_etag(self):
+        etag = self.client.get(self.url)['ETag']
+        self.processed_image.enhanced = True
+        with self.captureOnCommitCallbacks(execute=True):
+            self.processed_image.save()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_failed_restore_is_not_cacheable(self):
+        encrypted, _ = encrypt_image(pack_raw_pixels(np.zeros((10, 20, 3), dtype=np.uint8)))
+        CroppedRegion.objects.create(
+            processed_image=self.processed_image, class_name='xray_region', confidence=0.9,
+            x1=5, y1=5, x2=25, y2=15, cropped_image_data=encrypted,
+            original_filename='crop.jpg', image_format='RAW'
+        )
+        restore_url = reverse('restore-image', kwargs={'processed_image_id': self.processed_image.id})
+        with mock.patch.object(CroppedRegion, 'get_decrypted_image', return_value=None):
+            for url in (self.url, restore_url):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertNotIn('ETag', response)
+                self.assertEqual(response['Cache-Control'], 'no-store')
+        
+        # Once decryption works again the restored image is served with an ETag
+        response = self.client.get(self.url)
+        self.assertTrue(response['ETag'])
+
+    def test_partially_failed_restore_is_not_cacheable(self):
+        regions = []
+        for x1 in (5, 30):
+            encrypted, _ = encrypt_image(pack_raw_pixels(np.zeros((10, 20, 3), dtype=np.uint8)))
+            regions.append(CroppedRegion.objects.create(
+                processed_image=self.processed_image, class_name='xray_region', confidence=0.9,
+                x1=x1, y1=5, x2=x1 + 20, y2=15, cropped_image_data=encrypted,
+                original_filename='crop.jpg', image_format='RAW'
+            ))
+        get_decrypted_image = CroppedRegion.get_decrypted_image
+
+        def fail_second_region(region):
+            return None if region.id == regions[1].id else get_decrypted_image(region)
+
+        with mock.patch.object(CroppedRegion, 'get_decrypted_image', autospec=True,
+                               side_effect=fail_second_region):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('ETag', response)
+        self.assertEqual(response['Cache-Control'], 'no-store')
+
+        # The partial frame was not cached, so the next request restores both regions
+        response = self.client.get(self.url)
+        self.assertTrue(response['ETag'])
+        decoded = cv2.imdecode(np.frombuffer(b''.join(response.streaming_content), dtype=np.uint8),
+                               cv2.IMREAD_UNCHANGED)
+        self.assertEqual(decoded[10, 35].tolist(), [0, 0, 0])
+
+    def test_plaintext_stays_out_of_shared_cache(self):
+        encrypted, _ = encrypt_image(pack_raw_pixels(np.zeros((10, 20, 3), dtype=np.uint8)))
+        CroppedRegion.objects.create(
+            processed_image=self.processed_image, class_name='xray_region', confidence=0.9,
+            x1=5, y1=5, x2=25, y2=15, cropped_image_data=encrypted,
+            original_filename='crop.jpg', image_format='RAW'
+        )
+        restore_url = reverse('restore-image', kwargs={'processed_image_id': self.processed_image.id})
+        backend = type(caches['default'])
+        with mock.patch.object(backend, 'set', autospec=True, side_effect=backend.set) as cache_set, \
+                mock.patch.object(backend, 'add', autospec=True, side_effect=backend.add) as cache_add:
+            for response in (self.client.get(self.url), self.client.get(restore_url),
+                             self.client.get(self.url, {'delivery': 'regions'})):
+                self.assertEqual(response.status_code, 200)
+
+        # Only the version stamp and single-flight lock tokens reach the shared
+        # cache; the results are cached in this process
+        written = {call.args[1]: call.args[2] for call in cache_set.call_args_list + cache_add.call_args_list}
+        self.assertIn(f"image_version:{self.processed_image.id}", written)
+        for key, value in written.items():
+            self.assertTrue(key.startswith(('image_version:', 'singleflight:')), key)
+            self.assertIsInstance(value, str)
+            self.assertLessEqual(len(value), 32)
+        self.assertGreater(len(restored_cache), 0)
+
+    def test_range_requests(self):
+        full = b''.join(self.client.get(self.url).streaming_content)
+        response = self.client.get(self.url, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{len(full)}')
+        self.assertEqual(b''.join(response.streaming_content), full[10:20])
+        
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-5')
+        self.assertEqual(b''.join(response.streaming_content), full[-5:])
+        
+        response = self.client.get(self.url, HTTP_RANGE=f'bytes={len(full)}-')
+        self.assertEqual(response.status_code, 416)
+        
+        # A stale If-Range gets the full, current image
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_region_delivery_returns_regions_for_client_compositing(self):
+        crop = np.random.RandomState(3).randint(0, 255, (10, 20, 3), dtype=np.uint8)
+        encrypted, _ = encrypt_image(pack_raw_pixels(crop))
+        region = CroppedRegion.objects.create(
+            processed_image=self.processed_image, class_name='xray_region', confidence=0.9,
+            x1=5, y1=5, x2=25, y2=15, cropped_image_data=encrypted,
+            original_filename='crop.jpg', image_format='RAW'
+        )
+        response = self.client.get(self.url, {'delivery': 'regions'})
+        self.assertEqual(response.status_code, 200)
+        payload = response.json()
+        self.assertTrue(payload['blurred_image_url'].endswith('/blurred.png'))
+        self.assertEqual(len(payload['regions']), 1)
+        entry = payload['regions'][0]
+        self.assertEqual((entry['id'], entry['x1'], entry['y2']), (region.id, 5, 15))
+        decoded = cv2.imdecode(np.frombuffer(base64.b64decode(entry['data']), dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        np.testing.assert_array_equal(decoded, crop)
+        
+        response = self.client.get(self.url, {'delivery': 'regions'}, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_region_delivery_with_failed_regions_is_not_cacheable(self):
+        encrypted, _ = encrypt_image(pack_raw_pixels(np.zeros((10, 20, 3), dtype=np.uint8)))
+        region = CroppedRegion.objects.create(
+            processed_image=self.processed_image, class_name='xray_region', confidence=0.9,
+            x1=5, y1=5, x2=25, y2=15, cropped_image_data=encrypted,
+            original_filename='crop.jpg', image_format='RAW'
+        )
+        with mock.patch.object(CroppedRegion, 'get_decrypted_image', return_value=None):
+            response = self.client.get(self.url, {'delivery': 'regions'})
+        self.assertEqual(response.json()['failed_regions'], [region.id])
+        self.assertNotIn('ETag', response)
+        self.assertEqual(response['Cache-Control'], 'no-store')
+        
+        response = self.client.get(self.url, {'delivery': 'regions'})
+        self.assertEqual(len(response.json()['regions']), 1)
+        self.assertTrue(response['ETag'])
+
+    def test_e2e_delivery_wraps_regions_under_user_key(self):
+        crop = np.random.RandomState(4).randint(0, 255, (10, 20, 3), dtype=np.uint8)
+        encrypted, _ = encrypt_image(pack_raw_pixels(crop))
+        CroppedRegion.objects.create(
+            processed_image=self.processed_image, class_name='xray_region', confidence=0.9,
+            x1=5, y1=5, x2=25, y2=15, cropped_image_data=encrypted,
+            original_filename='crop.jpg', image_format='RAW'
+        )
+        with mock.patch('patients.utils.load_encryption_keys_from_file', return_value={}):
+            response = self.client.get(self.url, {'delivery': 'e2e'})
+        self.assertEqual(response.status_code, 409)
+        
+        key = bytes(range(32))
+        cache.set(f"encryption_key_{self.doctor.id}", base64.b64encode(key).decode())
+        payload = self.client.get(self.url, {'delivery': 'e2e'}).json()
+        self.assertEqual(payload['encryption']['algorithm'], 'AES-GCM')
+        
+        wrapped = base64.b64decode(payload['regions'][0]['data'])
+        cipher = AES.new(key, AES.MODE_GCM, nonce=wrapped[:12])
+        plaintext = cipher.decrypt_and_verify(wrapped[12:-16], wrapped[-16:])
+        decoded = cv2.imdecode(np.frombuffer(plaintext, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        np.testing.assert_array_equal(decoded, crop)
+        
+        # The wrapped blob is reused rather than re-encrypted on the next view
+        again = self.client.get(self.url, {'delivery': 'e2e'}).json()
+        self.assertEqual(again['regions'][0]['data'], payload['regions'][0]['data'])
+
+    def test_accept_header_selects_webp(self):
+        response = self.client.get(self.url, HTTP_ACCEPT='image/webp,image/*;q=0.8')
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        self.assertEqual(response['Vary'], 'Accept')
+        png_etag = self.client.get(self.url)['ETag']
+        self.assertNotEqual(response['ETag'], png_etag)
+
+    def test_restore_endpoint_honours_format_and_quality(self):
+        url = reverse('restore-image', kwargs={'processed_image_id': self.processed_image.id})
+        response = self.client.get(url, {'format': 'jpg', 'quality': 80})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertTrue(response['Content-Disposition'].endswith('.jpg"'))
+
+    def test_restore_endpoint_rejects_invalid_quality(self):
+        url = reverse('restore-image', kwargs={'processed_image_id': self.processed_image.id})
+        for params in ({'format': 'jpg', 'quality': 1000}, {'format': 'jpg', 'quality': 'high'},
+                       {'format': 'png', 'compression': 12}):
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('Quality', response.json()['error'])
+
+    def test_similarity_is_only_computed_on_request(self):
+        metrics = {'similarity': 0.9}
+        with mock.patch('patients.utils.calculate_restoration_similarity', return_value=metrics) as calc:
+            response = self.client.get(self.url)
+            self.assertNotIn('X-Image-Similarity', response)
+            calc.assert_not_called()
+            
+            response = self.client.get(self.url, {'similarity': 'true'})
+            self.assertIn('"similarity": 0.9', response['X-Image-Similarity'])
+            # Metrics are persisted for the version, so asking again is free
+            self.client.get(self.url, {'similarity': 'true'})
+            self.assertEqual(calc.call_count, 1)
+
+    def test_similarity_reuses_the_restored_pixels(self):
+        with mock.patch('patients.utils.calculate_restoration_similarity', return_value={'similarity': 0.9}), \
+                mock.patch('patients.utils.restore_from_cropped', wraps=restore_from_cropped) as restore:
+            response = self.client.get(self.url, {'similarity': 'true'})
+        self.assertIn('"similarity": 0.9', response['X-Image-Similarity'])
+        self.assertEqual(restore.call_count, 1)
+
+
+class RawCropPayloadTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        # Region ids are reused across tests, so drop plaintext cached by earlier ones
+        CroppedRegion._decrypted_cache.clear()
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(
+            MEDIA_ROOT=self.media_root, RAW_PIXEL_CACHE_DIR=f"{self.media_root}/raw"
+        )
+        self.settings_override.enable()
+        cv2.imwrite(f"{self.media_root}/blurred.png", np.zeros((40, 60, 3), dtype=np.uint8))
+        patient = Patient.objects.create(id='P4', name='Test', age=40)
+        self.processed_image = ProcessedImage.objects.create(
+            patient=patient, blurred_image='blurred.png', grid_image='grid.png'
+        )
+        self.crop = np.random.RandomState(1).randint(0, 255, (10, 20, 3), dtype=np.uint8)
+
+    def tearDown(self):
+        decryption_timings.reset()
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def add_region(self, payload, image_format, x1, y1):
+        encrypted, _ = encrypt_image(payload)
+        return CroppedRegion.objects.create(
+            processed_image=self.processed_image, class_name='xray_region', confidence=0.9,
+            x1=x1, y1=y1, x2=x1 + 20, y2=y1 + 10, cropped_image_data=encrypted,
+            original_filename='crop.jpg', image_format=image_format
+        )
+
+    def test_pack_unpack_round_trip(self):
+        for level in (0, 1):
+            unpacked = unpack_raw_pixels(pack_raw_pixels(self.crop, compress_level=level))
+            np.testing.assert_array_equal(unpacked, self.crop)
+        gray = self.crop[:, :, 0].astype(np.uint16)
+        np.testing.assert_array_equal(unpack_raw_pixels(pack_raw_pixels(gray)), gray)
+
+    def test_raw_payload_passes_decrypt_header_check(self):
+        encrypted, _ = encrypt_image(pack_raw_pixels(self.crop))
+        decrypted, _ = decrypt_image(encrypted)
+        self.assertTrue(is_raw_pixel_payload(decrypted))
+
+    def test_restore_pastes_raw_and_legacy_jpeg_regions(self):
+        self.add_region(pack_raw_pixels(self.crop), 'RAW', 0, 0)
+        _, jpeg = cv2.imencode('.jpg', np.full((10, 20, 3), 200, dtype=np.uint8))
+        self.add_region(jpeg.tobytes(), 'JPEG', 30, 20)
+
+        restored, filename, data = restore_from_cropped(self.processed_image.id, cache_policy=CachePolicy.BYPASS)
+
+        self.assertTrue(filename.startswith('restored_'))
+        self.assertEqual(data['decrypted_regions'], 2)
+        # Raw payloads are bit-exact; the JPEG region is only close
+        np.testing.assert_array_equal(restored[0:10, 0:20], self.crop)
+        self.assertAlmostEqual(restored[20:30, 30:50].mean(), 200, delta=2)
+
+
+@override_settings(DEEPZOOM_TILE_SIZE=256)
+class DeepZoomTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        # Region ids are reused across tests, so drop plaintext cached by earlier ones
+        CroppedRegion._decrypted_cache.clear()
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(
+            MEDIA_ROOT=self.media_root, RAW_PIXEL_CACHE_DIR=f"{self.media_root}/raw"
+        )
+        self.settings_override.enable()
+        cv2.imwrite(f"{self.media_root}/blurred.png", np.full((400, 600, 3), 50, dtype=np.uint8))
+        patient = Patient.objects.create(id='P5', name='Test', age=40)
+        self.processed_image = ProcessedImage.objects.create(
+            patient=patient, blurred_image='blurred.png', grid_image='grid.png'
+        )
+        self.crop = np.random.RandomState(2).randint(0, 255, (20, 40, 3), dtype=np.uint8)
+        encrypted, _ = encrypt_image(pack_raw_pixels(self.crop))
+        CroppedRegion.objects.create(
+            processed_image=self.processed_image, class_name='xray_region', confidence=0.9,
+            x1=300, y1=200, x2=340, y2=220, cropped_image_data=encrypted,
+            original_filename='crop.jpg', image_format='RAW'
+        )
+        doctor = get_user_model().objects.create_user(
+            email='doctor@example.com', password='testpassword123', role='DOCTOR'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(doctor)
+
+    def tearDown(self):
+        decryption_timings.reset()
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def render(self, level, col, row):
+        regions = self.processed_image.cropped_regions.defer('cropped_image_data')
+        return render_tile(self.processed_image, level, col, row, regions)
+
+    def test_only_intersecting_tiles_decrypt_regions(self):
+        # 600x400 has 11 levels; level 10 is full resolution
+        tile, decrypted, failed = self.render(10, 0, 0)
+        self.assertEqual((decrypted, failed), (0, []))
+        self.assertEqual(tile.shape, (256, 256, 3))
+        self.assertTrue((tile == 50).all())
+        
+        tile, decrypted, failed = self.render(10, 1, 0)
+        self.assertEqual((decrypted, failed), (1, []))
+        np.testing.assert_array_equal(tile[200:220, 44:84], self.crop)
+
+    def test_lower_levels_are_downscaled(self):
+        tile, _, _ = self.render(9, 0, 0)
+        self.assertEqual(tile.shape, (200, 256, 3))
+        self.assertIsNone(self.render(9, 2, 0)[0])
+
+    def test_cached_levels_are_not_decoded_again(self):
+        self.render(9, 1, 0)
+        with mock.patch('patients.tiles.load_image_pixels') as load:
+            tile, decrypted, _ = self.render(9, 0, 0)
+        load.assert_not_called()
+        self.assertEqual((tile.shape, decrypted), ((200, 256, 3), 1))
+
+    def test_descriptor_and_tile_endpoints(self):
+        with mock.patch('patients.tiles.load_image_pixels') as load:
+            response = self.client.get(
+                reverse('deepzoom-descriptor', kwargs={'processed_image_id': self.processed_image.id})
+            )
+        load.assert_not_called()
+        self.assertContains(response, 'Width="600" Height="400"')
+        
+        kwargs = {'processed_image_id': self.processed_image.id, 'level': 10, 'col': 1, 'row': 0}
+        response = self.client.get(reverse('deepzoom-tile', kwargs={**kwargs, 'img_format': 'png'}))
+        self.assertEqual(response['Content-Type'], 'image/png')
+        response = self.client.get(reverse('deepzoom-tile', kwargs={**kwargs, 'row': 5, 'img_format': 'png'}))
+        self.assertEqual(response.status_code, 404)
+
+    def test_tiles_with_failed_regions_are_not_cached(self):
+        url = reverse('deepzoom-tile', kwargs={
+            'processed_image_id': self.processed_image.id, 'level': 10, 'col': 1, 'row': 0, 'img_format': 'png'
+        })
+        with mock.patch.object(CroppedRegion, 'get_decrypted_image', return_value=None):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('ETag', response)
+        self.assertEqual(response['Cache-Control'], 'no-store')
+        
+        # The next request renders the tile again and restores the region
+        response = self.client.get(url)
+        self.assertTrue(response['ETag'])
+        tile = cv2.imdecode(np.frombuffer(b''.join(response.streaming_content), dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        np.testing.assert_array_equal(tile[200:220, 44:84], self.crop)
+
+
+@override_settings(DEEPZOOM_TILE_SIZE=256)
+class PatientGalleryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        CroppedRegion._decrypted_cache.clear()
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(
+            MEDIA_ROOT=self.media_root, RAW_PIXEL_CACHE_DIR=f"{self.media_root}/raw"
+        )
+        self.settings_override.enable()
+        cv2.imwrite(f"{self.media_root}/wide.png", np.full((300, 1000, 3), 80, dtype=np.uint8))
+        cv2.imwrite(f"{self.media_root}/small.png", np.full((100, 120, 3), 80, dtype=np.uint8))
+        self.patient = Patient.objects.create(id='P6', name='Test', age=40)
+        self.images = [
+            ProcessedImage.objects.create(patient=self.patient, blurred_image=name, grid_image='grid.png')
+            for name in ('wide.png', 'small.png')
+        ]
+        doctor = get_user_model().objects.create_user(
+            email='doctor@example.com', password='testpassword123', role='DOCTOR'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(doctor)
+        self.url = reverse('patient-gallery', kwargs={'patient_id': self.patient.id})
+
+    def tearDown(self):
+        decryption_timings.reset()
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def thumbnail(self, entry):
+        data = base64.b64decode(entry['thumbnail']['data'])
+        return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+
+    @override_settings(GALLERY_MAX_WORKERS=1)
+    def test_gallery_returns_thumbnails_with_restored_regions(self):
+        encrypted, _ = encrypt_image(pack_raw_pixels(np.full((100, 200, 3), 255, dtype=np.uint8)))
+        CroppedRegion.objects.create(
+            processed_image=self.images[0], class_name='xray_region', confidence=0.9,
+            x1=0, y1=0, x2=200, y2=100, cropped_image_data=encrypted,
+            original_filename='crop.jpg', image_format='RAW'
+        )
+        payload = self.client.get(self.url).json()
+        self.assertEqual(payload['count'], 2)
+        by_id = {entry['id']: entry for entry in payload['images']}
+        
+        wide = by_id[self.images[0].id]
+        self.assertEqual((wide['width'], wide['height'], wide['regions']), (1000, 300, 1))
+        thumbnail = self.thumbnail(wide)
+        self.assertLessEqual(max(thumbnail.shape[:2]), 256)
+        # The region covers the top-left fifth of the image and is restored in the thumbnail
+        self.assertGreater(thumbnail[:10, :20].mean(), 240)
+        self.assertLess(thumbnail[-10:, -20:].mean(), 100)
+        self.assertIn('timing_ms', wide)
+        self.assertIn('thumbnail_url', wide)
+
+    @override_settings(GALLERY_MAX_WORKERS=1)
+    def test_each_image_is_decoded_at_most_once(self):
+        with mock.patch('patients.tiles.load_image_pixels', wraps=load_image_pixels) as load:
+            self.client.get(self.url)
+            self.assertEqual(load.call_count, len(self.images))
+            # Sizes and thumbnails are cached per version after the first request
+            self.client.get(self.url)
+            self.assertEqual(load.call_count, len(self.images))
+
+    @override_settings(GALLERY_MAX_WORKERS=4)
+    def test_gallery_renders_on_thread_pool(self):
+        payload = self.client.get(self.url, {'size': 64}).json()
+        for entry in payload['images']:
+            self.assertNotIn('error', entry)
+            self.assertLessEqual(max(self.thumbnail(entry).shape[:2]), 64)
+
+
+class EncoderNegotiationTests(SimpleTestCase):
+    def test_explicit_format_wins(self):
+        self.assertEqual(negotiate_format('image/webp', 'jpg'), 'jpeg')
+
+    def test_highest_q_value_wins(self):
+        self.assertEqual(negotiate_format('image/png;q=0.5, image/jpeg'), 'jpeg')
+
+    def test_wildcards_use_server_preference(self):
+        self.assertEqual(negotiate_format('*/*'), 'png')
+        self.assertEqual(negotiate_format(''), 'png')
+        self.assertEqual(negotiate_format('image/webp,*/*;q=0.8'), 'webp')
+
+    def test_encode_image(self):
+        data, content_type = encode_image(np.zeros((8, 8, 3), dtype=np.uint8), 'webp')
+        self.assertEqual(content_type, 'image/webp')
+        self.assertEqual(cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED).shape, (8, 8, 3))
+
+    def test_quality_is_validated_per_format(self):
+        self.assertEqual(resolve_encoding('jpg', '80'), ('jpeg', 80))
+        self.assertEqual(resolve_encoding('webp', 101), ('webp', 101))
+        for img_format, quality in (('png', 10), ('jpeg', 0), ('jpeg', 101), ('webp', '1e3'), ('png', '')):
+            with self.assertRaises(ValueError):
+                resolve_encoding(img_format, quality)
+
+
+class RawPixelCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(RAW_PIXEL_CACHE_DIR=f"{self.tmp_dir}/raw")
+        self.settings_override.enable()
+        self.image_path = f"{self.tmp_dir}/blurred.png"
+        self.pixels = np.random.RandomState(0).randint(0, 255, (30, 50, 3), dtype=np.uint8)
+        cv2.imwrite(self.image_path, self.pixels)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def test_second_load_maps_raw_copy_read_only(self):
+        np.testing.assert_array_equal(load_image_pixels(self.image_path), self.pixels)
+        mapped = load_image_pixels(self.image_path)
+        np.testing.assert_array_equal(mapped, self.pixels)
+        self.assertFalse(mapped.flags.writeable)
+        self.assertIsInstance(mapped.base, np.memmap)
+
+    def test_writable_mapping_does_not_modify_cached_copy(self):
+        load_image_pixels(self.image_path)
+        restored = load_image_pixels(self.image_path, writable=True)
+        restored[0:10, 0:10] = 0
+        np.testing.assert_array_equal(load_image_pixels(self.image_path), self.pixels)
+
+    def test_replaced_image_is_not_served_from_stale_copy(self):
+        load_image_pixels(self.image_path)
+        replacement = np.zeros((30, 50, 3), dtype=np.uint8)
+        cv2.imwrite(self.image_path, replacement)
+        os.utime(self.image_path, ns=(0, 0))
+        np.testing.assert_array_equal(load_image_pixels(self.image_path), replacement)
+
+
+    def test_least_recently_used_copies_are_pruned_beyond_budget(self):
+        raw_dir = settings.RAW_PIXEL_CACHE_DIR
+        other_path = f"{self.tmp_dir}/other.png"
+        cv2.imwrite(other_path, self.pixels[::-1])
+        load_image_pixels(self.image_path)
+        [first_copy] = os.listdir(raw_dir)
+        # Mark the first copy as used long ago, so the second one is newer
+        os.utime(os.path.join(raw_dir, first_copy), ns=(0, 0))
+        
+        with override_settings(RAW_PIXEL_CACHE_MAX_BYTES=os.path.getsize(os.path.join(raw_dir, first_copy))):
+            load_image_pixels(other_path)
+        self.assertNotIn(first_copy, os.listdir(raw_dir))
+        self.assertIsInstance(load_image_pixels(other_path).base, np.memmap)
+        # The evicted image is decoded again
+        np.testing.assert_array_equal(load_image_pixels(self.image_path), self.pixels)
+        self.assertEqual(prune_raw_pixel_cache(max_bytes=0), 2)
+        self.assertEqual(os.listdir(raw_dir), [])
+
+class SingleFlightTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_concurrent_callers_share_one_computation(self):
+        flight = SingleFlight()
+        calls = []
+        results = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return 'restored'
+
+        threads = [threading.Thread(target=lambda: results.append(flight.do('img:1:v1', compute)))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['restored'] * 5)
+
+    def test_workers_restore_one_at_a_time(self):
+        # Two SingleFlights stand in for two workers, each with its own cache
+        worker_a, worker_b = SingleFlight(poll_interval=0.01), SingleFlight(poll_interval=0.01)
+        spans = []
+
+        def compute():
+            start = time.monotonic()
+            time.sleep(0.2)
+            spans.append((start, time.monotonic()))
+            return 'restored'
+
+        thread = threading.Thread(target=worker_a.do, args=('img:1:v1', compute), kwargs={'reread': lambda: None})
+        thread.start()
+        time.sleep(0.05)
+        self.assertEqual(worker_b.do('img:1:v1', compute, reread=lambda: None), 'restored')
+        thread.join()
+
+        # Worker B only started restoring once worker A released the lock
+        self.assertEqual(len(spans), 2)
+        self.assertGreaterEqual(spans[1][0], spans[0][1])
+        self.assertIsNone(cache.get('singleflight:img:1:v1'))
+
+    def test_waiting_worker_rereads_its_own_cache(self):
+        flight = SingleFlight()
+        compute = mock.Mock(return_value='restored')
+        self.assertEqual(flight.do('img:1:v1', compute, reread=lambda: 'cached'), 'cached')
+        compute.assert_not_called()
+
+
+class QueryBudgetTests(TestCase):
+    """
+    Fixed query budgets per read path. The budgets must not grow with the
+    number of images or regions; a failure here usually means a missing
+    select_related/prefetch_related.
+    """
+
+    def setUp(self):
+        cache.clear()
+        CroppedRegion._decrypted_cache.clear()
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(
+            MEDIA_ROOT=self.media_root, RAW_PIXEL_CACHE_DIR=f"{self.media_root}/raw"
+        )
+        self.settings_override.enable()
+        # A time-based flush inside a budget block would add queries
+        decryption_timings.reset()
+        cv2.imwrite(f"{self.media_root}/blurred.png", np.zeros((40, 60, 3), dtype=np.uint8))
+        
+        self.patient = Patient.objects.create(id='P7', name='Test', age=40)
+        encrypted, _ = encrypt_image(pack_raw_pixels(np.full((10, 20, 3), 255, dtype=np.uint8)))
+        self.images = []
+        for _ in range(3):
+            processed_image = ProcessedImage.objects.create(
+                patient=self.patient, blurred_image='blurred.png', grid_image='grid.png'
+            )
+            ImageFingerprint.objects.create(
+                processed_image=processed_image, color_histogram=b'', avg_hash='0' * 16, phash='0' * 16
+            )
+            for offset in (0, 20):
+                CroppedRegion.objects.create(
+                    processed_image=processed_image, class_name='xray_region', confidence=0.9,
+                    x1=offset, y1=0, x2=offset + 20, y2=10, cropped_image_data=encrypted,
+                    original_filename='crop.jpg', image_format='RAW'
+                )
+            self.images.append(processed_image)
+        
+        self.doctor = get_user_model().objects.create_user(
+            email='doctor@example.com', password='testpassword123', role='DOCTOR'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.doctor)
+
+    def tearDown(self):
+        decryption_timings.reset()
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def test_patient_retrieve(self):
+        url = reverse('patient-detail', kwargs={'pk': self.patient.id})
+        with self.assertNumQueries(2):
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_processed_image_list(self):
+        url = reverse('processedimage-list')
+        # Images plus one prefetch for all of their regions
+        with self.assertNumQueries(2):
+            response = self.client.get(url, {'patient_id': self.patient.id})
+        self.assertEqual(len(response.json()['results']), 3)
+        self.assertEqual(len(response.json()['results'][0]['cropped_regions']), 2)
+
+    def test_processed_image_list_without_regions(self):
+        url = reverse('processedimage-list')
+        # No prefetch when the regions are not serialized
+        with self.assertNumQueries(1):
+            response = self.client.get(url, {'include_regions': 'false'})
+        self.assertNotIn('cropped_regions', response.json()['results'][0])
+
+    def test_restore_with_warm_decrypted_cache(self):
+        image = self.images[0]
+        restore_from_cropped(image.id, cache_policy=CachePolicy.BYPASS)
+        # The image and its regions; no per-region parent lookups or saves
+        with self.assertNumQueries(2):
+            restore_from_cropped(image.id, cache_policy=CachePolicy.BYPASS)
+
+    def test_decryption_timing_is_buffered(self):
+        regions = list(CroppedRegion.objects.with_payload())
+        # Decrypting writes nothing; the flush is one read and one bulk update
+        with self.assertNumQueries(0):
+            for region in regions:
+                self.assertIsNotNone(region.get_decrypted_image())
+        self.assertEqual(decryption_timings.pending(), len(regions))
+        with self.assertNumQueries(2):
+            self.assertEqual(decryption_timings.flush(), 3)
+        self.assertGreater(ProcessedImage.objects.get(id=self.images[0].id).decryption_time, 0)
+
+    def test_cached_patient_image(self):
+        url = reverse('patient-image', kwargs={'patient_id': self.patient.id})
+        self.client.get(url)
+        with self.assertNumQueries(2):
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+
+class AdminQueryBudgetTests(TestCase):
+    def setUp(self):
+        patient = Patient.objects.create(id='P8', name='Test', age=40)
+        for _ in range(3):
+            processed_image = ProcessedImage.objects.create(
+                patient=patient, blurred_image='blurred.png', grid_image='grid.png'
+            )
+            ImageFingerprint.objects.create(
+                processed_image=processed_image, color_histogram=b'', avg_hash='0' * 16, phash='0' * 16
+            )
+            for _ in range(2):
+                CroppedRegion.objects.create(
+                    processed_image=processed_image, class_name='xray_region', confidence=0.9,
+                    x1=0, y1=0, x2=20, y2=10, cropped_image_data=b'\x00' * 64,
+                    original_filename='crop.jpg', image_format='RAW'
+                )
+        admin_user = get_user_model().objects.create_superuser(email='admin@example.com', password='testpassword123')
+        self.client.force_login(admin_user)
+
+    def assert_changelist_budget(self, model_name, budget):
+        # Budgets are per page and must not depend on the number of rows
+        url = reverse(f'admin:patients_{model_name}_changelist')
+        with self.assertNumQueries(budget):
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+    # Session, user, list filters, two counts and one joined page query; the
+    # processed image list also reads user ids for the encryption key status
+
+    def test_processed_image_changelist(self):
+        self.assert_changelist_budget('processedimage', 7)
+
+    def test_cropped_region_changelist(self):
+        self.assert_changelist_budget('croppedregion', 7)
+
+    def test_fingerprint_changelist(self):
+        self.assert_changelist_budget('imagefingerprint', 5)
+
+
+class DecryptionTimingTests(TestCase):
+    def setUp(self):
+        patient = Patient.objects.create(id='P9', name='Test', age=40)
+        self.images = [
+            ProcessedImage.objects.create(patient=patient, blurred_image='blurred.png', grid_image='grid.png')
+            for _ in range(2)
+        ]
+
+    def tearDown(self):
+        decryption_timings.reset()
+
+    def test_threshold_flushes_all_images_with_one_bulk_update(self):
+        aggregator = DecryptionTimingAggregator(flush_interval=3600, flush_threshold=3)
+        aggregator.record(self.images[0].id, 10.0)
+        aggregator.record(self.images[1].id, 4.0)
+        self.assertIsNone(ProcessedImage.objects.get(id=self.images[0].id).decryption_time)
+        
+        with self.assertNumQueries(2):
+            aggregator.record(self.images[0].id, 20.0)
+        self.assertEqual(aggregator.pending(), 0)
+        # Samples are folded in arrival order with the usual 0.7/0.3 weighting
+        self.assertAlmostEqual(ProcessedImage.objects.get(id=self.images[0].id).decryption_time, 13.0)
+        self.assertAlmostEqual(ProcessedImage.objects.get(id=self.images[1].id).decryption_time, 4.0)
+
+    def test_interval_flushes_on_next_sample(self):
+        aggregator = DecryptionTimingAggregator(flush_interval=0, flush_threshold=1000)
+        aggregator.record(self.images[0].id, 5.0)
+        self.assertEqual(aggregator.flushes, 1)
+        self.assertAlmostEqual(ProcessedImage.objects.get(id=self.images[0].id).decryption_time, 5.0)
+
+    def test_request_finished_flushes_once_interval_passed(self):
+        aggregator = DecryptionTimingAggregator(flush_interval=3600, flush_threshold=1000)
+        aggregator.record(self.images[0].id, 5.0)
+        self.assertEqual(aggregator.flush_if_due(), 0)
+        aggregator.flush_interval = 0
+        with mock.patch('patients.timing.decryption_timings', aggregator):
+            request_finished.send(sender=self.__class__)
+        self.assertEqual(aggregator.pending(), 0)
+        self.assertAlmostEqual(ProcessedImage.objects.get(id=self.images[0].id).decryption_time, 5.0)
+
+    def test_percentiles_per_image_and_overall(self):
+        aggregator = DecryptionTimingAggregator(flush_interval=3600, flush_threshold=1000)
+        for value in range(1, 101):
+            aggregator.record(self.images[0].id, float(value))
+        aggregator.record(self.images[1].id, 500.0)
+        
+        summary = aggregator.percentiles(self.images[0].id)
+        self.assertEqual(summary['count'], 100)
+        # Log buckets are within 10% of the true value
+        self.assertAlmostEqual(summary['p50_ms'], 50, delta=5)
+        self.assertAlmostEqual(summary['p99_ms'], 99, delta=10)
+        self.assertEqual(aggregator.percentiles()['max_ms'], 500.0)
+        self.assertEqual(aggregator.percentiles(-1), {'count': 0})
+
+    def test_histogram_overflow_reports_max(self):
+        histogram = TimingHistogram(min_ms=1, max_ms=10)
+        histogram.add(1000.0)
+        self.assertEqual(histogram.percentile(50), 1000.0)
+
+
+class PersistProcessedImageTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        self.source = os.path.join(self.media_root, 'source.png')
+        cv2.imwrite(self.source, np.zeros((10, 10, 3), dtype=np.uint8))
+        self.patient = Patient.objects.create(id='P10', name='Test', age=40)
+        self.fingerprint_data = {'color_histogram': b'', 'avg_hash': '0' * 16, 'phash': '0' * 16}
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def build(self):
+        processed_image = ProcessedImage(patient=self.patient, encryption_time=1.5)
+        regions = [
+            CroppedRegion(
+                processed_image=processed_image, class_name='xray_region', confidence=0.9,
+                x1=0, y1=0, x2=5, y2=5, cropped_image_data=b'data', original_filename='crop.png',
+                image_format='RAW'
+            )
+            for _ in range(3)
+        ]
+        files = [('blurred_image', 'blurred.png', self.source), ('grid_image', 'grid.png', self.source)]
+        return processed_image, files, regions
+
+    def stored_files(self):
+        directory = os.path.join(self.media_root, 'patient_images')
+        return [name for _, _, names in os.walk(directory) for name in names]
+
+    def test_writes_all_rows_in_one_transaction(self):
+        processed_image, files, regions = self.build()
+        # Savepoint, image insert, fingerprint insert, one region bulk insert, release
+        with self.assertNumQueries(5):
+            _persist_processed_image(processed_image, files, self.fingerprint_data, regions)
+        self.assertEqual(processed_image.cropped_regions.count(), 3)
+        self.assertTrue(ImageFingerprint.objects.filter(processed_image=processed_image).exists())
+        self.assertEqual(len(self.stored_files()), 2)
+
+    def test_failure_leaves_no_rows_or_files(self):
+        processed_image, files, regions = self.build()
+        with mock.patch.object(CroppedRegion.objects, 'bulk_create', side_effect=RuntimeError('disk full')):
+            with self.assertRaises(RuntimeError):
+                _persist_processed_image(processed_image, files, self.fingerprint_data, regions)
+        self.assertFalse(ProcessedImage.objects.exists())
+        self.assertFalse(ImageFingerprint.objects.exists())
+        self.assertEqual(self.stored_files(), [])
+        self.assertIsNone(processed_image.pk)
+
+
+class RegionBlobStoreTests(TestCase):
+    def setUp(self):
+        CroppedRegion._decrypted_cache.clear()
+        cache.clear()
+        self.blob_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(REGION_BLOB_STORE_DIR=self.blob_dir)
+        self.settings_override.enable()
+        patient = Patient.objects.create(id='P11', name='Test', age=40)
+        self.processed_image = ProcessedImage.objects.create(
+            patient=patient, blurred_image='blurred.png', grid_image='grid.png'
+        )
+        self.plaintext = pack_raw_pixels(np.full((10, 20, 3), 200, dtype=np.uint8))
+        self.encrypted, _ = encrypt_image(self.plaintext)
+
+    def tearDown(self):
+        decryption_timings.reset()
+        self.settings_override.disable()
+        shutil.rmtree(self.blob_dir, ignore_errors=True)
+
+    def make_region(self, encrypted=None, inline=False):
+        region = CroppedRegion(
+            processed_image=self.processed_image, class_name='xray_region', confidence=0.9,
+            x1=0, y1=0, x2=20, y2=10, original_filename='crop.jpg', image_format='RAW'
+        )
+        if inline:
+            region.cropped_image_data = encrypted or self.encrypted
+        else:
+            region.set_encrypted_payload(encrypted or self.encrypted)
+        region.save()
+        return region
+
+    def test_payload_is_stored_by_hash_and_decrypts(self):
+        region = self.make_region()
+        region.refresh_from_db()
+        self.assertEqual(bytes(region.cropped_image_data), b'')
+        self.assertEqual(region.payload_size, len(self.encrypted))
+        self.assertTrue(os.path.exists(blob_path(region.payload_ref)))
+        self.assertEqual(region.get_decrypted_image(), self.plaintext)
+
+    @override_settings(REGION_BLOB_MMAP_THRESHOLD=1)
+    def test_large_blobs_are_memory_mapped(self):
+        ref = put_blob(self.encrypted)
+        data = read_blob(ref)
+        self.assertIsInstance(data, memoryview)
+        self.assertEqual(bytes(data), self.encrypted)
+
+    def test_identical_payloads_share_a_blob_until_both_are_deleted(self):
+        first, second = self.make_region(), self.make_region()
+        self.assertEqual(first.payload_ref, second.payload_ref)
+        path = blob_path(first.payload_ref)
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertTrue(os.path.exists(path))
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+            # The blob outlives the delete until it commits
+            self.assertTrue(os.path.exists(path))
+        self.assertFalse(os.path.exists(path))
+
+    def test_rolled_back_delete_keeps_its_blob(self):
+        region = self.make_region()
+        path = blob_path(region.payload_ref)
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    CroppedRegion.objects.get(id=region.id).delete()
+                    raise RuntimeError('roll back')
+            except RuntimeError:
+                pass
+        self.assertEqual(callbacks, [])
+        self.assertTrue(CroppedRegion.objects.filter(id=region.id).exists())
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(CroppedRegion.objects.get(id=region.id).get_decrypted_image(), self.plaintext)
+
+    def test_command_moves_payloads_out_and_back(self):
+        region = self.make_region(inline=True)
+        call_command('migrate_region_blobs', batch_size=1, stdout=StringIO())
+        region.refresh_from_db()
+        self.assertTrue(region.payload_ref)
+        self.assertEqual(bytes(region.cropped_image_data), b'')
+        self.assertEqual(region.get_decrypted_image(), self.plaintext)
+        
+        call_command('migrate_region_blobs', inline=True, stdout=StringIO())
+        ref = region.payload_ref
+        region.refresh_from_db()
+        self.assertEqual(region.payload_ref, '')
+        self.assertEqual(bytes(region.cropped_image_data), self.encrypted)
+        self.assertFalse(os.path.exists(blob_path(ref)))
+
+
+class RegionMetadataManagerTests(TestCase):
+    def setUp(self):
+        CroppedRegion._decrypted_cache.clear()
+        cache.clear()
+        patient = Patient.objects.create(id='P12', name='Test', age=40)
+        self.processed_image = ProcessedImage.objects.create(
+            patient=patient, blurred_image='blurred.png', grid_image='grid.png'
+        )
+        self.plaintext = pack_raw_pixels(np.full((10, 20, 3), 50, dtype=np.uint8))
+        self.encrypted, _ = encrypt_image(self.plaintext)
+        # Assigned directly: save() still fills the size and header columns
+        self.region = CroppedRegion.objects.create(
+            processed_image=self.processed_image, class_name='xray_region', confidence=0.9,
+            x1=0, y1=0, x2=20, y2=10, cropped_image_data=self.encrypted,
+            original_filename='crop.jpg', image_format='RAW'
+        )
+
+
+    def tearDown(self):
+        decryption_timings.reset()
+    def test_default_queryset_defers_ciphertext(self):
+        region = CroppedRegion.objects.get(id=self.region.id)
+        self.assertIn('cropped_image_data', region.get_deferred_fields())
+        self.assertNotIn('cropped_image_data', CroppedRegion.objects.with_payload().get(id=self.region.id).get_deferred_fields())
+        self.assertNotIn('cropped_image_data', self.processed_image.cropped_regions.with_payload()[0].get_deferred_fields())
+
+    def test_size_and_preview_without_loading_payload(self):
+        region = CroppedRegion.objects.with_payload_size().get(id=self.region.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(region.encrypted_size, len(self.encrypted))
+            self.assertEqual(region.payload_size, len(self.encrypted))
+            self.assertEqual(region.payload_preview(48), self.encrypted[:48])
+
+    def test_rewriting_ciphertext_updates_header(self):
+        encrypted, _ = encrypt_image(self.plaintext)
+        region = CroppedRegion.objects.with_payload().get(id=self.region.id)
+        region.cropped_image_data = encrypted
+        region.save(update_fields=['cropped_image_data'])
+        region = CroppedRegion.objects.get(id=self.region.id)
+        self.assertEqual(bytes(region.payload_header), encrypted[:64])
+        self.assertEqual(region.get_decrypted_image(), self.plaintext)
+
+
+class SeedSyntheticCommandTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        CroppedRegion._decrypted_cache.clear()
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        decryption_timings.reset()
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def seed(self, **options):
+        options = {'patients': 2, 'images_per_patient': 2, 'regions_per_image': 2, 'width': 160,
+                   'height': 120, 'region_size': 40, 'workers': 1, 'seed': 7, **options}
+        call_command('seed_synthetic', stdout=StringIO(), **options)
+
+    def regions(self):
+        return list(CroppedRegion.objects.order_by('processed_image__patient_id', 'id')
+                    .values_list('processed_image__patient_id', 'class_name', 'x1', 'y1', 'x2', 'y2'))
+
+    def test_creates_decryptable_regions_and_fingerprints(self):
+        self.seed()
+        self.assertEqual(Patient.objects.filter(id__startswith='SYN7-').count(), 2)
+        self.assertEqual(ProcessedImage.objects.count(), 4)
+        self.assertEqual(ImageFingerprint.objects.count(), 4)
+        region = CroppedRegion.objects.with_payload().first()
+        self.assertEqual(unpack_raw_pixels(region.get_decrypted_image()).shape, (40, 40, 3))
+
+    def test_same_seed_reproduces_layout_and_reruns_skip_existing_patients(self):
+        self.seed()
+        first = self.regions()
+        self.seed()
+        self.assertEqual(ProcessedImage.objects.count(), 4)
+
+        CroppedRegion.objects.all().delete()
+        ProcessedImage.objects.all().delete()
+        Patient.objects.all().delete()
+        self.seed()
+        self.assertEqual(self.regions(), first)
+
+
+class BenchPipelineCommandTests(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.results_path = os.path.join(self.tmp_dir, 'results.json')
+
+    def tearDown(self):
+        decryption_timings.reset()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def bench(self, **options):
+        options = {'images': 1, 'width': 160, 'height': 120, 'regions_per_image': 1, 'region_size': 40,
+                   'warmup': 0, 'repetitions': 2, 'skip_inference': True, 'json': self.results_path, **options}
+        call_command('bench_pipeline', stdout=StringIO(), **options)
+        with open(self.results_path) as f:
+            return json.load(f)
+
+    def test_reports_every_stage_and_cleans_up(self):
+        results = self.bench()
+        process = results['pipelines']['process_image']
+        restore = results['pipelines']['restore_from_cropped']
+        self.assertEqual(list(process['stages']),
+                         ['decode', 'fingerprint', 'analytics', 'blur', 'grid', 'encrypt', 'persist'])
+        self.assertIn('inference', process['skipped'])
+        self.assertEqual(list(restore['stages']),
+                         ['fetch', 'decrypt', 'decode', 'composite', 'similarity', 'encode'])
+        self.assertEqual(restore['total']['count'], 2)
+        self.assertGreater(results['peak_rss_mb'], 0)
+        self.assertFalse(Patient.objects.exists())
+        self.assertFalse(CroppedRegion.objects.exists())
+
+    def test_fails_on_regression_against_baseline(self):
+        results = self.bench()
+        for pipeline in results['pipelines'].values():
+            pipeline['total']['p50_ms'] /= 100
+        baseline_path = os.path.join(self.tmp_dir, 'baseline.json')
+        with open(baseline_path, 'w') as f:
+            json.dump(results, f)
+
+        with self.assertRaisesMessage(CommandError, 'regressed'):
+            self.bench(baseline=baseline_path)
+        # A generous threshold accepts the same slowdown
+        comparison = self.bench(baseline=baseline_path, threshold=1e9)['comparison']
+        self.assertTrue(comparison)
+        self.assertFalse(any(row['regressed'] for row in comparison))
+
+
+class ProcessedImageListTests(TestCase):
+    def setUp(self):
+        self.patient = Patient.objects.create(id='P12', name='Test', age=40)
+        for _ in range(5):
+            ProcessedImage.objects.create(patient=self.patient, blurred_image='blurred.png', grid_image='grid.png')
+        # Identical timestamps: pages must still neither skip nor repeat rows
+        ProcessedImage.objects.update(created_at=timezone.now())
+        self.url = reverse('processedimage-list')
+        self.client = APIClient()
+        self.client.force_authenticate(get_user_model().objects.create_user(
+            email='doctor@example.com', password='testpassword123', role='DOCTOR'
+        ))
+
+    def test_keyset_pages_cover_every_image_once(self):
+        ids, url, pages = [], self.url + '?page_size=2', []
+        while url:
+            page = self.client.get(url).json()
+            pages.append(page)
+            ids.extend(image['id'] for image in page['results'])
+            url = page['next']
+        expected = list(ProcessedImage.objects.order_by('-id').values_list('id', flat=True))
+        self.assertEqual(ids, expected)
+        self.assertEqual(len(pages), 3)
+
+        previous = self.client.get(pages[2]['previous']).json()
+        self.assertEqual(previous['results'], pages[1]['results'])
+
+    def test_sparse_fieldset(self):
+        response = self.client.get(self.url, {'fields': 'id,created_at'})
+        self.assertEqual(set(response.json()['results'][0]), {'id', 'created_at'})
+        response = self.client.get(self.url, {'fields': 'id,secret'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('secret', response.json()['fields'])
+        for params in ({'fields': ','}, {'fields': 'cropped_regions', 'include_regions': 'false'}):
+            response = self.client.get(self.url, params)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('fields', response.json())
+
+    def test_invalid_cursor(self):
+        cursor = base64.b64encode(b'p=not-a-position').decode()
+        self.assertEqual(self.client.get(self.url, {'cursor': cursor}).status_code, 404)
+
+
+class DatabaseProfileTests(TestCase):
+    def test_sqlite_tuning_is_applied_per_connection(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('SQLite profile only')
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)  # NORMAL
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], int(settings.SQLITE_OPTIONS['timeout'] * 1000))
+        self.assertEqual(connection.transaction_mode, 'IMMEDIATE')
@@ -0,0 +1,253 @@
+"""
+Deep Zoom tile pyramid for restored images.
+
+Level images of the blurred image are kept in a per-process byte-bounded
+LRU, and image sizes are read from the file header, so a tile of a cached
+level never decodes the full image. A tile is cut from the matching level
+image, and only the cropped regions whose boxes intersect the tile are
+decrypted, scaled to the level and pasted. Tiles that touch no region never
+decrypt anything.
+"""
+import logging
+import math
+
+import cv2
+from django.conf import settings
+
+from .cache import ByteLRUCache, deepzoom_tile_cache_key, get_image_version, load_image_pixels, restored_cache
+from .encoders import encode_image
+
+logger = logging.getLogger(__name__)
+
+DEEPZOOM_NAMESPACE = 'http://schemas.microsoft.com/deepzoom/2008'
+
+# Downscaled blurred frames, keyed by image version and level
+_pyramid_cache = ByteLRUCache(
+    max_bytes=getattr(settings, 'DEEPZOOM_PYRAMID_CACHE_BYTES', 128 * 1024 * 1024),
+    sizeof=lambda img: img.nbytes,
+)
+
+# (width, height) of blurred images, keyed by image version; bounded by entry count
+_dimensions_cache = ByteLRUCache(max_bytes=10000, sizeof=lambda dimensions: 1)
+
+
+def tile_size():
+    return getattr(settings, 'DEEPZOOM_TILE_SIZE', 256)
+
+
+def max_level(width, height):
+    """Index of the full-resolution level (level 0 is 1x1)"""
+    return int(math.ceil(math.log2(max(width, height, 1))))
+
+
+def level_dimensions(width, height, level):
+    """Width and height of the image at a pyramid level"""
+    scale = 2 ** (max_level(width, height) - level)
+    return max(1, int(math.ceil(width / scale))), max(1, int(math.ceil(height / scale)))
+
+
+def thumbnail_level(width, height, max_size):
+    """
+    Highest pyramid level whose image fits in max_size x max_size.
+
+    With max_size no larger than the tile size, the thumbnail is tile (0, 0)
+    of that level, so it shares the tile cache and rendering path.
+    """
+    top = max_level(width, height)
+    steps = max(0, int(math.ceil(math.log2(max(width, height) / max_size)))) if max_size > 0 else top
+    return max(0, top - steps)
+
+
+def deepzoom_descriptor(width, height, img_format):
+    """
+    Deep Zoom Image (.dzi) XML describing the pyramid.
+
+    Args:
+        width, height: Full-resolution size of the image
+        img_format: Tile file extension, e.g. 'png' or 'jpg'
+
+    Returns:
+        str: The descriptor document
+    """
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        f'<Image xmlns="{DEEPZOOM_NAMESPACE}" TileSize="{tile_size()}" Overlap="0" Format="{img_format}">'
+        f'<Size Width="{width}" Height="{height}"/>'
+        '</Image>'
+    )
+
+
+def image_dimensions(processed_image, version=None):
+    """
+    Width and height of a ProcessedImage's blurred image.
+
+    Read from the file header (no pixel decode) and cached per image version.
+
+    Returns:
+        Tuple of (width, height), or None if the blurred image cannot be read
+    """
+    if version is None:
+        version = get_image_version(processed_image.id)
+    cache_key = f"{processed_image.id}:{version}"
+    dimensions = _dimensions_cache.get(cache_key)
+    if dimensions is None:
+        try:
+            width, height = processed_image.blurred_image.width, processed_image.blurred_image.height
+        except (OSError, ValueError):
+            return None
+        if not width or not height:
+            return None
+        dimensions = (width, height)
+        _dimensions_cache.set(cache_key, dimensions)
+    return dimensions
+
+
+def get_blurred_level(processed_image, level, version=None):
+    """
+    The blurred image of a ProcessedImage downscaled to a pyramid level.
+
+    The full-resolution level is the memory-mapped raw copy; lower levels are
+    resized with INTER_AREA and cached per image version, so a cached level is
+    served without decoding the full image.
+
+    Returns:
+        numpy.ndarray (read-only) or None if the blurred image cannot be read
+    """
+    if version is None:
+        version = get_image_version(processed_image.id)
+    dimensions = image_dimensions(processed_image, version)
+    if dimensions is None:
+        return None
+    width, height = dimensions
+    if level >= max_level(width, height):
+        return load_image_pixels(processed_image.blurred_image.path)
+
+    cache_key = f"{processed_image.id}:{version}:{level}"
+    level_img = _pyramid_cache.get(cache_key)
+    if level_img is None:
+        full = load_image_pixels(processed_image.blurred_image.path)
+        if full is None:
+            return None
+        level_img = cv2.resize(full, level_dimensions(width, height, level), interpolation=cv2.INTER_AREA)
+        level_img.flags.writeable = False
+        _pyramid_cache.set(cache_key, level_img)
+    return level_img
+
+
+def render_tile(processed_image, level, col, row, regions, version=None):
+    """
+    Render one Deep Zoom tile of the restored image.
+
+    Args:
+        processed_image: The ProcessedImage to render
+        level: Pyramid level (0 is 1x1, max_level is full resolution)
+        col, row: Tile coordinates within the level
+        regions: The image's CroppedRegions (cropped_image_data may be deferred;
+                 it is only loaded for regions that intersect the tile)
+        version: Image version stamp, if already known
+
+    Returns:
+        Tuple of (tile_array, decrypted_region_count, failed_region_ids), or
+        (None, 0, []) if the tile is outside the level or the blurred image
+        cannot be read. Regions that fail to decrypt or decode stay blurred.
+    """
+    from .utils import decode_region_payload
+
+    if version is None:
+        version = get_image_version(processed_image.id)
+    dimensions = image_dimensions(processed_image, version)
+    if dimensions is None:
+        return None, 0, []
+    full_width, full_height = dimensions
+    if level < 0 or level > max_level(full_width, full_height):
+        return None, 0, []
+
+    level_img = get_blurred_level(processed_image, level, version)
+    if level_img is None:
+        return None, 0, []
+    level_height, level_width = level_img.shape[:2]
+    size = tile_size()
+    tx1, ty1 = col * size, row * size
+    tx2, ty2 = min(tx1 + size, level_width), min(ty1 + size, level_height)
+    if col < 0 or row < 0 or tx1 >= level_width or ty1 >= level_height:
+        return None, 0, []
+
+    # Level coordinates map back to full resolution by this factor
+    scale_x = level_width / full_width
+    scale_y = level_height / full_height
+
+    tile = level_img[ty1:ty2, tx1:tx2]
+    decrypted = 0
+    failed = []
+    for region in regions:
+        # Region box at this level, clipped to the tile
+        rx1, ry1 = int(round(region.x1 * scale_x)), int(round(region.y1 * scale_y))
+        rx2, ry2 = int(round(region.x2 * scale_x)), int(round(region.y2 * scale_y))
+        ix1, iy1 = max(rx1, tx1), max(ry1, ty1)
+        ix2, iy2 = min(rx2, tx2), min(ry2, ty2)
+        if ix1 >= ix2 or iy1 >= iy2:
+            continue
+
+        decrypted_data = region.get_decrypted_image()
+        if decrypted_data is None:
+            logger.warning(f"Tile {level}/{col}_{row}: could not decrypt region {region.id}, leaving it blurred")
+            failed.append(region.id)
+            continue
+        try:
+            crop = decode_region_payload(decrypted_data)
+        except ValueError as e:
+            logger.warning(f"Tile {level}/{col}_{row}: invalid payload for region {region.id}: {str(e)}")
+            failed.append(region.id)
+            continue
+        if crop is None:
+            failed.append(region.id)
+            continue
+
+        if (rx2 - rx1, ry2 - ry1) != (crop.shape[1], crop.shape[0]):
+            interpolation = cv2.INTER_AREA if rx2 - rx1 < crop.shape[1] else cv2.INTER_LANCZOS4
+            crop = cv2.resize(crop, (rx2 - rx1, ry2 - ry1), interpolation=interpolation)
+
+        # The level image is shared and read-only; copy the tile on first paste
+        if not tile.flags.writeable:
+            tile = tile.copy()
+        tile[iy1 - ty1:iy2 - ty1, ix1 - tx1:ix2 - tx1] = crop[iy1 - ry1:iy2 - ry1, ix1 - rx1:ix2 - rx1]
+        decrypted += 1
+
+    return tile, decrypted, failed
+
+
+def get_encoded_tile(processed_image_id, version, level, col, row, img_format, load_image):
+    """
+    Encoded tile from this worker's restored-image cache, rendering and caching it on a miss.
+
+    Tiles with regions that could not be restored are returned but not cached,
+    so the next request retries them instead of serving them blurred.
+
+    Args:
+        processed_image_id: ID of the ProcessedImage
+        version: Image version stamp the tile belongs to
+        level, col, row: Tile coordinates
+        img_format: Canonical image format ('png', 'jpeg' or 'webp')
+        load_image: Callable returning (processed_image, regions); only called on a miss
+
+    Returns:
+        dict with 'data', 'content_type' and 'failed_regions' (IDs of intersecting
+        regions left blurred), or None if the tile does not exist
+    """
+    cache_key = deepzoom_tile_cache_key(processed_image_id, version, level, col, row, img_format)
+    encoded = restored_cache.get(cache_key)
+    if encoded is not None:
+        return encoded
+
+    processed_image, regions = load_image()
+    tile, decrypted, failed = render_tile(processed_image, level, col, row, regions, version)
+    if tile is None:
+        return None
+
+    data, content_type = encode_image(tile, img_format)
+    encoded = {'data': data, 'content_type': content_type, 'failed_regions': failed}
+    if not failed:
+        restored_cache.set(cache_key, encoded)
+    logger.debug(f"Rendered tile {level}/{col}_{row} of image {processed_image_id} "
+                 f"({decrypted} regions decrypted)")
+    return encoded
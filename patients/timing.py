@@ -0,0 +1,202 @@
+"""
+Buffered decryption-timing statistics.
+
+Decrypting a region used to write the parent ProcessedImage's decryption_time
+on every cache miss, turning each doctor view into a write transaction. Samples
+are now collected in memory and folded into the database with one bulk_update
+per flush. A flush happens when enough samples are pending, or when the flush
+interval has passed at the next sample or at the end of the next request.
+Samples still pending when a worker exits are dropped; they are statistics,
+and the database may no longer be usable at that point. Per-image and
+process-wide latency histograms are kept for percentile reporting.
+"""
+import bisect
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.dispatch import receiver
+
+logger = logging.getLogger(__name__)
+
+# Weight of a new sample in the persisted moving average
+EMA_WEIGHT = 0.3
+
+
+class TimingHistogram:
+    """
+    Fixed log-scale latency histogram.
+
+    Buckets grow by `growth` from `min_ms` up to `max_ms`, so percentiles are
+    accurate to within one bucket (about 10% with the defaults) while the
+    memory use stays constant regardless of the number of samples.
+    """
+
+    def __init__(self, min_ms=0.01, max_ms=60000.0, growth=1.1):
+        steps = int(math.ceil(math.log(max_ms / min_ms) / math.log(growth)))
+        self._bounds = [min_ms * growth ** i for i in range(steps + 1)]
+        self._counts = [0] * (len(self._bounds) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, value_ms):
+        self._counts[bisect.bisect_left(self._bounds, value_ms)] += 1
+        self.count += 1
+        self.total_ms += value_ms
+        self.max_ms = max(self.max_ms, value_ms)
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p-th percentile, or None if empty"""
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(self.count * p / 100.0)))
+        seen = 0
+        for index, bucket_count in enumerate(self._counts):
+            seen += bucket_count
+            if seen >= rank:
+                # The overflow bucket has no upper bound; report the largest sample
+                return min(self._bounds[index], self.max_ms) if index < len(self._bounds) else self.max_ms
+        return self.max_ms
+
+    def summary(self, percentiles=(50, 90, 99)):
+        if not self.count:
+            return {'count': 0}
+        result = {
+            'count': self.count,
+            'avg_ms': self.total_ms / self.count,
+            'max_ms': self.max_ms,
+        }
+        for p in percentiles:
+            result[f'p{p}_ms'] = self.percentile(p)
+        return result
+
+
+class DecryptionTimingAggregator:
+    """
+    Collect per-image decryption timings and persist them in batches.
+
+    Args:
+        flush_interval: Seconds after which the next sample triggers a flush
+        flush_threshold: Number of pending samples that triggers a flush
+        max_tracked_images: Per-image histograms kept in memory (LRU)
+    """
+
+    def __init__(self, flush_interval=30, flush_threshold=200, max_tracked_images=1024):
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.max_tracked_images = max_tracked_images
+        self._lock = threading.Lock()
+        self._pending = {}  # processed_image_id -> [ms, ...] in arrival order
+        self._pending_count = 0
+        self._last_flush = time.monotonic()
+        self._histograms = OrderedDict()
+        self._overall = TimingHistogram()
+        self.flushes = 0
+
+    def record(self, processed_image_id, elapsed_ms):
+        """Add one decryption timing; may flush pending samples to the database"""
+        with self._lock:
+            self._pending.setdefault(processed_image_id, []).append(elapsed_ms)
+            self._pending_count += 1
+            self._overall.add(elapsed_ms)
+            histogram = self._histograms.get(processed_image_id)
+            if histogram is None:
+                histogram = self._histograms[processed_image_id] = TimingHistogram()
+                if len(self._histograms) > self.max_tracked_images:
+                    self._histograms.popitem(last=False)
+            else:
+                self._histograms.move_to_end(processed_image_id)
+            histogram.add(elapsed_ms)
+
+            due = self._pending_count >= self.flush_threshold or self._interval_passed()
+
+        if due:
+            self.flush()
+
+    def flush_if_due(self):
+        """Flush pending samples once the flush interval has passed; cheap when nothing is due"""
+        with self._lock:
+            due = self._pending_count and self._interval_passed()
+        return self.flush() if due else 0
+
+    def _interval_passed(self):
+        return time.monotonic() - self._last_flush >= self.flush_interval
+
+    def flush(self):
+        """
+        Fold pending samples into ProcessedImage.decryption_time with one bulk_update.
+
+        Returns:
+            int: Number of images updated
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._pending_count = 0
+            self._last_flush = time.monotonic()
+        if not pending:
+            return 0
+
+        from .models import ProcessedImage
+
+        try:
+            images = list(ProcessedImage.objects.filter(id__in=pending).only('id', 'decryption_time'))
+            for image in images:
+                # Same weighting as before: recent decryptions count more, history is kept
+                for elapsed_ms in pending[image.id]:
+                    if not image.decryption_time:
+                        image.decryption_time = elapsed_ms
+                    else:
+                        image.decryption_time = (image.decryption_time * (1 - EMA_WEIGHT)
+                                                 + elapsed_ms * EMA_WEIGHT)
+            # bulk_update sends no post_save; decryption_time is version-neutral anyway
+            ProcessedImage.objects.bulk_update(images, ['decryption_time'])
+        except Exception as e:
+            # Timings are statistics; losing a batch must never fail a request
+            logger.warning(f"Dropping {sum(len(samples) for samples in pending.values())} "
+                           f"decryption timing samples: {str(e)}")
+            return 0
+
+        self.flushes += 1
+        logger.debug(f"Flushed decryption timings for {len(images)} images")
+        return len(images)
+
+    def pending(self, processed_image_id=None):
+        """Number of samples not yet written (for one image or in total)"""
+        with self._lock:
+            if processed_image_id is None:
+                return self._pending_count
+            return len(self._pending.get(processed_image_id, ()))
+
+    def percentiles(self, processed_image_id=None, percentiles=(50, 90, 99)):
+        """Latency summary of one image, or of the whole process when no id is given"""
+        with self._lock:
+            histogram = self._overall if processed_image_id is None else self._histograms.get(processed_image_id)
+            return histogram.summary(percentiles) if histogram is not None else {'count': 0}
+
+    def reset(self):
+        """Drop pending samples and histograms without writing them"""
+        with self._lock:
+            self._pending.clear()
+            self._pending_count = 0
+            self._histograms.clear()
+            self._overall = TimingHistogram()
+            self._last_flush = time.monotonic()
+
+
+# Shared by all decryptions in this process
+decryption_timings = DecryptionTimingAggregator(
+    flush_interval=getattr(settings, 'DECRYPTION_TIMING_FLUSH_INTERVAL', 30),
+    flush_threshold=getattr(settings, 'DECRYPTION_TIMING_FLUSH_THRESHOLD', 200),
+)
+
+
+@receiver(request_finished)
+def flush_decryption_timings(sender, **kwargs):
+    # Samples of the last requests before traffic stops would otherwise wait
+    # for the next decryption
+    decryption_timings.flush_if_due()
@@ -1,6 +1,9 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import PatientViewSet, ProcessedImageViewSet, PatientImageView
+from .views import (
+    PatientViewSet, ProcessedImageViewSet, PatientImageView, RestoreImageView,
+    DeepZoomDescriptorView, DeepZoomTileView, PatientGalleryView,
+)
 
 router = DefaultRouter()
 router.register('', PatientViewSet)
@@ -9,4 +12,9 @@ router.register('processed-images', ProcessedImageViewSet)
 urlpatterns = [
     path('', include(router.urls)),
     path('image/<str:patient_id>/', PatientImageView.as_view(), name='patient-image'),
+    path('gallery/<str:patient_id>/', PatientGalleryView.as_view(), name='patient-gallery'),
+    path('restore/<int:processed_image_id>/', RestoreImageView.as_view(), name='restore-image'),
+    path('deepzoom/<int:processed_image_id>.dzi', DeepZoomDescriptorView.as_view(), name='deepzoom-descriptor'),
+    path('deepzoom/<int:processed_image_id>_files/<int:level>/<int:col>_<int:row>.<str:img_format>',
+         DeepZoomTileView.as_view(), name='deepzoom-tile'),
 ] 
\ No newline at end of file
@@ -13,6 +13,7 @@ from Crypto.Cipher import AES
 from Crypto.Util.Padding import pad, unpad
 from Crypto.Random import get_random_bytes
 import base64
+import binascii
 from django.core.cache import cache
 import pickle
 import imagehash
@@ -22,6 +23,12 @@ import math
 import logging
 import json
 import hashlib
+import struct
+from .encoders import encode_image, resolve_encoding
+from .cache import (
+    ByteLRUCache, CachePolicy, encoded_image_cache_key, get_image_version, load_image_pixels, region_payloads_cache_key,
+    restore_single_flight, restored_cache, restored_image_cache_key, restored_image_etag, similarity_cache_key,
+)
 
 # Encryption settings
 # In production, this should be stored securely (e.g., in environment variables)
@@ -196,7 +203,8 @@ def decrypt_image(encrypted_data, user=None, force_static_key=False):
                 # Check for common image format headers
                 is_jpeg = decrypted_data.startswith(b'\xff\xd8\xff')  # JPEG header
                 is_png = decrypted_data.startswith(b'\x89PNG')       # PNG header
-                is_valid_image = is_jpeg or is_png
+                is_raw = decrypted_data.startswith(RAW_PAYLOAD_MAGIC)  # Raw pixel payload
+                is_valid_image = is_jpeg or is_png or is_raw
                 
                 if not is_valid_image:
                     logger.warning("Decrypted data does not have a valid image header - may be corrupted")
@@ -219,6 +227,107 @@ def decrypt_image(encrypted_data, user=None, force_static_key=False):
         logger.error(traceback.format_exc())
         return None, decryption_time_ms
 
+# Raw crop payloads: a small header followed by the (optionally zlib-compressed)
+# pixel buffer, so restores can paste crops without an image decode.
+# Header: magic, version, compressed flag, dtype code, height, width, channels
+RAW_PAYLOAD_MAGIC = b'MSRAW'
+RAW_PAYLOAD_VERSION = 1
+RAW_PAYLOAD_HEADER = struct.Struct('<5sBBBIIB')
+RAW_PAYLOAD_DTYPES = {1: np.uint8, 2: np.uint16, 3: np.float32}
+
+def is_raw_pixel_payload(data):
+    """Return True if the (decrypted) payload is a raw pixel crop"""
+    return data is not None and bytes(data[:len(RAW_PAYLOAD_MAGIC)]) == RAW_PAYLOAD_MAGIC
+
+def pack_raw_pixels(img, compress_level=0):
+    """
+    Serialize a crop as a raw pixel payload.
+    
+    Args:
+        img: Image array (H x W or H x W x C) of uint8, uint16 or float32
+        compress_level: zlib level; 0 (default) stores the pixels uncompressed,
+                        which is the fastest to restore but the largest to store
+        
+    Returns:
+        bytes: Header followed by the pixel buffer
+    """
+    import zlib
+    
+    dtype_codes = {np.dtype(dtype): code for code, dtype in RAW_PAYLOAD_DTYPES.items()}
+    dtype_code = dtype_codes.get(img.dtype)
+    if dtype_code is None:
+        raise ValueError(f"Unsupported dtype for raw payload: {img.dtype}")
+    
+    height, width = img.shape[:2]
+    channels = img.shape[2] if img.ndim == 3 else 0
+    pixels = np.ascontiguousarray(img).tobytes()
+    compressed = compress_level > 0
+    if compressed:
+        pixels = zlib.compress(pixels, compress_level)
+    
+    header = RAW_PAYLOAD_HEADER.pack(RAW_PAYLOAD_MAGIC, RAW_PAYLOAD_VERSION, int(compressed),
+                                     dtype_code, height, width, channels)
+    return header + pixels
+
+def unpack_raw_pixels(data):
+    """
+    Turn a raw pixel payload back into an image array.
+    
+    Uncompressed payloads are returned as a read-only view of the buffer,
+    compressed ones as a view of the decompressed bytes.
+    
+    Args:
+        data: Payload produced by pack_raw_pixels
+        
+    Returns:
+        numpy.ndarray
+    """
+    import zlib
+    
+    magic, version, compressed, dtype_code, height, width, channels = \
+        RAW_PAYLOAD_HEADER.unpack_from(data)
+    if magic != RAW_PAYLOAD_MAGIC or version != RAW_PAYLOAD_VERSION:
+        raise ValueError("Not a supported raw pixel payload")
+    if dtype_code not in RAW_PAYLOAD_DTYPES:
+        raise ValueError(f"Unknown dtype code in raw payload: {dtype_code}")
+    
+    pixels = memoryview(data)[RAW_PAYLOAD_HEADER.size:]
+    if compressed:
+        pixels = zlib.decompress(pixels)
+    
+    shape = (height, width, channels) if channels else (height, width)
+    return np.frombuffer(pixels, dtype=RAW_PAYLOAD_DTYPES[dtype_code]).reshape(shape)
+
+def decode_region_payload(data, flags=cv2.IMREAD_UNCHANGED):
+    """
+    Decode a decrypted crop payload, raw or JPEG/PNG, into an image array.
+    
+    Returns:
+        numpy.ndarray or None if the payload could not be decoded
+    """
+    if is_raw_pixel_payload(data):
+        img = unpack_raw_pixels(data)
+        if flags == cv2.IMREAD_GRAYSCALE and img.ndim == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        return img
+    return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+
+def region_payload_as_image_file(data, image_format):
+    """
+    Return a decrypted crop payload as browser-displayable image bytes.
+    
+    JPEG/PNG payloads are returned unchanged; raw payloads are encoded as PNG.
+    
+    Returns:
+        Tuple of (image_bytes, format_name) e.g. (b'...', 'png')
+    """
+    if is_raw_pixel_payload(data):
+        success, buffer = cv2.imencode('.png', unpack_raw_pixels(data))
+        if not success:
+            raise ValueError("Could not encode raw crop payload as PNG")
+        return buffer.tobytes(), 'png'
+    return data, (image_format or 'jpeg').lower()
+
 # Model path
 MODEL_PATH = "model/best.pt"
 
@@ -505,6 +614,187 @@ def analyze_data_characteristics(data, name=""):
             "error": str(e)
         }
 
+def measure_original_entropy(original_img, original_data):
+    """
+    Derive the display entropy of an uploaded image.
+    
+    Combines the byte entropy of the file with image statistics and a hash of
+    the first 10KB, so visually similar uploads still get distinct values.
+    
+    Args:
+        original_img: Decoded BGR image array
+        original_data: Raw bytes of the uploaded file
+        
+    Returns:
+        Tuple of (original_entropy on the 1-8 scale, analyze_data_characteristics result)
+    """
+    logger = logging.getLogger(__name__)
+    
+    # Calculate a unique hash for this image to differentiate it from others
+    img_hash = hashlib.md5(original_data[:10000]).hexdigest()  # Use first 10KB to calculate hash
+    
+    # Convert first 4 chars of hash to a number between 0 and 1
+    hash_value = int(img_hash[:4], 16) / 65535  # 0xFFFF
+    
+    # Get basic image stats that contribute to uniqueness
+    img_mean = np.mean(original_img)
+    img_std = np.std(original_img)
+    
+    # Calculate histogram for each channel to detect color distribution uniqueness
+    hist_b = cv2.calcHist([original_img], [0], None, [32], [0, 256])
+    hist_g = cv2.calcHist([original_img], [1], None, [32], [0, 256])
+    hist_r = cv2.calcHist([original_img], [2], None, [32], [0, 256])
+    
+    # Calculate edge count as another measure of complexity
+    gray_img = cv2.cvtColor(original_img, cv2.COLOR_BGR2GRAY)
+    edges = cv2.Canny(gray_img, 100, 200)
+    edge_count = np.count_nonzero(edges)
+    edge_ratio = edge_count / (gray_img.shape[0] * gray_img.shape[1])
+    
+    # Get detailed entropy analysis
+    original_analysis = analyze_data_characteristics(original_data, name="Original Image")
+    original_raw_entropy = original_analysis["entropy"]["raw"]
+    
+    # Create a uniqueness factor based on image characteristics AND hash value
+    # This ensures even identical-looking images get different entropy values
+    color_variance = np.std([np.sum(hist_b), np.sum(hist_g), np.sum(hist_r)]) / 1000
+    texture_factor = edge_ratio * 0.5  # Edge density as texture measure
+    
+    # Use the hash value to create a strong differentiation
+    # Scale it to add/subtract up to 1.5 points of entropy
+    hash_factor = (hash_value - 0.5) * 3.0  # Range: -1.5 to +1.5
+    
+    # Base entropy influenced by image characteristics
+    base_entropy = 5.0 + (img_std / 128.0) + (color_variance * 2) + (texture_factor * 3)
+    
+    # Final entropy is base + hash-based variation
+    # This ensures unique values for each image
+    adjusted_entropy = base_entropy + hash_factor
+    
+    # Ensure it stays in reasonable range (4.0-7.0)
+    adjusted_entropy = min(7.0, max(4.0, adjusted_entropy))
+    
+    # Scale to 1-8 range for UI display (keep values distinct)
+    original_entropy = 1.0 + (adjusted_entropy / 8.0) * 7.0
+    
+    # Log detailed characteristics
+    logger.info(f"Original Image Analysis:")
+    logger.info(f"  - Raw Entropy: {original_raw_entropy:.4f} bits")
+    logger.info(f"  - Adjusted Entropy: {adjusted_entropy:.4f} bits ({original_entropy:.2f} scaled)")
+    logger.info(f"  - Uniqueness factors: StdDev={img_std:.2f}, EdgeRatio={edge_ratio:.4f}, HashFactor={hash_factor:.4f}")
+    logger.info(f"  - Image Hash: {img_hash[:8]}...")
+    logger.info(f"  - Randomness: {original_analysis['randomness']['assessment']}")
+    logger.info(f"  - Unique values: {original_analysis['distribution']['unique_values']}/256")
+    
+    return original_entropy, original_analysis
+
+
+def obscure_region(region_to_blur, rng=None):
+    """
+    Make an image region completely unrecognizable.
+    
+    Two strong Gaussian passes, heavy noise, pixelation and a grey overlay.
+    
+    Args:
+        region_to_blur: BGR numpy array of the region
+        rng: Optional numpy Generator for the noise (for reproducible output)
+    
+    Returns:
+        numpy.ndarray: The obscured region, same shape as the input
+    """
+    h, w = region_to_blur.shape[:2]
+    
+    # Apply multiple passes of strong blur for maximum effect
+    blurred_region = cv2.GaussianBlur(region_to_blur, (201, 201), 100)
+    # Second pass of blur for extreme effect
+    blurred_region = cv2.GaussianBlur(blurred_region, (151, 151), 80)
+    
+    # Add heavy noise to completely obscure details
+    noise = (rng or np.random).normal(0, 40, blurred_region.shape).astype(np.uint8)
+    blurred_region = cv2.add(blurred_region, noise)
+    
+    # Apply extreme pixelation
+    pixel_size = max(25, min(50, w//5))
+    if w > pixel_size and h > pixel_size:
+        temp = cv2.resize(blurred_region, (w//pixel_size, h//pixel_size), interpolation=cv2.INTER_LINEAR)
+        blurred_region = cv2.resize(temp, (w, h), interpolation=cv2.INTER_NEAREST)
+    
+    # Add strong overlay to completely obscure details
+    overlay_color = [150, 150, 150]
+    alpha = 0.75
+    return cv2.addWeighted(blurred_region, 1-alpha, np.full_like(blurred_region, overlay_color), alpha, 0)
+
+
+def _discard_unreferenced_blobs(cropped_regions):
+    """Remove blob-store payloads of unsaved regions that no stored region shares"""
+    from .blobstore import blob_store_dir, delete_blob
+    from .models import CroppedRegion
+    
+    if blob_store_dir() is None:
+        return
+    refs = {region.payload_ref for region in cropped_regions if region.payload_ref}
+    if not refs:
+        return
+    referenced = set(CroppedRegion.objects.filter(payload_ref__in=refs).values_list('payload_ref', flat=True))
+    for ref in refs - referenced:
+        delete_blob(ref)
+
+
+def _persist_processed_image(processed_image, files, fingerprint_data, cropped_regions=()):
+    """
+    Store a processed image's files and write all of its rows in one transaction.
+    
+    The image row, its fingerprint and its regions (via bulk_create) are written
+    inside a single atomic block, so a failure never leaves a half-written
+    record. Files are written to storage first; if the transaction fails, they
+    are deleted again and the exception is re-raised.
+    
+    Args:
+        processed_image: Unsaved ProcessedImage with all scalar fields set
+        files: List of (field_name, stored_name, source_path) for its file fields
+        fingerprint_data: Output of create_image_fingerprint for the original image
+        cropped_regions: Unsaved CroppedRegion instances pointing at processed_image
+    
+    Returns:
+        The saved ProcessedImage
+    """
+    from django.db import transaction
+    from .models import CroppedRegion, ImageFingerprint
+    
+    logger = logging.getLogger(__name__)
+    
+    stored_files = []
+    try:
+        for field_name, stored_name, source_path in files:
+            field_file = getattr(processed_image, field_name)
+            with open(source_path, 'rb') as f:
+                field_file.save(stored_name, ContentFile(f.read()), save=False)
+            stored_files.append(field_file)
+        
+        with transaction.atomic():
+            processed_image.save()
+            ImageFingerprint.objects.create(
+                processed_image=processed_image,
+                color_histogram=fingerprint_data['color_histogram'],
+                avg_hash=fingerprint_data['avg_hash'],
+                phash=fingerprint_data['phash']
+            )
+            if cropped_regions:
+                CroppedRegion.objects.bulk_create(cropped_regions)
+    except Exception:
+        # Leave no orphaned files behind for rows that were rolled back
+        for field_file in stored_files:
+            try:
+                field_file.storage.delete(field_file.name)
+            except Exception as e:
+                logger.warning(f"Could not remove {field_file.name} after a failed save: {str(e)}")
+        _discard_unreferenced_blobs(cropped_regions)
+        processed_image.pk = None
+        raise
+    
+    return processed_image
+
+
 def process_image(image, patient, user=None):
     """
     Process a single image from the lab.
@@ -550,62 +840,7 @@ def process_image(image, patient, user=None):
         # Store the original image entropy for comparison
         with open(temp_image_path, 'rb') as f:
             original_data = f.read()
-            
-            # Calculate a unique hash for this image to differentiate it from others
-            img_hash = hashlib.md5(original_data[:10000]).hexdigest()  # Use first 10KB to calculate hash
-            
-            # Convert first 4 chars of hash to a number between 0 and 1
-            hash_value = int(img_hash[:4], 16) / 65535  # 0xFFFF
-            
-            # Get basic image stats that contribute to uniqueness
-            img_mean = np.mean(original_img)
-            img_std = np.std(original_img)
-            
-            # Calculate histogram for each channel to detect color distribution uniqueness
-            hist_b = cv2.calcHist([original_img], [0], None, [32], [0, 256])
-            hist_g = cv2.calcHist([original_img], [1], None, [32], [0, 256])
-            hist_r = cv2.calcHist([original_img], [2], None, [32], [0, 256])
-            
-            # Calculate edge count as another measure of complexity
-            gray_img = cv2.cvtColor(original_img, cv2.COLOR_BGR2GRAY)
-            edges = cv2.Canny(gray_img, 100, 200)
-            edge_count = np.count_nonzero(edges)
-            edge_ratio = edge_count / (gray_img.shape[0] * gray_img.shape[1])
-            
-            # Get detailed entropy analysis
-            original_analysis = analyze_data_characteristics(original_data, name="Original Image")
-            original_raw_entropy = original_analysis["entropy"]["raw"]
-            
-            # Create a uniqueness factor based on image characteristics AND hash value
-            # This ensures even identical-looking images get different entropy values
-            color_variance = np.std([np.sum(hist_b), np.sum(hist_g), np.sum(hist_r)]) / 1000
-            texture_factor = edge_ratio * 0.5  # Edge density as texture measure
-            
-            # Use the hash value to create a strong differentiation
-            # Scale it to add/subtract up to 1.5 points of entropy
-            hash_factor = (hash_value - 0.5) * 3.0  # Range: -1.5 to +1.5
-            
-            # Base entropy influenced by image characteristics
-            base_entropy = 5.0 + (img_std / 128.0) + (color_variance * 2) + (texture_factor * 3)
-            
-            # Final entropy is base + hash-based variation
-            # This ensures unique values for each image
-            adjusted_entropy = base_entropy + hash_factor
-            
-            # Ensure it stays in reasonable range (4.0-7.0)
-            adjusted_entropy = min(7.0, max(4.0, adjusted_entropy))
-            
-            # Scale to 1-8 range for UI display (keep values distinct)
-            original_entropy = 1.0 + (adjusted_entropy / 8.0) * 7.0
-            
-            # Log detailed characteristics
-            logger.info(f"Original Image Analysis:")
-            logger.info(f"  - Raw Entropy: {original_raw_entropy:.4f} bits")
-            logger.info(f"  - Adjusted Entropy: {adjusted_entropy:.4f} bits ({original_entropy:.2f} scaled)")
-            logger.info(f"  - Uniqueness factors: StdDev={img_std:.2f}, EdgeRatio={edge_ratio:.4f}, HashFactor={hash_factor:.4f}")
-            logger.info(f"  - Image Hash: {img_hash[:8]}...")
-            logger.info(f"  - Randomness: {original_analysis['randomness']['assessment']}")
-            logger.info(f"  - Unique values: {original_analysis['distribution']['unique_values']}/256")
+        original_entropy, original_analysis = measure_original_entropy(original_img, original_data)
         
         # Get model
         model = get_model()
@@ -642,22 +877,10 @@ def process_image(image, patient, user=None):
             cv2.imwrite(blurred_path, original_img)
             
             # Save to model
-            with open(blurred_path, 'rb') as f:
-                processed_image.blurred_image.save(f"blurred_{os.path.basename(image.name)}", ContentFile(f.read()))
-            
-            with open(grid_path, 'rb') as f:
-                processed_image.grid_image.save(f"grid_{os.path.basename(image.name)}", ContentFile(f.read()))
-            
-            processed_image.save()
-            
-            # Save the fingerprint data
-            fingerprint = ImageFingerprint(
-                processed_image=processed_image,
-                color_histogram=fingerprint_data['color_histogram'],
-                avg_hash=fingerprint_data['avg_hash'],
-                phash=fingerprint_data['phash']
-            )
-            fingerprint.save()
+            _persist_processed_image(processed_image, [
+                ('blurred_image', f"blurred_{os.path.basename(image.name)}", blurred_path),
+                ('grid_image', f"grid_{os.path.basename(image.name)}", grid_path),
+            ], fingerprint_data)
             
             # Clean up temp files and directory - including the original
             for file in os.listdir(temp_dir):
@@ -699,22 +922,10 @@ def process_image(image, patient, user=None):
             cv2.imwrite(blurred_path, original_img)
             
             # Save to model
-            with open(blurred_path, 'rb') as f:
-                processed_image.blurred_image.save(f"blurred_{os.path.basename(image.name)}", ContentFile(f.read()))
-            
-            with open(grid_path, 'rb') as f:
-                processed_image.grid_image.save(f"grid_{os.path.basename(image.name)}", ContentFile(f.read()))
-            
-            processed_image.save()
-            
-            # Save the fingerprint data
-            fingerprint = ImageFingerprint(
-                processed_image=processed_image,
-                color_histogram=fingerprint_data['color_histogram'],
-                avg_hash=fingerprint_data['avg_hash'],
-                phash=fingerprint_data['phash']
-            )
-            fingerprint.save()
+            _persist_processed_image(processed_image, [
+                ('blurred_image', f"blurred_{os.path.basename(image.name)}", blurred_path),
+                ('grid_image', f"grid_{os.path.basename(image.name)}", grid_path),
+            ], fingerprint_data)
             
             # Clean up temp files and directory - including the original
             for file in os.listdir(temp_dir):
@@ -781,28 +992,7 @@ def process_image(image, patient, user=None):
             })
             
             # Apply maximum blur to the region to make it completely unrecognizable
-            region_to_blur = modified_original[y1:y2, x1:x2].copy()
-            
-            # Apply multiple passes of strong blur for maximum effect
-            blurred_region = cv2.GaussianBlur(region_to_blur, (201, 201), 100)
-            # Second pass of blur for extreme effect
-            blurred_region = cv2.GaussianBlur(blurred_region, (151, 151), 80)
-            
-            # Add heavy noise to completely obscure details
-            noise = np.random.normal(0, 40, blurred_region.shape).astype(np.uint8)
-            blurred_region = cv2.add(blurred_region, noise)
-            
-            # Apply extreme pixelation
-            pixel_size = max(25, min(50, (x2-x1)//5))
-            if x2-x1 > pixel_size and y2-y1 > pixel_size:
-                h, w = region_to_blur.shape[:2]
-                temp = cv2.resize(blurred_region, (w//pixel_size, h//pixel_size), interpolation=cv2.INTER_LINEAR)
-                blurred_region = cv2.resize(temp, (w, h), interpolation=cv2.INTER_NEAREST)
-            
-            # Add strong overlay to completely obscure details
-            overlay_color = [150, 150, 150]
-            alpha = 0.75
-            blurred_region = cv2.addWeighted(blurred_region, 1-alpha, np.full_like(blurred_region, overlay_color), alpha, 0)
+            blurred_region = obscure_region(modified_original[y1:y2, x1:x2])
             
             # Apply the blurred region back to the image
             modified_original[y1:y2, x1:x2] = blurred_region
@@ -842,25 +1032,9 @@ def process_image(image, patient, user=None):
         grid_path = create_output_grid(original_img, result_img, modified_original, 
                                        cropped_images, os.path.basename(image.name), temp_dir)
         
-        # Save files to model fields - only blurred and grid
-        with open(blurred_path, 'rb') as f:
-            processed_image.blurred_image.save(f"blurred_{os.path.basename(image.name)}", ContentFile(f.read()))
-        
-        with open(grid_path, 'rb') as f:
-            processed_image.grid_image.save(f"grid_{os.path.basename(image.name)}", ContentFile(f.read()))
-        
-        processed_image.save()
-        
-        # Save the fingerprint data
-        fingerprint = ImageFingerprint(
-            processed_image=processed_image,
-            color_histogram=fingerprint_data['color_histogram'],
-            avg_hash=fingerprint_data['avg_hash'],
-            phash=fingerprint_data['phash']
-        )
-        fingerprint.save()
-        
-        # Create CroppedRegion instances
+        # Build CroppedRegion instances in memory; everything is written in one
+        # transaction once all regions are encrypted
+        cropped_regions = []
         total_encrypted_entropy = 0
         total_encrypted_raw_entropy = 0
         total_original_region_raw_entropy = 0
@@ -872,10 +1046,21 @@ def process_image(image, patient, user=None):
         print(f"{'Region':<10} | {'Original':<10} | {'Encrypted':<10} | {'Difference':<10} | {'Increase %':<10} | {'Assessment'}")
         print("-" * 90)
         
+        # RAW stores lossless pixels that restores paste without decoding;
+        # anything else keeps the encoded crop file written above
+        payload_format = getattr(settings, 'CROP_PAYLOAD_FORMAT', 'RAW').upper()
+        
         for crop_info in cropped_images:
             # Read the cropped image data for original entropy (before encryption)
-            with open(crop_info['path'], 'rb') as f:
-                cropped_image_data = f.read()
+            if payload_format == 'RAW':
+                cropped_image_data = pack_raw_pixels(
+                    crop_info['image'], compress_level=getattr(settings, 'CROP_PAYLOAD_ZLIB_LEVEL', 1)
+                )
+                image_format = 'RAW'
+            else:
+                with open(crop_info['path'], 'rb') as f:
+                    cropped_image_data = f.read()
+                image_format = 'JPEG'
             
             # Get the original entropy before encryption
             original_region_analysis = analyze_data_characteristics(
@@ -887,15 +1072,12 @@ def process_image(image, patient, user=None):
             # Encrypt the image data and get timing information
             encrypted_data, encryption_time_ms = encrypt_image(cropped_image_data, user=user)
             
-            # Store the encryption time in the processed image
+            # Store the encryption time in the processed image (saved with it below)
             if not processed_image.encryption_time:
                 processed_image.encryption_time = encryption_time_ms
             else:
                 # Average with existing time
                 processed_image.encryption_time = (processed_image.encryption_time + encryption_time_ms) / 2
-                
-            # Save the updated encryption time
-            processed_image.save(update_fields=['encryption_time'])
             
             # Calculate entropy of encrypted data
             encrypted_analysis = analyze_data_characteristics(
@@ -935,13 +1117,13 @@ def process_image(image, patient, user=None):
                 x2=crop_info['coords'][2],
                 y2=crop_info['coords'][3],
                 original_filename=os.path.basename(crop_info['path']),
-                image_format='JPEG'
+                image_format=image_format
             )
             
-            # Store the encrypted data
-            cropped_region.cropped_image_data = encrypted_data
+            # Store the encrypted data (inline or in the region blob store)
+            cropped_region.set_encrypted_payload(encrypted_data)
             
-            cropped_region.save()
+            cropped_regions.append(cropped_region)
         
         print("-" * 90)
         
@@ -965,8 +1147,12 @@ def process_image(image, patient, user=None):
             print(f"  - Original image entropy: {original_analysis['entropy']['raw']:.4f} bits")
             print(f"  - Blurred image entropy: {blurred_analysis['entropy']['raw']:.4f} bits")
             print(f"  - Encrypted regions stored with scaled entropy: {avg_encrypted_entropy:.2f} (1-8 scale)")
-            
-            processed_image.save()
+        
+        # Save files to model fields - only blurred and grid - and all rows at once
+        _persist_processed_image(processed_image, [
+            ('blurred_image', f"blurred_{os.path.basename(image.name)}", blurred_path),
+            ('grid_image', f"grid_{os.path.basename(image.name)}", grid_path),
+        ], fingerprint_data, cropped_regions)
         
         # Clean up temp files and directory - including the original
         for file in os.listdir(temp_dir):
@@ -991,7 +1177,8 @@ def process_image(image, patient, user=None):
         # Re-raise the exception
         raise e
 
-def restore_from_cropped(processed_image_id, enhance=False, user=None):
+def restore_from_cropped(processed_image_id, enhance=False, user=None, cache_policy=CachePolicy.USE,
+                         compute_similarity=False):
     """
     Restore an image by placing cropped regions back into blurred image
     without saving to disk, preserving exact original quality.
@@ -1000,84 +1187,52 @@ def restore_from_cropped(processed_image_id, enhance=False, user=None):
         processed_image_id: ID of the ProcessedImage to restore
         enhance: Whether to apply enhancement to the restored image (ignored for exact quality)
         user: Optional user object (ignored, using static key only)
+        cache_policy: One of the CachePolicy values controlling cache reads/writes
+        compute_similarity: Add similarity/entropy metrics to the returned data
+                            (computed once per image version, see get_restoration_similarity)
         
     Returns:
         Tuple of (restored_image_array, filename, similarity_data)
         Note: The image is not saved to disk, only the numpy array is returned
     """
     from .models import ProcessedImage, CroppedRegion, ImageFingerprint
-    from django.core.cache import cache
     import time
     import logging
     
     # Set up logging
     logger = logging.getLogger(__name__)
     
-    # Generate a cache key based on processed_image_id and current timestamp
-    current_time = int(time.time())
-    cache_key = f"restored_image:{processed_image_id}:exact:{current_time % 300}"  # Reset cache every 5 minutes
-    
-    # For admin panel requests, bypass cache
-    use_cache = True
-    import inspect
-    stack = inspect.stack()
-    for frame in stack:
-        if 'admin.py' in frame.filename and 'similarity_metrics' in frame.function:
-            use_cache = False
-            logger.info("Bypassing cache for admin panel similarity calculation")
-            break
-    
-    # Check if the restored image is in cache and we want to use cache
-    cached_result = None if not use_cache else cache.get(cache_key)
+    # The cache key embeds the image's version stamp, which is bumped whenever
+    # the image, its regions or its fingerprint change
+    version = get_image_version(processed_image_id)
+    cache_key = restored_image_cache_key(processed_image_id, version)
+    
+    # Check if the restored image is in this worker's cache and the policy allows reading it
+    cached_result = restored_cache.get(cache_key) if CachePolicy.reads(cache_policy) else None
     if cached_result is not None:
         # Return cached result if available
+        if compute_similarity:
+            restored_img, filename, similarity_data = cached_result
+            metrics = get_restoration_similarity(processed_image_id, restored_img=restored_img, version=version)
+            return (restored_img, filename, {**similarity_data, **metrics})
         return cached_result
     
     try:
         # Get the processed image
         processed_image = ProcessedImage.objects.get(id=processed_image_id)
         
-        # Get the blurred image - use IMREAD_UNCHANGED to preserve exact color space and bit depth
+        # Get the blurred image as a copy-on-write mapping of its raw pixels, so
+        # hot images skip the decode and only the pasted region pages are copied
         blurred_img_path = processed_image.blurred_image.path
-        blurred_img = cv2.imread(blurred_img_path, cv2.IMREAD_UNCHANGED)
+        restored_img = load_image_pixels(blurred_img_path, writable=True)
         
-        if blurred_img is None:
+        if restored_img is None:
             raise Exception(f"Error: Could not read blurred image at {blurred_img_path}")
         
-        # Make a copy to restore
-        restored_img = blurred_img.copy()
-        
-        # Get all cropped regions for this processed image
-        cropped_regions = list(CroppedRegion.objects.filter(processed_image=processed_image))
-        
-        # Calculate pre-restoration similarity between original and blurred image
-        pre_restoration_similarity = {}
-        original_fingerprint = None
-        try:
-            # Try to get the fingerprint for this image
-            original_fingerprint = ImageFingerprint.objects.get(processed_image=processed_image)
-            logger.info(f"Original fingerprint found: avg_hash={original_fingerprint.avg_hash[:8]}..., phash={original_fingerprint.phash[:8]}...")
-            
-            # Calculate fingerprint for the blurred image
-            blurred_fingerprint = create_image_fingerprint(blurred_img)
-            logger.info(f"Blurred fingerprint: avg_hash={blurred_fingerprint['avg_hash'][:8]}..., phash={blurred_fingerprint['phash'][:8]}...")
-            
-            # Mark this fingerprint as from a blurred image to adjust similarity calculations
-            blurred_fingerprint['is_blurred'] = True
-            
-            # Calculate similarity
-            blurred_similarity_metrics = calculate_image_similarity(original_fingerprint, blurred_fingerprint)
-            
-            # Save pre-restoration similarity
-            pre_restoration_similarity = {
-                "pre_similarity": blurred_similarity_metrics["overall_similarity"],
-                "pre_hash_similarity": blurred_similarity_metrics["hash_similarity"],
-                "pre_color_similarity": blurred_similarity_metrics["color_similarity"]
-            }
-            logger.info(f"Pre-restoration similarity: {pre_restoration_similarity['pre_similarity']:.4f}")
-        except Exception as e:
-            pre_restoration_similarity = {"pre_error": f"Error calculating pre-restoration similarity: {str(e)}"}
-            logger.error(f"Error in pre-restoration similarity: {str(e)}")
+        # Get all cropped regions for this processed image through the reverse
+        # relation, so each region's processed_image is already cached; every
+        # region is decrypted, so load the ciphertext with them
+        cropped_regions = list(processed_image.cropped_regions.with_payload())
         
         # Count successful and failed decryptions
         successful_decryptions = 0
@@ -1118,8 +1273,8 @@ def restore_from_cropped(processed_image_id, enhance=False, user=None):
         if successful_decryptions == 0 and len(cropped_regions) > 0:
             error_details = "; ".join(decryption_errors)
             logger.critical(f"ALL decryption attempts failed for all regions. Errors: {error_details}")
-            # Return blurred image with error information
-            return (blurred_img, 
+            # Return blurred image with error information (nothing has been pasted yet)
+            return (restored_img, 
                     f"error_blurred_{os.path.basename(blurred_img_path)}", 
                     {"error": "Critical decryption failure: All regions failed to decrypt",
                      "details": error_details})
@@ -1132,12 +1287,13 @@ def restore_from_cropped(processed_image_id, enhance=False, user=None):
         for coords, decrypted_data in region_data:
             x1, y1, x2, y2 = coords
             
-            # Create a temp file to use with OpenCV
-            with BytesIO(decrypted_data) as img_buffer:
-                # Convert to numpy array for OpenCV - preserve exact format
-                img_array = np.frombuffer(img_buffer.getvalue(), dtype=np.uint8)
-                # Use IMREAD_UNCHANGED to preserve exact color space, bit depth and format
-                crop_img = cv2.imdecode(img_array, cv2.IMREAD_UNCHANGED)
+            # Raw payloads are viewed in place; JPEG/PNG payloads are decoded
+            # with IMREAD_UNCHANGED to preserve exact color space and bit depth
+            try:
+                crop_img = decode_region_payload(decrypted_data)
+            except ValueError as e:
+                logger.warning(f"Warning: Invalid raw crop payload ({str(e)}), skipping")
+                continue
             
             if crop_img is None:
                 logger.warning(f"Warning: Could not decode image data, skipping")
@@ -1173,73 +1329,23 @@ def restore_from_cropped(processed_image_id, enhance=False, user=None):
             "decryption_errors": decryption_errors if decryption_errors else None
         })
         
-        # Continue with similarity metrics if we have the fingerprint
-        try:
-            if original_fingerprint:
-                # Calculate fingerprint for the restored image
-                restored_fingerprint = create_image_fingerprint(restored_img)
-                logger.info(f"Restored fingerprint: avg_hash={restored_fingerprint['avg_hash'][:8]}..., phash={restored_fingerprint['phash'][:8]}...")
-                
-                # Compare restored with original (not with itself)
-                similarity_metrics = calculate_image_similarity(original_fingerprint, restored_fingerprint)
-                logger.info(f"Post-restoration similarity: {similarity_metrics['overall_similarity']:.4f}")
-                
-                # Get entropy and confidence metrics
-                regions = processed_image.cropped_regions.all()
-                num_regions = regions.count()
-                
-                if num_regions > 0:
-                    avg_confidence = sum(region.confidence for region in regions) / num_regions
-                else:
-                    avg_confidence = 0
-                    
-                # Calculate entropy of restored image
-                gray_img = cv2.cvtColor(restored_img, cv2.COLOR_BGR2GRAY) if len(restored_img.shape) > 2 else restored_img
-                img_entropy = calculate_entropy(gray_img.flatten())
-                
-                # Add both pre-restoration and post-restoration metrics to similarity data
-                similarity_data.update({
-                    # Post-restoration metrics (primary)
-                    "similarity": similarity_metrics["overall_similarity"],
-                    "hash_similarity": similarity_metrics["hash_similarity"],
-                    "color_similarity": similarity_metrics["color_similarity"],
-                    "entropy": float(img_entropy),
-                    "avg_confidence": float(avg_confidence),
-                    "num_regions": num_regions,
-                    
-                    # Pre-restoration metrics
-                    **pre_restoration_similarity
-                })
-                
-                # Calculate improvement from pre to post restoration
-                if "pre_similarity" in pre_restoration_similarity:
-                    similarity_data["improvement"] = max(0, similarity_data["similarity"] - pre_restoration_similarity["pre_similarity"])
-                
-                # Add quality assessment based on post-restoration similarity
-                if similarity_metrics["overall_similarity"] > 0.99:
-                    # If similarity is too perfect, it might indicate an issue
-                    similarity_data["quality"] = "Suspicious - Too Perfect"
-                elif similarity_metrics["overall_similarity"] > 0.85:
-                    similarity_data["quality"] = "Excellent"
-                elif similarity_metrics["overall_similarity"] > 0.7:
-                    similarity_data["quality"] = "Good"
-                elif similarity_metrics["overall_similarity"] > 0.5:
-                    similarity_data["quality"] = "Fair"
-                else:
-                    similarity_data["quality"] = "Poor"
-            else:
-                similarity_data["message"] = "No fingerprint data available for similarity comparison"
-                logger.error("Error: No original fingerprint found for comparison")
-        except Exception as e:
-            similarity_data["error"] = f"Error calculating similarity: {str(e)}"
-            logger.error(f"Error in similarity calculation: {str(e)}")
-        
         # Always return the best possible image, even if no regions could be decrypted
         result = (restored_img, f"restored_{os.path.basename(blurred_img_path)}", similarity_data)
         
-        # Cache the result but with shorter timeout
-        if use_cache:
-            cache.set(cache_key, result, timeout=300)  # 5 minutes timeout
+        # Cache the result in this worker until the image version changes; the
+        # array is shared with later callers, so it must not be modified.
+        # Frames with regions left blurred are not cached, so they are retried
+        if CachePolicy.writes(cache_policy) and not failed_decryptions:
+            restored_img.flags.writeable = False
+            restored_cache.set(cache_key, result)
+        
+        # Similarity and entropy are only computed when explicitly requested
+        if compute_similarity:
+            metrics = get_restoration_similarity(
+                processed_image_id, restored_img=restored_img, version=version,
+                processed_image=processed_image, cropped_regions=cropped_regions
+            )
+            result = (restored_img, result[1], {**similarity_data, **metrics})
         
         return result
         
@@ -1253,7 +1359,7 @@ def restore_from_cropped(processed_image_id, enhance=False, user=None):
         try:
             processed_image = ProcessedImage.objects.get(id=processed_image_id)
             blurred_img_path = processed_image.blurred_image.path
-            blurred_img = cv2.imread(blurred_img_path, cv2.IMREAD_UNCHANGED)
+            blurred_img = load_image_pixels(blurred_img_path)
             return (blurred_img, 
                     f"error_restored_{os.path.basename(blurred_img_path)}", 
                     {"error": f"Restoration failed: {str(e)}"})
@@ -1261,6 +1367,377 @@ def restore_from_cropped(processed_image_id, enhance=False, user=None):
             # If we can't even get the blurred image, re-raise the exception
             raise Exception(f"Processed image with ID {processed_image_id} not found or could not be read")
 
+def get_restoration_similarity(processed_image_id, restored_img=None, version=None,
+                               processed_image=None, blurred_img=None, cropped_regions=None):
+    """
+    Return similarity and entropy metrics of a restored image, computed once
+    per image version and persisted in the cache afterwards.
+    
+    Args:
+        processed_image_id: ID of the ProcessedImage
+        restored_img: Restored image array (restored on demand if not given)
+        version: Image version stamp (current version if not given)
+        processed_image, blurred_img, cropped_regions: Already loaded inputs, if available
+        
+    Returns:
+        dict: Similarity metrics (see calculate_restoration_similarity)
+    """
+    from .models import ProcessedImage, CroppedRegion
+    
+    if version is None:
+        version = get_image_version(processed_image_id)
+    cache_key = similarity_cache_key(processed_image_id, version)
+    
+    metrics = cache.get(cache_key)
+    if metrics is not None:
+        return metrics
+    
+    if restored_img is None:
+        restored_img, _, _ = restore_from_cropped(processed_image_id, cache_policy=CachePolicy.READ_ONLY)
+    if processed_image is None:
+        processed_image = ProcessedImage.objects.get(id=processed_image_id)
+    if blurred_img is None:
+        blurred_img = load_image_pixels(processed_image.blurred_image.path)
+    if cropped_regions is None:
+        cropped_regions = list(CroppedRegion.objects.filter(processed_image=processed_image))
+    
+    metrics = calculate_restoration_similarity(processed_image, blurred_img, restored_img, cropped_regions)
+    
+    # Only persist complete results; errors are retried on the next request
+    if "similarity" in metrics:
+        cache.set(cache_key, metrics, timeout=None)
+    return metrics
+
+def calculate_restoration_similarity(processed_image, blurred_img, restored_img, cropped_regions):
+    """
+    Compare the blurred and restored images against the original fingerprint.
+    
+    Args:
+        processed_image: The ProcessedImage being restored
+        blurred_img: Blurred image array
+        restored_img: Restored image array
+        cropped_regions: List of the image's CroppedRegion objects
+        
+    Returns:
+        dict: Pre- and post-restoration similarity, entropy and quality assessment
+    """
+    from .models import ImageFingerprint
+    
+    logger = logging.getLogger(__name__)
+    similarity_data = {}
+    
+    # Calculate pre-restoration similarity between original and blurred image
+    pre_restoration_similarity = {}
+    original_fingerprint = None
+    try:
+        # Try to get the fingerprint for this image
+        original_fingerprint = ImageFingerprint.objects.get(processed_image=processed_image)
+        logger.info(f"Original fingerprint found: avg_hash={original_fingerprint.avg_hash[:8]}..., phash={original_fingerprint.phash[:8]}...")
+        
+        # Calculate fingerprint for the blurred image
+        blurred_fingerprint = create_image_fingerprint(blurred_img)
+        logger.info(f"Blurred fingerprint: avg_hash={blurred_fingerprint['avg_hash'][:8]}..., phash={blurred_fingerprint['phash'][:8]}...")
+        
+        # Mark this fingerprint as from a blurred image to adjust similarity calculations
+        blurred_fingerprint['is_blurred'] = True
+        
+        # Calculate similarity
+        blurred_similarity_metrics = calculate_image_similarity(original_fingerprint, blurred_fingerprint)
+        
+        # Save pre-restoration similarity
+        pre_restoration_similarity = {
+            "pre_similarity": blurred_similarity_metrics["overall_similarity"],
+            "pre_hash_similarity": blurred_similarity_metrics["hash_similarity"],
+            "pre_color_similarity": blurred_similarity_metrics["color_similarity"]
+        }
+        logger.info(f"Pre-restoration similarity: {pre_restoration_similarity['pre_similarity']:.4f}")
+    except Exception as e:
+        pre_restoration_similarity = {"pre_error": f"Error calculating pre-restoration similarity: {str(e)}"}
+        logger.error(f"Error in pre-restoration similarity: {str(e)}")
+    
+    # Continue with similarity metrics if we have the fingerprint
+    try:
+        if original_fingerprint:
+            # Calculate fingerprint for the restored image
+            restored_fingerprint = create_image_fingerprint(restored_img)
+            logger.info(f"Restored fingerprint: avg_hash={restored_fingerprint['avg_hash'][:8]}..., phash={restored_fingerprint['phash'][:8]}...")
+            
+            # Compare restored with original (not with itself)
+            similarity_metrics = calculate_image_similarity(original_fingerprint, restored_fingerprint)
+            logger.info(f"Post-restoration similarity: {similarity_metrics['overall_similarity']:.4f}")
+            
+            # Get entropy and confidence metrics
+            num_regions = len(cropped_regions)
+            
+            if num_regions > 0:
+                avg_confidence = sum(region.confidence for region in cropped_regions) / num_regions
+            else:
+                avg_confidence = 0
+                
+            # Calculate entropy of restored image
+            gray_img = cv2.cvtColor(restored_img, cv2.COLOR_BGR2GRAY) if len(restored_img.shape) > 2 else restored_img
+            img_entropy = calculate_entropy(gray_img.flatten())
+            
+            # Add both pre-restoration and post-restoration metrics to similarity data
+            similarity_data.update({
+                # Post-restoration metrics (primary)
+                "similarity": similarity_metrics["overall_similarity"],
+                "hash_similarity": similarity_metrics["hash_similarity"],
+                "color_similarity": similarity_metrics["color_similarity"],
+                "entropy": float(img_entropy),
+                "avg_confidence": float(avg_confidence),
+                "num_regions": num_regions,
+                
+                # Pre-restoration metrics
+                **pre_restoration_similarity
+            })
+            
+            # Calculate improvement from pre to post restoration
+            if "pre_similarity" in pre_restoration_similarity:
+                similarity_data["improvement"] = max(0, similarity_data["similarity"] - pre_restoration_similarity["pre_similarity"])
+            
+            # Add quality assessment based on post-restoration similarity
+            if similarity_metrics["overall_similarity"] > 0.99:
+                # If similarity is too perfect, it might indicate an issue
+                similarity_data["quality"] = "Suspicious - Too Perfect"
+            elif similarity_metrics["overall_similarity"] > 0.85:
+                similarity_data["quality"] = "Excellent"
+            elif similarity_metrics["overall_similarity"] > 0.7:
+                similarity_data["quality"] = "Good"
+            elif similarity_metrics["overall_similarity"] > 0.5:
+                similarity_data["quality"] = "Fair"
+            else:
+                similarity_data["quality"] = "Poor"
+        else:
+            similarity_data["message"] = "No fingerprint data available for similarity comparison"
+            logger.error("Error: No original fingerprint found for comparison")
+    except Exception as e:
+        similarity_data["error"] = f"Error calculating similarity: {str(e)}"
+        logger.error(f"Error in similarity calculation: {str(e)}")
+    
+    return similarity_data
+
+def get_encoded_restored_image(processed_image_id, img_format='png', quality=None, user=None,
+                               cache_policy=CachePolicy.USE, compute_similarity=False):
+    """
+    Restore an image and return it encoded, caching the encoded bytes per
+    (image version, format, quality) in this worker instead of the raw pixel array.
+    
+    Args:
+        processed_image_id: ID of the ProcessedImage to restore
+        img_format: 'png', 'jpeg'/'jpg' or 'webp'
+        quality: PNG compression level or JPEG/WebP quality (see encoders.encode_image);
+                 None for the configured default
+        user: Optional user object (ignored, using static key only)
+        cache_policy: One of the CachePolicy values controlling cache reads/writes
+        compute_similarity: Add similarity/entropy metrics to the 'similarity' entry
+        
+    Returns:
+        dict with 'data', 'content_type', 'etag' (None for error fallbacks and
+        partial restores),
+        'filename' and 'similarity'
+    """
+    img_format, quality = resolve_encoding(img_format, quality)
+    
+    # Resolve the version once so the cache key and ETag always agree
+    version = get_image_version(processed_image_id)
+    cache_key = encoded_image_cache_key(processed_image_id, img_format, quality, version)
+    
+    # Metrics computed from the pixels restored by this call, if any
+    computed = {}
+    
+    def with_similarity(result):
+        # Similarity is persisted separately per version, never in the byte cache
+        if not compute_similarity or result['filename'].startswith('error_'):
+            return result
+        metrics = computed.get('metrics')
+        if metrics is None:
+            metrics = get_restoration_similarity(processed_image_id, version=version)
+        return {**result, 'similarity': {**result['similarity'], **metrics}}
+    
+    if CachePolicy.reads(cache_policy):
+        cached = restored_cache.get(cache_key)
+        if cached is not None:
+            return with_similarity(cached)
+    
+    def compute():
+        # The encoded bytes are what we cache, so skip caching the pixel array
+        restored_img, filename, similarity = restore_from_cropped(
+            processed_image_id, user=user, cache_policy=CachePolicy.BYPASS
+        )
+        data, content_type = encode_image(restored_img, img_format, quality)
+        if compute_similarity and not filename.startswith('error_'):
+            # Measure the pixels just restored instead of restoring them again
+            computed['metrics'] = get_restoration_similarity(
+                processed_image_id, restored_img=restored_img, version=version
+            )
+        
+        # Error fallbacks (the blurred image returned on failure) and frames with
+        # regions left blurred get no ETag and are never cached, so the next
+        # request retries the restore
+        failed = filename.startswith('error_') or similarity.get('failed_regions', 0) > 0
+        result = {
+            'data': data,
+            'content_type': content_type,
+            'etag': None if failed else restored_image_etag(processed_image_id, img_format, quality, version),
+            'filename': filename,
+            'similarity': similarity,
+        }
+        
+        if CachePolicy.writes(cache_policy) and not failed:
+            restored_cache.set(cache_key, result)
+        return result
+    
+    if cache_policy == CachePolicy.BYPASS:
+        return with_similarity(compute())
+    
+    # Coalesce concurrent restores of the same image version, and let one worker
+    # at a time restore it
+    reread = (lambda: restored_cache.get(cache_key)) if CachePolicy.reads(cache_policy) else None
+    return with_similarity(restore_single_flight.do(cache_key, compute, reread=reread))
+
+def get_region_payloads(processed_image_id, cache_policy=CachePolicy.USE):
+    """
+    Decrypt the regions of a processed image for client-side compositing.
+    
+    Instead of a restored frame, clients get each region's small encoded image
+    and its box, and paste them over the blurred image themselves. Raw pixel
+    payloads are encoded as PNG (lossless); JPEG/PNG payloads are passed through.
+    The payloads are plaintext, so they are only cached in this worker.
+    
+    Args:
+        processed_image_id: ID of the ProcessedImage
+        cache_policy: One of the CachePolicy values controlling cache reads/writes
+        
+    Returns:
+        dict with 'version', 'regions' (id, x1, y1, x2, y2, content_type, data
+        as base64) and 'failed_regions' (IDs that could not be decrypted)
+    """
+    from .models import CroppedRegion
+    
+    logger = logging.getLogger(__name__)
+    
+    version = get_image_version(processed_image_id)
+    cache_key = region_payloads_cache_key(processed_image_id, version)
+    if CachePolicy.reads(cache_policy):
+        cached = restored_cache.get(cache_key)
+        if cached is not None:
+            return cached
+    
+    regions = []
+    failed_regions = []
+    for region in CroppedRegion.objects.filter(processed_image_id=processed_image_id).with_payload().order_by('id'):
+        decrypted_data = region.get_decrypted_image()
+        if decrypted_data is None:
+            failed_regions.append(region.id)
+            continue
+        
+        if is_raw_pixel_payload(decrypted_data):
+            data, content_type = encode_image(unpack_raw_pixels(decrypted_data), 'png')
+        else:
+            data = decrypted_data
+            content_type = 'image/png' if decrypted_data.startswith(b'\x89PNG') else 'image/jpeg'
+        
+        regions.append({
+            'id': region.id,
+            'x1': region.x1,
+            'y1': region.y1,
+            'x2': region.x2,
+            'y2': region.y2,
+            'content_type': content_type,
+            'data': base64.b64encode(data).decode('ascii'),
+        })
+    
+    if failed_regions:
+        logger.error(f"Could not decrypt regions {failed_regions} of image {processed_image_id}")
+    
+    result = {'version': version, 'regions': regions, 'failed_regions': failed_regions}
+    
+    # Never cache partial results, so a transient failure is retried next time
+    if CachePolicy.writes(cache_policy) and not failed_regions:
+        restored_cache.set(cache_key, result)
+    return result
+
+def get_user_transport_key(user):
+    """
+    The AES key a user established through the Diffie-Hellman key exchange.
+    
+    Looks in the shared cache first (where DHKeyExchangeView stores it) and
+    falls back to the local key file.
+    
+    Args:
+        user: The requesting user
+        
+    Returns:
+        bytes: 32-byte AES key, or None if no key exchange has been completed
+    """
+    if user is None or not getattr(user, 'id', None):
+        return None
+    key_b64 = cache.get(f"encryption_key_{user.id}")
+    if not key_b64:
+        key_b64 = load_encryption_keys_from_file().get(str(user.id))
+    if not key_b64:
+        return None
+    try:
+        key = base64.b64decode(key_b64)
+    except (binascii.Error, ValueError):
+        return None
+    return key if len(key) == 32 else None
+
+def wrap_for_client(data, key):
+    """
+    Encrypt a payload for decryption in the browser with WebCrypto.
+    
+    Uses AES-256-GCM with a random 96-bit nonce. The result is
+    nonce || ciphertext || tag, which maps directly onto
+    crypto.subtle.decrypt({name: 'AES-GCM', iv: blob.slice(0, 12)}, key, blob.slice(12)).
+    
+    Args:
+        data: Plaintext bytes
+        key: 32-byte AES key shared with the client
+        
+    Returns:
+        bytes: The wrapped payload
+    """
+    nonce = get_random_bytes(12)
+    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+    ciphertext, tag = cipher.encrypt_and_digest(data)
+    return nonce + ciphertext + tag
+
+def get_e2e_region_payloads(processed_image_id, key):
+    """
+    Region payloads re-wrapped under a client's key for in-browser decryption.
+    
+    The plaintext payloads come from get_region_payloads (decrypted once per
+    image version); each region is then only wrapped with the client key, and
+    wrapped blobs are kept in a small per-process LRU so repeated views serve
+    them as-is.
+    
+    Args:
+        processed_image_id: ID of the ProcessedImage
+        key: 32-byte AES key shared with the client (see get_user_transport_key)
+        
+    Returns:
+        dict like get_region_payloads, with each region's 'data' wrapped
+        (see wrap_for_client) and a 'key_id' identifying the key used
+    """
+    payloads = get_region_payloads(processed_image_id)
+    key_id = hashlib.sha256(key).hexdigest()[:16]
+    
+    regions = []
+    for region in payloads['regions']:
+        rewrap_key = f"{region['id']}:{payloads['version']}:{key_id}"
+        wrapped = _rewrap_cache.get(rewrap_key)
+        if wrapped is None:
+            wrapped = base64.b64encode(wrap_for_client(base64.b64decode(region['data']), key)).decode('ascii')
+            _rewrap_cache.set(rewrap_key, wrapped)
+        regions.append({**region, 'data': wrapped})
+    
+    return {**payloads, 'regions': regions, 'key_id': key_id}
+
+# Region payloads already wrapped for a client key, by region, version and key id
+_rewrap_cache = ByteLRUCache(max_bytes=getattr(settings, 'E2E_REWRAP_CACHE_BYTES', 32 * 1024 * 1024))
+
 def create_output_grid(original, result, modified, cropped_images, image_name, output_dir):
     """Create a grid with original, result, modified and cropped images"""
     # Define padding and maximum images per row for cropped images
@@ -1579,8 +2056,12 @@ def calculate_original_image_entropy(processed_image_id):
             pass
         
         # If we have cropped regions, generate a hash from their data
-        cropped_regions = CroppedRegion.objects.filter(processed_image=processed_image)
-        if cropped_regions.exists():
+        # One query for just the fields the hash needs (never the encrypted payloads)
+        cropped_regions = list(
+            CroppedRegion.objects.filter(processed_image=processed_image)
+            .only('id', 'x1', 'y1', 'class_name', 'confidence')
+        )
+        if cropped_regions:
             # Use region IDs and coordinates to create a hash
             region_data = []
             for region in cropped_regions:
@@ -1597,8 +2078,8 @@ def calculate_original_image_entropy(processed_image_id):
             hash_factor = (hash_value - 0.5) * 3.0
             
             # Base entropy value adjusted by region count and average confidence
-            avg_confidence = sum(region.confidence for region in cropped_regions) / cropped_regions.count()
-            base_entropy = 5.0 + (avg_confidence * 0.5) + (cropped_regions.count() * 0.1)
+            avg_confidence = sum(region.confidence for region in cropped_regions) / len(cropped_regions)
+            base_entropy = 5.0 + (avg_confidence * 0.5) + (len(cropped_regions) * 0.1)
             
             # Add hash-based variation for uniqueness
             raw_entropy = base_entropy + hash_factor
@@ -1777,7 +2258,7 @@ def recalculate_image_entropy(processed_image_id=None):
                 
                 # If there are cropped regions, recalculate their entropy too
                 # This ensures consistency across the entire image set
-                cropped_regions = img.cropped_regions.all()
+                cropped_regions = img.cropped_regions.with_payload()
                 region_updates = []
                 
                 for region in cropped_regions:
@@ -2,29 +2,151 @@ from django.shortcuts import render, get_object_or_404
 from rest_framework import viewsets, permissions, status
 from rest_framework.response import Response
 from rest_framework.parsers import MultiPartParser, FormParser
-from rest_framework.exceptions import PermissionDenied
+from rest_framework.exceptions import PermissionDenied, ValidationError
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.views import APIView
-from django.http import HttpResponse, HttpResponseForbidden, FileResponse
+from rest_framework.negotiation import BaseContentNegotiation
+from django.http import (
+    HttpResponse, HttpResponseForbidden, HttpResponseNotModified, FileResponse, StreamingHttpResponse,
+)
+from django.utils.http import parse_etags
 from django.core.files.base import ContentFile
 from .models import Patient, ProcessedImage, CroppedRegion
 from .serializers import PatientSerializer, ProcessedImageSerializer
+from .pagination import KeysetCursorPagination
 from authentication.permissions import IsDoctorUser, IsLabUser
-from .utils import process_image, restore_from_cropped
+from .utils import (
+    process_image, get_encoded_restored_image, get_e2e_region_payloads,
+    get_region_payloads, get_user_transport_key, region_payload_as_image_file,
+)
+from .encoders import FILE_EXTENSIONS, negotiate_format, normalize_format, resolve_encoding
+from .cache import (
+    CachePolicy, deepzoom_tile_etag, get_image_version, restored_image_etag,
+)
+from .tiles import deepzoom_descriptor, get_encoded_tile, image_dimensions, thumbnail_level, tile_size
 import logging
-import cv2
 import os
 import base64
-import numpy as np
 from django.conf import settings
-from io import BytesIO
 from django.urls import reverse
-from django.core.cache import cache
 import json
+import hashlib
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
+def etag_matches(request, etag):
+    """Check whether the request's If-None-Match header already covers the given ETag"""
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+    # If-None-Match uses weak comparison, so ignore any W/ prefix
+    etags = [tag[2:] if tag.startswith('W/') else tag for tag in parse_etags(header)]
+    return '*' in etags or etag in etags
+
+# Size of the slices streamed from an encoded image buffer
+STREAM_CHUNK_SIZE = 64 * 1024
+
+def parse_byte_range(header, size):
+    """
+    Parse a single-range ``Range: bytes=...`` header.
+    
+    Args:
+        header: Value of the Range header (may be None)
+        size: Total length of the representation in bytes
+        
+    Returns:
+        Inclusive (start, end) tuple, or None when the whole body should be sent
+        (no header, unsupported unit or a multi-range request)
+        
+    Raises:
+        ValueError: If the range cannot be satisfied (answer with 416)
+    """
+    if not header:
+        return None
+    unit, _, ranges = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in ranges:
+        return None
+    start, sep, end = ranges.strip().partition('-')
+    if not sep or not (start.isdigit() or end.isdigit()):
+        return None
+    if not start:
+        # Suffix range: the last N bytes
+        length = int(end)
+        if length == 0:
+            raise ValueError("Empty suffix range")
+        return max(0, size - length), size - 1
+    start = int(start)
+    if end and int(end) < start:
+        # Syntactically invalid ranges are ignored rather than rejected
+        return None
+    if start >= size:
+        raise ValueError(f"Range {header} not satisfiable for {size} bytes")
+    end = min(int(end), size - 1) if end else size - 1
+    return start, end
+
+def stream_image_response(request, data, content_type, etag=None, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Stream an encoded image in chunks straight from its buffer.
+    
+    The response iterates over memoryview slices of ``data`` so the encoded
+    image is never copied as a whole, sets Content-Length and answers single
+    byte-range requests with 206 (honouring If-Range against ``etag``).
+    
+    Args:
+        request: The incoming request
+        data: Encoded image (bytes or a uint8 numpy buffer)
+        content_type: MIME type of the image
+        etag: ETag of the image, if any, used for If-Range
+        chunk_size: Bytes per streamed chunk
+        
+    Returns:
+        StreamingHttpResponse (200 or 206) or HttpResponse (416)
+    """
+    view = memoryview(data).cast('B')
+    size = len(view)
+    
+    # A stale If-Range means the client's partial copy is outdated: send everything
+    range_header = request.headers.get('Range')
+    if_range = request.headers.get('If-Range')
+    if if_range and if_range != etag:
+        range_header = None
+    
+    try:
+        byte_range = parse_byte_range(range_header, size)
+    except ValueError:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        response['Accept-Ranges'] = 'bytes'
+        return response
+    
+    start, end = byte_range if byte_range else (0, size - 1)
+    
+    def chunks():
+        for offset in range(start, end + 1, chunk_size):
+            yield view[offset:min(offset + chunk_size, end + 1)]
+    
+    response = StreamingHttpResponse(chunks(), content_type=content_type, status=206 if byte_range else 200)
+    response['Content-Length'] = str(end - start + 1)
+    response['Accept-Ranges'] = 'bytes'
+    if byte_range:
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    return response
+
+class ImageContentNegotiation(BaseContentNegotiation):
+    """
+    Content negotiation for views that return raw image bytes.
+    
+    The image format is negotiated by the view itself (see encoders.negotiate_format),
+    so DRF must neither reject image Accept headers with 406 nor treat ?format=
+    as a renderer override; error responses always use the first renderer.
+    """
+    def select_parser(self, request, parsers):
+        return parsers[0]
+    
+    def select_renderer(self, request, renderers, format_suffix=None):
+        return (renderers[0], renderers[0].media_type)
+
 class PatientViewSet(viewsets.ModelViewSet):
     """
     ViewSet for patient data management:
@@ -152,16 +274,79 @@ class PatientViewSet(viewsets.ModelViewSet):
 class ProcessedImageViewSet(viewsets.ReadOnlyModelViewSet):
     """
     API endpoint for viewing processed images
+    
+    Listings are keyset-paginated on (created_at, id), newest first. Optional
+    query parameters:
+        patient_id:       only this patient's images
+        fields:           comma-separated subset of the serializer fields
+        include_regions:  'false' leaves out the nested cropped_regions
+        page_size:        images per page (up to KeysetCursorPagination.max_page_size)
     """
     queryset = ProcessedImage.objects.all()
     permission_classes = [IsAuthenticated]
     serializer_class = ProcessedImageSerializer
+    pagination_class = KeysetCursorPagination
+    
+    def get_requested_fields(self):
+        """
+        Fields to serialize, from ?fields= and ?include_regions=; None means all.
+        
+        Raises:
+            ValidationError: if ?fields= names a field the serializer does not have,
+                             or the selection leaves no fields to return
+        """
+        if hasattr(self, '_requested_fields'):
+            return self._requested_fields
+        
+        available = list(ProcessedImageSerializer.Meta.fields)
+        fields_param = self.request.query_params.get('fields')
+        requested = None
+        if fields_param:
+            requested = [name.strip() for name in fields_param.split(',') if name.strip()]
+            unknown = sorted(set(requested) - set(available))
+            if unknown:
+                raise ValidationError({'fields': f"Unknown fields: {', '.join(unknown)}. "
+                                                 f"Available: {', '.join(available)}"})
+        if self.request.query_params.get('include_regions', 'true').lower() == 'false':
+            requested = [name for name in (requested if requested is not None else available)
+                         if name != 'cropped_regions']
+        if requested == []:
+            # e.g. ?fields=, would otherwise return a list of empty objects
+            raise ValidationError({'fields': f"Select at least one field. Available: {', '.join(available)}"})
+        
+        self._requested_fields = requested
+        return requested
+    
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['fields'] = self.get_requested_fields()
+        return context
     
     def get_queryset(self):
         """
         Filter processed images by patient if patient_id is provided
         """
+        from django.db.models import Prefetch
+        
         queryset = ProcessedImage.objects.all()
+        fields = self.get_requested_fields()
+        
+        if fields is not None:
+            # Load only the requested columns, plus the pagination key
+            columns = {'id', 'created_at'} | (set(fields) & {'blurred_image', 'grid_image', 'restored_image'})
+            queryset = queryset.only(*columns)
+        
+        if fields is None or 'cropped_regions' in fields:
+            # The serializer nests cropped_regions; prefetch them in one query with
+            # only the serialized columns, never the encrypted payloads
+            queryset = queryset.prefetch_related(
+                Prefetch(
+                    'cropped_regions',
+                    queryset=CroppedRegion.objects.only(
+                        'id', 'processed_image_id', 'class_name', 'confidence', 'x1', 'y1', 'x2', 'y2'
+                    ),
+                )
+            )
         patient_id = self.request.query_params.get('patient_id')
         
         if patient_id:
@@ -175,6 +360,7 @@ class RestoreImageView(APIView):
     Images are generated on-demand and never saved to disk.
     """
     permission_classes = [IsAuthenticated & IsDoctorUser]
+    content_negotiation_class = ImageContentNegotiation
     
     def get(self, request, processed_image_id):
         """
@@ -187,17 +373,15 @@ class RestoreImageView(APIView):
             # Check if enhancement is requested
             enhance = request.query_params.get('enhance', 'true').lower() == 'true'
             
-            # Check if format is specified (default to png)
-            img_format = request.query_params.get('format', 'png').lower()
-            # Check if PNG quality is specified (0-9, higher is better compression but slower)
-            png_compression = int(request.query_params.get('compression', '3'))
-            # Check if user wants jpeg and its quality setting
-            jpeg_quality = int(request.query_params.get('quality', '95'))
+            # Explicit ?format= wins, otherwise negotiate from the Accept header
+            img_format = negotiate_format(request.headers.get('Accept'), request.query_params.get('format'))
+            # PNG compression level (0-9, higher is smaller but slower) and JPEG/WebP
+            # quality are optional; the configured encoder defaults are tuned for latency
+            png_compression = request.query_params.get('compression')
+            quality = request.query_params.get('quality')
             
-            # Get the processed image
-            try:
-                processed_image = ProcessedImage.objects.get(id=processed_image_id)
-            except ProcessedImage.DoesNotExist:
+            # The restore itself loads the image; only check that it exists here
+            if not ProcessedImage.objects.filter(id=processed_image_id).exists():
                 return Response(
                     {"error": f"Processed image with ID {processed_image_id} not found"}, 
                     status=status.HTTP_404_NOT_FOUND
@@ -205,33 +389,48 @@ class RestoreImageView(APIView):
             
             # Check if user has permission to access this patient's data
             if IsDoctorUser().has_permission(request, self):
+                # PNG takes a compression level, JPEG and WebP a quality
+                try:
+                    img_format, quality = resolve_encoding(
+                        img_format, png_compression if img_format == 'png' else quality
+                    )
+                except ValueError as e:
+                    return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+                
+                # Answer revalidation requests without touching the cached payload
+                etag = restored_image_etag(processed_image_id, img_format, quality)
+                if etag_matches(request, etag):
+                    response = HttpResponseNotModified()
+                    response['ETag'] = etag
+                    response['Vary'] = 'Accept'
+                    return response
+                
                 # Restore the image on-demand
                 logger.info(f"Restoring image {processed_image_id} with enhancement={enhance}")
                 # Pass the user object for proper decryption
-                restored_img, filename = restore_from_cropped(processed_image_id, enhance, user=request.user)
-                
-                if img_format == 'jpg' or img_format == 'jpeg':
-                    # Use high-quality JPEG encoding for users who prefer it
-                    encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), jpeg_quality]
-                    content_type = 'image/jpeg'
-                    _, img_encoded = cv2.imencode('.jpg', restored_img, encode_param)
-                else:
-                    # Use PNG for highest quality and lossless encoding
-                    encode_param = [int(cv2.IMWRITE_PNG_COMPRESSION), png_compression]
-                    content_type = 'image/png'
-                    _, img_encoded = cv2.imencode('.png', restored_img, encode_param)
+                encoded = get_encoded_restored_image(
+                    processed_image_id, img_format=img_format, quality=quality,
+                    user=request.user, cache_policy=CachePolicy.USE
+                )
+                filename = encoded['filename']
                 
                 # Return the image without saving it
-                response = HttpResponse(img_encoded.tobytes(), content_type=content_type)
+                response = stream_image_response(
+                    request, encoded['data'], encoded['content_type'], etag=encoded['etag']
+                )
+                response['Vary'] = 'Accept'
                 
                 # Set appropriate filename based on format
-                if img_format == 'jpg' or img_format == 'jpeg':
-                    response['Content-Disposition'] = f'inline; filename="{filename.replace(".jpg", ".jpg")}"'
-                else:
-                    response['Content-Disposition'] = f'inline; filename="{filename.replace(".jpg", ".png")}"'
+                filename = f"{os.path.splitext(filename)[0]}.{FILE_EXTENSIONS[img_format]}"
+                response['Content-Disposition'] = f'inline; filename="{filename}"'
                 
-                # Add cache headers for better performance
-                response['Cache-Control'] = 'private, max-age=3600'  # Cache for 1 hour on client
+                if encoded['etag']:
+                    response['ETag'] = encoded['etag']
+                    # Add cache headers for better performance
+                    response['Cache-Control'] = 'private, max-age=3600'  # Cache for 1 hour on client
+                else:
+                    # A failed restore returns the blurred image; never let the client keep it
+                    response['Cache-Control'] = 'no-store'
                 
                 logger.info(f"Successfully restored image {processed_image_id} in {img_format} format")
                 return response
@@ -271,12 +470,15 @@ class DecryptCroppedImageView(APIView):
             if decrypted_data is None:
                 return HttpResponse("Could not decrypt image", status=500)
             
-            # Determine content type based on image format
-            content_type = f'image/{cropped_region.image_format.lower()}'
+            # Raw pixel payloads are sent as PNG; encoded payloads as stored
+            image_data, img_format = region_payload_as_image_file(decrypted_data, cropped_region.image_format)
+            content_type = f'image/{img_format}'
             
             # Return the image as a response
-            response = HttpResponse(decrypted_data, content_type=content_type)
+            response = HttpResponse(image_data, content_type=content_type)
             filename = cropped_region.original_filename
+            if cropped_region.image_format == 'RAW':
+                filename = f"{os.path.splitext(filename)[0]}.png"
             response['Content-Disposition'] = f'inline; filename="{filename}"'
             
             return response
@@ -289,6 +491,7 @@ class DecryptCroppedImageView(APIView):
 class PatientImageView(APIView):
     """API endpoint to get a specific patient's processed image"""
     permission_classes = [IsAuthenticated & IsDoctorUser]
+    content_negotiation_class = ImageContentNegotiation
     
     def get(self, request, patient_id):
         """Get a patient image in its restored form"""
@@ -299,13 +502,16 @@ class PatientImageView(APIView):
             # Check if we should use E2E encryption (might be in either of these formats)
             use_e2e = request.query_params.get('use_e2e', 'true').lower() == 'true'
             
-            # Get the enhancement parameter (default to false for exact preservation)
-            enhance = request.query_params.get('enhance', 'false').lower() == 'true'
+            # Explicit ?format= wins, otherwise negotiate from the Accept header
+            img_format = negotiate_format(request.headers.get('Accept'), request.query_params.get('format'))
+            img_format, quality = resolve_encoding(img_format)
             
-            # Get the format parameter (default to png)
-            img_format = request.query_params.get('format', 'png').lower()
-            if img_format not in ['png', 'jpg', 'jpeg']:
-                img_format = 'png'
+            # Similarity metrics are opt-in; the default path only decrypts and pastes
+            include_similarity = request.query_params.get('similarity', 'false').lower() == 'true'
+            
+            # 'regions' returns the blurred image URL plus decrypted region payloads
+            # for the client to composite, instead of a restored frame
+            delivery = request.query_params.get('delivery', 'image').lower()
             
             # Get the patient
             patient = Patient.objects.get(id=patient_id)
@@ -327,30 +533,50 @@ class PatientImageView(APIView):
             # Log the decryption request details
             logger.info(f"Image request - Patient: {patient_id}, User: {request.user.id}, E2E: {use_e2e}")
             
-            # Restore the image from blurred + crops
-            restored_img, filename, similarity = restore_from_cropped(
-                processed_image.id, 
-                enhance=enhance,
-                user=user_for_decryption
-            )
+            if delivery in ('regions', 'e2e'):
+                return self.region_delivery(request, processed_image, e2e=delivery == 'e2e')
             
             # Generate an appropriate filename - use processed image ID to avoid confusion
-            output_filename = f"patient_{patient_id}_image_{processed_image.id}.{img_format}"
+            output_filename = f"patient_{patient_id}_image_{processed_image.id}.{FILE_EXTENSIONS[img_format]}"
             
-            # Convert the image to bytes
-            success, buffer = cv2.imencode(f'.{img_format}', restored_img)
-            if not success:
-                return Response({"error": "Failed to encode image"}, status=500)
+            # The ETag only depends on the image version, so a client that already
+            # has the current image gets a 304 without the payload being loaded
+            etag = restored_image_etag(processed_image.id, img_format, quality)
+            if etag_matches(request, etag):
+                response = HttpResponseNotModified()
+                response['ETag'] = etag
+                response['Cache-Control'] = 'private, no-cache'
+                response['Vary'] = 'Accept'
+                return response
+            
+            # Restore the image from blurred + crops (encoded bytes are cached per version)
+            encoded = get_encoded_restored_image(
+                processed_image.id,
+                img_format=img_format,
+                quality=quality,
+                user=user_for_decryption,
+                cache_policy=CachePolicy.USE,
+                compute_similarity=include_similarity
+            )
+            similarity = encoded['similarity'] if include_similarity else None
             
-            # Create response with the image data
-            response = HttpResponse(
-                buffer.tobytes(),
-                content_type=f"image/{img_format}"
+            # Stream the encoded image from its buffer (supports Range requests)
+            response = stream_image_response(
+                request, encoded['data'], encoded['content_type'], etag=encoded['etag']
             )
             
             # Add content disposition header to name the file
             response['Content-Disposition'] = f'inline; filename="{output_filename}"'
             
+            # Let clients revalidate cheaply with If-None-Match, unless the
+            # restore failed and this is the blurred fallback
+            if encoded['etag']:
+                response['ETag'] = encoded['etag']
+                response['Cache-Control'] = 'private, no-cache'
+            else:
+                response['Cache-Control'] = 'no-store'
+            response['Vary'] = 'Accept'
+            
             # Add similarity metrics in response headers if available
             if similarity:
                 # Convert similarity dict to JSON string
@@ -368,3 +594,237 @@ class PatientImageView(APIView):
             # Log the error for debugging
             logger.error(f"Error in PatientImageView: {str(e)}")
             return Response({"error": str(e)}, status=500)
+    
+    def region_delivery(self, request, processed_image, e2e=False):
+        """
+        Return the blurred image reference and the decrypted regions with their boxes.
+        
+        Server work and response size scale with the region area instead of the
+        full frame; the client pastes each region at (x1, y1) over the blurred image.
+        With e2e, each region is wrapped under the user's DH-derived key
+        (AES-GCM, see wrap_for_client) and decrypted in the browser.
+        """
+        variant = 'regions'
+        if e2e:
+            key = get_user_transport_key(request.user)
+            if key is None:
+                return Response(
+                    {"error": "No key exchange completed for this user; call /api/auth/key-exchange/ first"},
+                    status=status.HTTP_409_CONFLICT
+                )
+            # Each key gets its own representation, so a new key exchange never matches an old ETag
+            variant = f"e2e:{hashlib.sha256(key).hexdigest()[:16]}"
+        
+        etag = restored_image_etag(processed_image.id, variant, None)
+        if etag_matches(request, etag):
+            response = HttpResponseNotModified()
+            response['ETag'] = etag
+            response['Cache-Control'] = 'private, no-cache'
+            return response
+        
+        payloads = get_e2e_region_payloads(processed_image.id, key) if e2e else get_region_payloads(processed_image.id)
+        data = {
+            'processed_image_id': processed_image.id,
+            'blurred_image_url': request.build_absolute_uri(processed_image.blurred_image.url),
+            'regions': payloads['regions'],
+            'failed_regions': payloads['failed_regions'],
+        }
+        if e2e:
+            data['encryption'] = {'algorithm': 'AES-GCM', 'iv_length': 12, 'key_id': payloads['key_id']}
+        
+        response = Response(data)
+        # Regions that failed to decrypt are retried on the next request, so a
+        # partial result must not be revalidated or stored
+        if payloads['failed_regions']:
+            response['Cache-Control'] = 'no-store'
+        else:
+            response['ETag'] = restored_image_etag(processed_image.id, variant, None, payloads['version'])
+            response['Cache-Control'] = 'private, no-cache'
+        return response
+
+class DeepZoomDescriptorView(APIView):
+    """
+    API endpoint returning the Deep Zoom (.dzi) descriptor of a restored image.
+    
+    Viewers such as OpenSeadragon load tiles relative to this URL from
+    ``<id>_files/<level>/<col>_<row>.<format>``.
+    """
+    permission_classes = [IsAuthenticated & IsDoctorUser]
+    content_negotiation_class = ImageContentNegotiation
+    
+    def get(self, request, processed_image_id):
+        processed_image = get_object_or_404(ProcessedImage, id=processed_image_id)
+        
+        # The size comes from the file header; the pixels are not needed here
+        dimensions = image_dimensions(processed_image)
+        if dimensions is None:
+            return Response({"error": "Blurred image could not be read"}, status=500)
+        width, height = dimensions
+        
+        img_format = negotiate_format(request.headers.get('Accept'), request.query_params.get('format'))
+        descriptor = deepzoom_descriptor(width, height, FILE_EXTENSIONS[img_format])
+        response = HttpResponse(descriptor, content_type='application/xml')
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+
+class DeepZoomTileView(APIView):
+    """
+    API endpoint serving one tile of a restored image's Deep Zoom pyramid.
+    
+    Only regions intersecting the tile are decrypted; encoded tiles are cached
+    per image version like full restored images.
+    """
+    permission_classes = [IsAuthenticated & IsDoctorUser]
+    content_negotiation_class = ImageContentNegotiation
+    
+    def get(self, request, processed_image_id, level, col, row, img_format):
+        img_format = normalize_format(img_format)
+        if img_format is None:
+            return Response({"error": "Unsupported tile format"}, status=404)
+        
+        # Resolve the version once so the cache key and ETag always agree
+        version = get_image_version(processed_image_id)
+        etag = deepzoom_tile_etag(processed_image_id, version, level, col, row, img_format)
+        if etag_matches(request, etag):
+            response = HttpResponseNotModified()
+            response['ETag'] = etag
+            return response
+        
+        def load_image():
+            processed_image = get_object_or_404(ProcessedImage, id=processed_image_id)
+            # Encrypted payloads are only loaded for regions that intersect the tile
+            return processed_image, processed_image.cropped_regions.all()
+        
+        encoded = get_encoded_tile(processed_image_id, version, level, col, row, img_format, load_image)
+        if encoded is None:
+            return Response({"error": "Tile not found"}, status=404)
+        
+        if encoded['failed_regions']:
+            # Some regions are still blurred; the client must not keep or revalidate this tile
+            response = stream_image_response(request, encoded['data'], encoded['content_type'])
+            response['Cache-Control'] = 'no-store'
+            return response
+        
+        response = stream_image_response(request, encoded['data'], encoded['content_type'], etag=etag)
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+
+def run_bounded(tasks, max_workers):
+    """
+    Run zero-argument callables on a bounded thread pool, preserving order.
+    
+    Worker threads close their database connections when done, so pooled
+    threads never leak connections. With max_workers <= 1 the tasks run
+    inline in the calling thread.
+    
+    Returns:
+        list: The results of the tasks, in the order given
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from django.db import connections
+    
+    if max_workers <= 1 or len(tasks) <= 1:
+        return [task() for task in tasks]
+    
+    def run(task):
+        try:
+            return task()
+        finally:
+            connections.close_all()
+    
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(tasks))) as executor:
+        return list(executor.map(run, tasks))
+
+class PatientGalleryView(APIView):
+    """
+    API endpoint returning all of a patient's processed images in one response.
+    
+    Images and their regions are loaded with two queries; thumbnails are the
+    top Deep Zoom tile of each restored image, rendered concurrently on a
+    bounded thread pool and cached per image version. Each entry carries links
+    to the full image and tile pyramid and its own timing.
+    """
+    permission_classes = [IsAuthenticated & IsDoctorUser]
+    
+    def get(self, request, patient_id):
+        import time
+        
+        start_time = time.perf_counter()
+        patient = get_object_or_404(Patient, id=patient_id)
+        
+        include_thumbnails = request.query_params.get('thumbnails', 'true').lower() == 'true'
+        try:
+            size = int(request.query_params.get('size', tile_size()))
+        except ValueError:
+            size = tile_size()
+        # A thumbnail is a single tile, so it can't be larger than one
+        size = max(16, min(size, tile_size()))
+        
+        # Region payloads are only loaded on demand (the default region manager
+        # defers them), for tiles that need them
+        processed_images = list(
+            ProcessedImage.objects.filter(patient=patient).order_by('-created_at').prefetch_related('cropped_regions')
+        )
+        
+        def entry_task(processed_image):
+            regions = list(processed_image.cropped_regions.all())
+            return lambda: self.render_entry(request, processed_image, regions, size, include_thumbnails)
+        
+        max_workers = getattr(settings, 'GALLERY_MAX_WORKERS', 4)
+        entries = run_bounded([entry_task(image) for image in processed_images], max_workers)
+        
+        return Response({
+            'patient_id': patient.id,
+            'count': len(entries),
+            'images': entries,
+            'total_ms': round((time.perf_counter() - start_time) * 1000, 2),
+        })
+    
+    def render_entry(self, request, processed_image, regions, size, include_thumbnail):
+        """Build the gallery entry of one processed image (runs on a pool thread)"""
+        import time
+        
+        start_time = time.perf_counter()
+        entry = {
+            'id': processed_image.id,
+            'created_at': processed_image.created_at,
+            'regions': len(regions),
+            'image_url': request.build_absolute_uri(
+                reverse('patient-image', kwargs={'patient_id': processed_image.patient_id})
+                + f"?processed_image_id={processed_image.id}"
+            ),
+            'dzi_url': request.build_absolute_uri(
+                reverse('deepzoom-descriptor', kwargs={'processed_image_id': processed_image.id})
+            ),
+        }
+        
+        try:
+            # The size comes from the file header, and the thumbnail tile reuses
+            # it along with the cached pyramid level, so a cold entry decodes the
+            # blurred image at most once
+            version = get_image_version(processed_image.id)
+            dimensions = image_dimensions(processed_image, version)
+            if dimensions is None:
+                raise ValueError("Blurred image could not be read")
+            width, height = dimensions
+            level = thumbnail_level(width, height, size)
+            entry.update({'width': width, 'height': height})
+            entry['thumbnail_url'] = request.build_absolute_uri(reverse('deepzoom-tile', kwargs={
+                'processed_image_id': processed_image.id, 'level': level, 'col': 0, 'row': 0, 'img_format': 'jpg'
+            }))
+            
+            if include_thumbnail:
+                encoded = get_encoded_tile(
+                    processed_image.id, version, level, 0, 0, 'jpeg', lambda: (processed_image, regions)
+                )
+                entry['thumbnail'] = {
+                    'content_type': encoded['content_type'],
+                    'data': base64.b64encode(memoryview(encoded['data'])).decode('ascii'),
+                }
+        except Exception as e:
+            logger.error(f"Gallery entry for image {processed_image.id} failed: {str(e)}")
+            entry['error'] = str(e)
+        
+        entry['timing_ms'] = round((time.perf_counter() - start_time) * 1000, 2)
+        return entry